@@ -0,0 +1 @@
+default_app_config = 'evileg_core.apps.EvilegCoreConfig'
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Denormalized counters of activities like likes, bookmarks and subscriptions.
+
+EActivityCounter of content object is changed with atomic UPDATE after creating and deleting of activity
+of any EAbstractActivity model, so numbers of activities are read without COUNT queries.
+Counters are not changed by bulk_create and QuerySet.update, they are fixed by reconcile_activity_counters
+management command, which can be run periodically. Counters are disabled by EVILEG_CORE_ACTIVITY_COUNTERS setting::
+
+    EVILEG_CORE_ACTIVITY_COUNTERS = False
+"""
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_delete, post_save
+
+from .managers import apply_list_projection
+
+_content_types_by_model_name = {}
+
+
+def get_content_type_by_model_name(model_name):
+    """
+    ContentType by name of model with cache, it is used by templates, which know only model name
+
+    :param model_name: lowercase name of model
+    :return: ContentType
+    """
+    if model_name not in _content_types_by_model_name:
+        _content_types_by_model_name[model_name] = ContentType.objects.get(model=model_name).pk
+    return ContentType.objects.get_for_id(_content_types_by_model_name[model_name])
+
+
+def count_activities(activity_set, model_name=None):
+    """
+    Number of activities in activity set. Activities of one object, like post.likes of GenericRelation,
+    are counted by EActivityCounter without COUNT query. Activities of user, like user.likes,
+    are counted by COUNT query, because counters are kept per object.
+
+    :param activity_set: QuerySet or related manager of activities
+    :param model_name: lowercase name of content model for counting of activities only of this model
+    :return: number of activities
+    """
+    if model_name:
+        return activity_set.filter(content_type=get_content_type_by_model_name(model_name)).count()
+    # Related manager of GenericRelation of one object has content_type and pk_val of this object
+    content_type = getattr(activity_set, 'content_type', None)
+    object_id = getattr(activity_set, 'pk_val', None)
+    if content_type is not None and object_id is not None and activity_set.model in get_activity_models():
+        from .models import EActivityCounter
+        return EActivityCounter.objects.db_manager(activity_set.db).get_counts_by_ids(
+            activity_set.model, content_type.pk, [object_id]
+        )[object_id]
+    return activity_set.count()
+
+
+def get_activity_models():
+    """
+    :return: list of models of activities
+    """
+    from .models import EAbstractActivity
+    return [model for model in apps.get_models() if issubclass(model, EAbstractActivity)]
+
+
+def increment_counter(sender, instance=None, created=False, raw=False, using=None, **kwargs):
+    if created and not raw:
+        from .models import EActivityCounter
+        EActivityCounter.objects.db_manager(using).change(sender, instance.content_type_id, instance.object_id, 1)
+
+
+def decrement_counter(sender, instance=None, using=None, **kwargs):
+    from .models import EActivityCounter
+    EActivityCounter.objects.db_manager(using).change(sender, instance.content_type_id, instance.object_id, -1)
+
+
+def connect_activity_counters():
+    """
+    Connect changing of counters to saving and deleting of activities. It is called when the application is ready.
+    """
+    if not getattr(settings, 'EVILEG_CORE_ACTIVITY_COUNTERS', True):
+        return
+    for model in get_activity_models():
+        post_save.connect(increment_counter, sender=model, dispatch_uid='evileg_core_activity_counter')
+        post_delete.connect(decrement_counter, sender=model, dispatch_uid='evileg_core_activity_counter')
+
+
+def get_target_select_related(model):
+    """
+    Relations of content model, which are selected together with targets of activities,
+    list_select_related of model or authors, because preview templates show them.
+
+    :param model: content model
+    :return: list of field names
+    """
+    if getattr(model, 'list_select_related', None) is not None:
+        return list(model.list_select_related)
+    user_model = apps.get_model(settings.AUTH_USER_MODEL)
+    return [
+        field.name for field in model._meta.concrete_fields
+        if field.many_to_one and field.related_model is user_model
+    ]
+
+
+def prefetch_targets(activities, select_related=None):
+    """
+    Load content objects of activities with one query per model of content and attach them to activities,
+    so content_object and get_self() do not query database. Activities of deleted objects are marked,
+    so their get_self() returns None without query.
+
+    :param activities: list of activities
+    :param select_related: dict of lists of relations by content models or their labels,
+                           list projection of content models is applied by default
+    :return: list of activities
+    """
+    activities = list(activities)
+    if not activities:
+        return activities
+    select_related = select_related or {}
+    using = activities[0]._state.db
+    ids_by_type = {}
+    for activity in activities:
+        ids_by_type.setdefault(activity.content_type_id, set()).add(activity.object_id)
+
+    targets = {}
+    for content_type_id, ids in ids_by_type.items():
+        model = ContentType.objects.db_manager(using).get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        related = select_related.get(model, select_related.get(model._meta.label, get_target_select_related(model)))
+        qs = apply_list_projection(model._base_manager.using(using).filter(pk__in=ids), related)
+        targets.update(((content_type_id, obj.pk), obj) for obj in qs)
+
+    for activity in activities:
+        activity.content_type = ContentType.objects.db_manager(using).get_for_id(activity.content_type_id)
+        target = targets.get((activity.content_type_id, activity.object_id))
+        if target is not None:
+            activity._meta.get_field('content_object').set_cached_value(activity, target)
+        else:
+            # GenericForeignKey does not cache None and queries again on every access
+            activity._missing_target = (activity.content_type_id, activity.object_id)
+    return activities
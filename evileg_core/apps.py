@@ -7,3 +7,11 @@ from django.utils.translation import ugettext_lazy as _
 class EvilegCoreConfig(AppConfig):
     name = 'evileg_core'
     verbose_name = _('EVILEG Core')
+
+    def ready(self):
+        from .activities import connect_activity_counters
+        from .fields import start_render_executor
+        from .search import connect_search_index
+        connect_activity_counters()
+        connect_search_index()
+        start_render_executor()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime
+
+import bs4
+import django
+import lxml.etree
+import markdown
+
+from ..extensions.video import VideoExtension
+from ..utils import EImageUrlsGetter, EMarkdownWorker, get_markdown_converter, get_sanitizer_class
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+
+
+def load_corpus(path=CORPUS_DIR):
+    """
+    Load markdown documents of benchmark corpus
+
+    :param path: directory with .md files, bundled corpus by default
+    :return: list of (name, text) tuples sorted by name
+    """
+    corpus = []
+    for file_name in sorted(glob.glob(os.path.join(path, '*.md'))):
+        with open(file_name, encoding='utf-8') as f:
+            corpus.append((os.path.splitext(os.path.basename(file_name))[0], f.read()))
+    return corpus
+
+
+class EMarkdownBenchmark:
+    """
+    Benchmark of stages of markdown to html pipeline over a corpus of documents.
+    Caches are not used, every stage is run repeat times over all documents, the best run is reported.
+    Peak memory of a stage is measured with tracemalloc in a separate run, because tracing slows the code down.
+
+    Stages:
+
+    - markdown - conversion of markdown to html by python-markdown with all extensions
+    - video - conversion of markdown by python-markdown with video extension only
+    - sanitize - clean up of html by sanitizer from MARKDOWN_SANITIZER_ENGINE
+    - render - the whole pipeline of EMarkdownWorker.render
+    - image_urls - EImageUrlsGetter.get_urls
+    - media_paths - EImageUrlsGetter.iter_media_paths
+
+    :param corpus: list of (name, text) tuples from load_corpus
+    :param repeat: number of timed runs of every stage
+    :param dofollow: dofollow flag of rendering
+    :param add_header_anchors: add_header_anchors flag of rendering
+    :param compact: compact flag of rendering
+    """
+    STAGES = ('markdown', 'video', 'sanitize', 'render', 'image_urls', 'media_paths')
+
+    def __init__(self, corpus, repeat=5, dofollow=False, add_header_anchors=False, compact=False):
+        self.corpus = corpus
+        self.repeat = repeat
+        self.flags = (dofollow, add_header_anchors, compact)
+        self.texts = [text for name, text in corpus]
+        # Input of stages after markdown conversion is prepared once
+        self.htmls = [EMarkdownWorker(text).markdown_text or '' for text in self.texts]
+        self.video_converter = markdown.Markdown(extensions=[VideoExtension()], output_format='html5')
+
+    def stage_markdown(self):
+        for text in self.texts:
+            get_markdown_converter().convert(text)
+
+    def stage_video(self):
+        for text in self.texts:
+            self.video_converter.reset().convert(text)
+
+    def stage_sanitize(self):
+        sanitizer_class = get_sanitizer_class()
+        dofollow, add_header_anchors, compact = self.flags
+        for html in self.htmls:
+            if html:
+                sanitizer_class(
+                    text=html, dofollow=dofollow, add_header_anchors=add_header_anchors, compact=compact
+                ).clean()
+
+    def stage_render(self):
+        for text in self.texts:
+            EMarkdownWorker(text).render(*self.flags, use_cache=False)
+
+    def stage_image_urls(self):
+        for html in self.htmls:
+            EImageUrlsGetter.get_urls(html)
+
+    def stage_media_paths(self):
+        for html in self.htmls:
+            set(EImageUrlsGetter.iter_media_paths(html))
+
+    def run_stage(self, name):
+        """
+        Run stage and measure it
+
+        :param name: name of stage
+        :return: dict with best and mean time in seconds, throughput in documents per second and peak memory in KiB
+        """
+        stage = getattr(self, 'stage_{}'.format(name))
+        # Warm up of converters and caches of regular expressions
+        stage()
+
+        timings = []
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            stage()
+            timings.append(time.perf_counter() - started)
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        stage()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        if not tracing:
+            tracemalloc.stop()
+
+        best = min(timings)
+        return {
+            'best': best,
+            'mean': sum(timings) / len(timings),
+            'docs_per_sec': len(self.texts) / best if best else 0,
+            'peak_kib': max(peak, 0) / 1024,
+        }
+
+    def run(self, stages=None):
+        """
+        Run stages
+
+        :param stages: names of stages, all stages by default
+        :return: dict with meta information and results of stages, it can be saved as JSON
+        """
+        return {
+            'meta': self.get_meta(),
+            'stages': {name: self.run_stage(name) for name in (stages or self.STAGES)},
+        }
+
+    def get_meta(self):
+        sanitizer_class = get_sanitizer_class()
+        return {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'markdown': markdown.__version__ if hasattr(markdown, '__version__') else markdown.version,
+            'beautifulsoup4': bs4.__version__,
+            'lxml': lxml.etree.__version__,
+            'sanitizer': '{}.{}'.format(sanitizer_class.__module__, sanitizer_class.__name__),
+            'documents': len(self.texts),
+            'bytes': sum(len(text.encode('utf-8')) for text in self.texts),
+            'repeat': self.repeat,
+            'flags': dict(zip(('dofollow', 'add_header_anchors', 'compact'), self.flags)),
+        }
+
+
+def compare_results(previous, current, threshold=0.1):
+    """
+    Compare results of two benchmark runs
+
+    :param previous: results of previous run
+    :param current: results of current run
+    :param threshold: relative slowdown of best time, which is reported as regression
+    :return: list of (stage, previous best, current best, relative change, is regression) tuples
+    """
+    rows = []
+    for name, result in current['stages'].items():
+        before = previous.get('stages', {}).get(name)
+        if before is None:
+            continue
+        change = (result['best'] - before['best']) / before['best'] if before['best'] else 0
+        rows.append((name, before['best'], result['best'], change, change > threshold))
+    return rows
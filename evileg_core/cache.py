@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class ELRUCache:
+    """
+    Thread-safe in-process cache with bounded number of entries.
+    The least recently used entry is evicted when the cache is full.
+    """
+    __slots__ = ['maxsize', '_data', '_lock']
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ERenderCache:
+    """
+    Two-tier cache for rendered content.
+    The first tier is a bounded in-process ELRUCache, the second tier is a django cache backend,
+    for example redis via django-redis. Keys are built from a hash of the source text, so they have fixed length.
+
+    Settings:
+
+    - MARKDOWN_RENDER_CACHE - enable or disable caching, True by default
+    - MARKDOWN_RENDER_CACHE_SIZE - number of entries in the in-process tier, 512 by default
+    - MARKDOWN_RENDER_CACHE_ALIAS - alias of django cache for the shared tier, 'default' by default, None disables it
+    - MARKDOWN_RENDER_CACHE_TIMEOUT - timeout of entries in the shared tier, one day by default
+    - MARKDOWN_RENDER_CACHE_VERSION - bump it for invalidation of all entries, when SITE_URL or LANGUAGES were changed
+
+    :param prefix: prefix of cache keys
+    :param size_setting: name of setting with number of entries in the in-process tier
+    :param size: default number of entries in the in-process tier
+    """
+    __slots__ = ['prefix', 'size_setting', 'size', '_local', '_lock']
+
+    def __init__(self, prefix, size_setting='MARKDOWN_RENDER_CACHE_SIZE', size=512):
+        self.prefix = prefix
+        self.size_setting = size_setting
+        self.size = size
+        self._local = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'MARKDOWN_RENDER_CACHE', True)
+
+    @property
+    def local(self):
+        if self._local is None:
+            with self._lock:
+                if self._local is None:
+                    self._local = ELRUCache(maxsize=getattr(settings, self.size_setting, self.size))
+        return self._local
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'MARKDOWN_RENDER_CACHE_ALIAS', 'default')
+        return caches[alias] if alias else None
+
+    def make_key(self, text, *flags):
+        """
+        Make cache key from text and flags, which have influence on the rendering result
+
+        :param text: source text
+        :param flags: flags and versions of rendering pipeline
+        :return: cache key
+        """
+        return '{}:{}:{}:{}'.format(
+            self.prefix,
+            getattr(settings, 'MARKDOWN_RENDER_CACHE_VERSION', 1),
+            ':'.join(str(flag) for flag in flags),
+            hashlib.sha256(text.encode('utf-8')).hexdigest()
+        )
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        value = self.local.get(key)
+        if value is None:
+            shared = self.shared
+            if shared is not None:
+                value = shared.get(key)
+                if value is not None:
+                    self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        self.local.set(key, value)
+        shared = self.shared
+        if shared is not None:
+            shared.set(key, value, getattr(settings, 'MARKDOWN_RENDER_CACHE_TIMEOUT', 60 * 60 * 24))
+
+    def clear(self):
+        """
+        Clear the in-process tier. The shared tier is invalidated by MARKDOWN_RENDER_CACHE_VERSION
+        """
+        self.local.clear()
@@ -1,52 +1,102 @@
 # -*- coding: utf-8 -*-
 
+import re
+from collections import OrderedDict
+
 import markdown
 from markdown.util import etree
 
 
-class VideoExtension(markdown.Extension):
+class VideoProvider:
+    """
+    Video hosting, which links are replaced with embedded player
 
-    def add_inline(self, md, name, klass, re):
-        pattern = klass(re)
-        pattern.md = md
-        pattern.ext = self
-        md.inlinePatterns.add(name, pattern, "<reference")
+    :param name: name of provider
+    :param regex: regular expression of video link with id named group
+    :param embed_url: url of player with {id} placeholder
+    """
+    __slots__ = ['name', 'regex', 'embed_url', 'compiled_re']
 
-    def extendMarkdown(self, md, md_globals):
-        self.add_inline(md, 'dailymotion', Dailymotion,
-                        r'([^(]|^)https?://www\.dailymotion\.com/video/(?P<dailymotionid>[a-zA-Z0-9]+)(_[\w\-]*)?')
-        self.add_inline(md, 'metacafe', Metacafe,
-                        r'([^(]|^)https://www\.metacafe\.com/watch/(?P<metacafeid>\d+)/?(:?.+/?)')
-        self.add_inline(md, 'vimeo', Vimeo,
-                        r'([^(]|^)https://(www.|)vimeo\.com/(?P<vimeoid>\d+)\S*')
-        self.add_inline(md, 'youtube', Youtube,
-                        r'([^(]|^)https?://www\.youtube\.com/watch\?\S*v=(?P<youtubeid>\S[^&/]+)')
-        self.add_inline(md, 'youtube_short', Youtube,
-                        r'([^(]|^)https?://youtu\.be/(?P<youtubeid>\S[^?&/]+)?')
+    def __init__(self, name, regex, embed_url):
+        self.name = name
+        self.regex = regex
+        self.embed_url = embed_url
+        self.compiled_re = re.compile(r'^(.*?)([^(]|^){}(.*)$'.format(regex), re.DOTALL | re.UNICODE)
 
+    def handleMatch(self, m):
+        return render_video(self.embed_url.format(id=m.group('id')))
 
-class Dailymotion(markdown.inlinepatterns.Pattern):
 
-    def handleMatch(self, m):
-        return render_video('//www.dailymotion.com/embed/video/{}'.format(m.group('dailymotionid')))
+video_providers = OrderedDict()
 
 
-class Metacafe(markdown.inlinepatterns.Pattern):
+def register_video_provider(name, regex, embed_url):
+    """
+    Register video provider for VideoExtension.
+    Providers are checked in order of registration, when a text contains a link of one of them.
 
-    def handleMatch(self, m):
-        return render_video('//www.metacafe.com/embed/{}/'.format(m.group('metacafeid')))
+    **Example**::
 
+        register_video_provider('rutube', r'https://rutube\\.ru/video/(?P<id>[a-f0-9]+)/?',
+                                '//rutube.ru/play/embed/{id}')
 
-class Vimeo(markdown.inlinepatterns.Pattern):
+    :param name: name of provider, provider with the same name is replaced
+    :param regex: regular expression of video link with id named group
+    :param embed_url: url of player with {id} placeholder
+    """
+    video_providers[name] = VideoProvider(name, regex, embed_url)
 
-    def handleMatch(self, m):
-        return render_video('//player.vimeo.com/video/{}'.format(m.group('vimeoid')))
+
+register_video_provider('dailymotion', r'https?://www\.dailymotion\.com/video/(?P<id>[a-zA-Z0-9]+)(_[\w\-]*)?',
+                        '//www.dailymotion.com/embed/video/{id}')
+register_video_provider('metacafe', r'https://www\.metacafe\.com/watch/(?P<id>\d+)/?(:?.+/?)',
+                        '//www.metacafe.com/embed/{id}/')
+register_video_provider('vimeo', r'https://(www.|)vimeo\.com/(?P<id>\d+)\S*',
+                        '//player.vimeo.com/video/{id}')
+register_video_provider('youtube', r'https?://www\.youtube\.com/watch\?\S*v=(?P<id>\S[^&/]+)',
+                        '//www.youtube.com/embed/{id}')
+register_video_provider('youtube_short', r'https?://youtu\.be/(?P<id>\S[^?&/]+)?',
+                        '//www.youtube.com/embed/{id}')
 
 
-class Youtube(markdown.inlinepatterns.Pattern):
+class VideoPattern(markdown.inlinepatterns.Pattern):
+    """
+    Single inline pattern for all video providers.
+    Text is skipped without regular expressions, if it does not contain '://',
+    then it is checked by one combined regular expression of all providers.
+    Only when it contains a video link, the match of the first provider in order of registration is returned,
+    and it is handled by this provider.
+    """
+
+    def __init__(self, providers, md=None):
+        self.providers = list(providers)
+        self.handlers = {provider.compiled_re: provider for provider in self.providers}
+        super().__init__(r'([^(]|^)(?:{})'.format('|'.join(
+            '(?:{})'.format(provider.regex.replace('(?P<id>', '(')) for provider in self.providers
+        )), md)
+
+    def getCompiledRegExp(self):
+        return self
+
+    def match(self, text):
+        if '://' not in text or self.compiled_re.match(text) is None:
+            return None
+        for provider in self.providers:
+            m = provider.compiled_re.match(text)
+            if m is not None:
+                return m
+        return None
 
     def handleMatch(self, m):
-        return render_video('//www.youtube.com/embed/{}'.format(m.group('youtubeid')))
+        return self.handlers[m.re].handleMatch(m)
+
+
+class VideoExtension(markdown.Extension):
+
+    def extendMarkdown(self, md, md_globals):
+        pattern = VideoPattern(video_providers.values(), md)
+        pattern.ext = self
+        md.inlinePatterns.add('video', pattern, "<reference")
 
 
 def render_video(url):
@@ -1,13 +1,169 @@
 # -*- coding: utf-8 -*-
 
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import django
 from django import forms
+from django.apps import apps
 from django.conf import settings
-from django.db import models
-from django.db.models.signals import pre_save
+from django.core.exceptions import FieldDoesNotExist
+from django.db import close_old_connections, models, transaction
+from django.db.models.signals import pre_save, post_save, post_delete, post_init
+from django.utils.html import linebreaks
 
-from .utils import EMarkdownWorker
+from .signals import markdown_render_context
+from .utils import EMarkdownWorker, get_excerpt
 from .widgets import EMarkdownWidget
 
+logger = logging.getLogger(__name__)
+
+_background_executor = None
+_background_executor_lock = threading.Lock()
+_render_executor = None
+
+# EMarkdownField fields of models, rendering of them is coordinated by one pre_save receiver per model
+_model_markdown_fields = {}
+
+
+def _render_in_background(field, pk, value, flags, using):
+    """
+    Render markdown of saved object and write html, if neither markdown nor dofollow were changed since saving
+    """
+    close_old_connections()
+    try:
+        with markdown_render_context(field.get_render_label(), pk):
+            result = EMarkdownWorker(value).render(*flags)
+        lookups = {'pk': pk, field.attname: value}
+        if 'dofollow' in {f.attname for f in field.model._meta.concrete_fields}:
+            lookups['dofollow'] = flags[0]
+        updated = field.model._base_manager.using(using).filter(**lookups).update(**field.get_rendered_values(result))
+        if updated and field.index_links:
+            from .models import EContentLink
+            EContentLink.objects.db_manager(using).index(field.model(pk=pk), field.name, result['links'])
+        if updated:
+            from .search import update_index
+            update_index(field.model, [pk], using)
+    except Exception:
+        logger.exception('Background rendering of %s pk=%s failed', field.get_render_label(), pk)
+    finally:
+        close_old_connections()
+
+
+def submit_background_rendering(field, pk, value, flags, using=None):
+    """
+    Render markdown of saved object in thread pool with MARKDOWN_BACKGROUND_WORKERS workers, 2 by default.
+    If MARKDOWN_BACKGROUND_WORKERS is 0, markdown is rendered in the current thread, it is useful for tests.
+
+    :param field: EMarkdownField
+    :param pk: primary key of object
+    :param value: saved markdown
+    :param flags: flags from get_render_flags
+    :param using: database alias
+    """
+    global _background_executor
+    workers = getattr(settings, 'MARKDOWN_BACKGROUND_WORKERS', 2)
+    if workers < 1:
+        _render_in_background(field, pk, value, flags, using)
+        return
+    with _background_executor_lock:
+        if _background_executor is None:
+            _background_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='markdown_render')
+    _background_executor.submit(_render_in_background, field, pk, value, flags, using)
+
+
+def _render_markdown(value, flags, label, pk):
+    """
+    Render markdown in worker process. The render cache is filled by the saving process,
+    so connections of cache backends are not opened in worker processes.
+    """
+    with markdown_render_context(label, pk):
+        return EMarkdownWorker(value).render(*flags, use_cache=False)
+
+
+def start_render_executor():
+    """
+    Start pool of MARKDOWN_RENDER_WORKERS processes for rendering of several changed fields of object on saving,
+    for example language variants of django-modeltranslation field. It is called when the application is ready,
+    pool is not started, if MARKDOWN_RENDER_WORKERS is 1, by default. Processes are started by spawn method
+    or by MARKDOWN_RENDER_START_METHOD, so they do not inherit database connections and threads of the server.
+    Threads are not used, because rendering holds the GIL.
+    """
+    global _render_executor
+    workers = getattr(settings, 'MARKDOWN_RENDER_WORKERS', 1)
+    # Worker processes set up Django too, they must not start their own pools
+    if workers > 1 and _render_executor is None and multiprocessing.current_process().name == 'MainProcess':
+        context = multiprocessing.get_context(getattr(settings, 'MARKDOWN_RENDER_START_METHOD', 'spawn'))
+        # Initializer is unpickled before setup of Django, so it must not be a function of this module
+        _render_executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=django.setup)
+
+
+def _render_in_pool(instance, tasks):
+    """
+    Render fields in the pool of processes, if more than one of them is not found in the render cache
+
+    :return: list of tasks, which were not rendered
+    """
+    global _render_executor
+    missed = []
+    for field, value, flags in tasks:
+        result = EMarkdownWorker(value).get_cached(*flags)
+        if result is None:
+            missed.append((field, value, flags))
+        else:
+            field.set_rendered(instance, value, flags, result)
+    if len(missed) < 2:
+        return missed
+    try:
+        futures = [
+            _render_executor.submit(_render_markdown, value, flags, field.get_render_label(), instance.pk)
+            for field, value, flags in missed
+        ]
+        results = [future.result() for future in futures]
+    except BrokenProcessPool:
+        # Broken pool is not restarted, rendering continues in saving processes
+        logger.exception('Pool of markdown rendering is broken, markdown is rendered in the saving process')
+        _render_executor = None
+        return missed
+    for (field, value, flags), result in zip(missed, results):
+        EMarkdownWorker(value).set_cached(result, *flags)
+        field.set_rendered(instance, value, flags, result)
+    return []
+
+
+def render_markdown_fields(sender, instance=None, update_fields=None, **kwargs):
+    """
+    Render all EMarkdownField fields of object, which need rendering, for example all changed
+    language variants of django-modeltranslation field. It is connected to pre_save signal once per model.
+
+    Markdown, which is not found in the render cache, is rendered in the saving thread,
+    or in the pool of processes from start_render_executor, if it is started and several fields are not cached.
+    """
+    tasks = []
+    for field in _model_markdown_fields.get(sender, ()):
+        prepared = field.prepare_rendering(instance, update_fields)
+        if prepared is None:
+            continue
+        value, flags = prepared
+        if field.background_rendering:
+            result = EMarkdownWorker(value).get_cached(*flags)
+            if result is None:
+                field.set_pending(instance, value, flags)
+            else:
+                field.set_rendered(instance, value, flags, result)
+        else:
+            tasks.append((field, value, flags))
+
+    if len(tasks) > 1 and _render_executor is not None:
+        tasks = _render_in_pool(instance, tasks)
+    for field, value, flags in tasks:
+        field.set_rendered(instance, value, flags, field.render(instance, flags))
+
 
 class EMarkdownField(models.TextField):
     """
@@ -15,28 +171,280 @@ class EMarkdownField(models.TextField):
     This field must be used with second text field for html content.
     This field support django-modeltranslation package.
 
+    If compact_html is True, html is stored without indentation and line breaks added by prettify.
+    Default value can be set by MARKDOWN_COMPACT_HTML setting.
+    Existing rows can be rewritten with compact_markdown_html management command.
+
+    If index_links is True, urls of links, images and embedded frames are written to EContentLink index
+    after saving of object. Default value can be set by MARKDOWN_INDEX_LINKS setting.
+
+    If toc_field is set, table of contents is stored to this text field as JSON list of dicts
+    with 'level', 'text' and 'anchor' keys, see ESoup.get_toc. Headers are collected only with add_header_anchors.
+    Use markdown_toc template filter for loading of it in templates.
+
+    If excerpt_field is set, plain text of html truncated to MARKDOWN_EXCERPT_LENGTH characters, 500 by default,
+    is stored to this text field, so previews and meta descriptions do not parse html on every request.
+    Excerpts of existing rows are written by rerender_markdown management command, because saving does not render
+    unchanged markdown. With django-modeltranslation, toc_field and excerpt_field must be registered
+    for translation together with markdown field, otherwise language variants do not populate them.
+
+    If background_rendering is True, markdown, which is not found in the render cache, is not rendered on saving.
+    The html field gets fallback html from get_fallback_html, and markdown is rendered in background
+    after commit of transaction, see submit_background_rendering. Rendered html is written by conditional update,
+    only if markdown of the row was not changed meanwhile. Default value can be set by MARKDOWN_BACKGROUND_RENDERING.
+    Rows with fallback html, which renderings were lost on restart of process, are fixed by rerender_markdown.
+
+    Markdown is rendered only when it or rendering flags were changed since loading from database or last saving,
+    and when the field is in update_fields of save(). All fields of object are rendered by render_markdown_fields.
+    Use reset_markdown_snapshots() for forced rendering, and rerender_markdown management command
+    after changes of flags via QuerySet.update() or in the code.
+
     EMarkdownField can use upload_link and upload_file_link for invoke upload dialog from backend.
     Unfortunately, this mechanism is not fully developed for using like 3d party.
     We develop this in near future.
     """
 
-    def set_markdown(self, instance=None, update_fields=None, **kwargs):
+    def get_html_field_name(self):
+        """
+        Get name of html field, which is populated by this field.
+        For django-modeltranslation fields it is html field with the same language code.
+
+        :return: field name
+        """
+        return self._get_translated_name(self.html_field)
+
+    def get_toc_field_name(self):
+        """
+        Get name of table of contents field, which is populated by this field, like get_html_field_name
+
+        :return: field name or None, if toc_field is not set or it is not registered for translation
+        """
+        return self._get_optional_translated_name(self.toc_field)
+
+    def get_excerpt_field_name(self):
+        """
+        Get name of excerpt field, which is populated by this field, like get_html_field_name
+
+        :return: field name or None, if excerpt_field is not set or it is not registered for translation
+        """
+        return self._get_optional_translated_name(self.excerpt_field)
+
+    def _get_translated_name(self, name):
+        return name + self.language_suffix
+
+    def _get_optional_translated_name(self, name):
+        """
+        Translated name of optional populated field. Language variants of toc_field and excerpt_field exist only,
+        if these fields are registered in django-modeltranslation together with markdown field,
+        otherwise they are not populated by language variants of markdown field.
+        """
+        if not name:
+            return None
+        translated_name = self._get_translated_name(name)
+        try:
+            self.model._meta.get_field(translated_name)
+        except FieldDoesNotExist:
+            return None
+        return translated_name
+
+    def _get_language_suffix(self, name):
+        """
+        Suffix of django-modeltranslation field name, for example '_en' for content_markdown_en, or empty string
+        """
+        if 'modeltranslation' in settings.INSTALLED_APPS:
+            for code, language in getattr(settings, "LANGUAGES", None) or ():
+                suffix = '_{}'.format(code.replace('-', '_'))
+                if name.endswith(suffix):
+                    return suffix
+        return ''
+
+    def get_rendered_field_names(self):
+        """
+        Names of fields, which are populated from render result: html field, and toc and excerpt fields, if they are set
+        """
+        names = [self.get_html_field_name(), self.get_toc_field_name(), self.get_excerpt_field_name()]
+        return [name for name in names if name]
+
+    def get_rendered_values(self, result):
+        """
+        Values of fields, which are populated from render result
+
+        :param result: render result from render
+        :return: dict of field name to value
+        """
+        values = {self.get_html_field_name(): result['html']}
+        toc_field_name = self.get_toc_field_name()
+        if toc_field_name:
+            values[toc_field_name] = json.dumps(result['toc'], ensure_ascii=False)
+        excerpt_field_name = self.get_excerpt_field_name()
+        if excerpt_field_name:
+            values[excerpt_field_name] = get_excerpt(
+                result['html'], getattr(settings, 'MARKDOWN_EXCERPT_LENGTH', 500)
+            )
+        return values
+
+    def get_fallback_html(self, instance):
+        """
+        Html, which is stored until markdown is rendered in background: escaped markdown text
+        in div with markdown-pending class, so templates and styles can recognize it
+
+        :param instance: model object
+        :return: html
+        """
+        return '<div class="markdown-pending">{}</div>'.format(linebreaks(getattr(instance, self.attname), autoescape=True))
+
+    def get_render_flags(self, instance):
+        """
+        Flags of rendering: dofollow of instance, add_header_anchors and compact_html
+
+        :param instance: model object
+        :return: tuple of flags
+        """
+        return getattr(instance, 'dofollow', False), self.add_header_anchors, self.compact_html
+
+    def render(self, instance, flags=None):
+        """
+        Render markdown of instance to html
+
+        :param instance: model object
+        :param flags: flags from get_render_flags
+        :return: dict with 'html' text and 'links' list, see EMarkdownWorker.render
+        """
+        with markdown_render_context(self.get_render_label(), instance.pk):
+            return EMarkdownWorker(getattr(instance, self.attname)).render(*(flags or self.get_render_flags(instance)))
+
+    def get_render_label(self):
+        """
+        Label of field for markdown_render_stage signal, for example 'blog.Article.content_markdown'
+        """
+        return '{}.{}'.format(self.model._meta.label, self.name)
+
+    def snapshot_markdown(self, instance=None, **kwargs):
+        """
+        Remember markdown and rendering flags of loaded object. It is connected to post_init signal.
+        dofollow is remembered only if it is a loaded field or a plain class attribute,
+        because a property may be expensive. Otherwise the object is rendered on the first saving.
+        """
+        if self.attname in instance.__dict__:
+            dofollow = instance.__dict__.get('dofollow', getattr(type(instance), 'dofollow', False))
+            if isinstance(dofollow, bool):
+                instance.__dict__.setdefault('_markdown_snapshots', {})[self.attname] = (
+                    instance.__dict__[self.attname], (dofollow, self.add_header_anchors, self.compact_html)
+                )
+
+    def update_snapshot(self, instance=None, **kwargs):
+        snapshot = instance.__dict__.get('_markdown_rendered', {}).pop(self.attname, None)
+        if snapshot is not None:
+            instance.__dict__.setdefault('_markdown_snapshots', {})[self.attname] = snapshot
+
+    def needs_rendering(self, instance, flags, update_fields=None):
+        """
+        Check if markdown must be rendered
+
+        :param instance: model object
+        :param flags: flags from get_render_flags
+        :param update_fields: update_fields of save()
+        :return: False, if the field is not saved or neither markdown nor flags were changed
+        """
+        if update_fields is not None and self.name not in update_fields:
+            return False
+        if instance._state.adding:
+            return True
+        snapshot = instance.__dict__.get('_markdown_snapshots', {}).get(self.attname)
+        return snapshot is None or snapshot != (getattr(instance, self.attname), flags)
+
+    def prepare_rendering(self, instance, update_fields=None):
+        """
+        Check if markdown of object must be rendered on saving
+
+        :param instance: model object
+        :param update_fields: update_fields of save()
+        :return: (markdown, flags) tuple or None
+        """
+        flags = self.get_render_flags(instance)
+        if not self.needs_rendering(instance, flags, update_fields):
+            return None
         value = getattr(instance, self.attname)
-        dofollow = False
-        if hasattr(instance, 'dofollow'):
-            dofollow = getattr(instance, 'dofollow')
         if (value and len(value) > 0) or getattr(settings, 'MARKDOWN_WRITE_EMPTY_CONTENT', False):
-            languages = getattr(settings, "LANGUAGES", None)
-            if 'modeltranslation' in settings.INSTALLED_APPS and self.name.endswith(
-                    tuple([code for code, language in languages])):
-                instance.__dict__['{}_{}'.format(self.html_field, self.name[-2:])] = EMarkdownWorker(
-                    value).get_text(dofollow, self.add_header_anchors)
-            else:
-                instance.__dict__[self.html_field] = EMarkdownWorker(value).get_text(dofollow, self.add_header_anchors)
+            return value, flags
+        return None
+
+    def set_rendered(self, instance, value, flags, result):
+        """
+        Populate html fields of object from render result
+
+        :param instance: model object
+        :param value: rendered markdown
+        :param flags: flags from get_render_flags
+        :param result: render result from render
+        """
+        instance.__dict__.update(self.get_rendered_values(result))
+        instance.__dict__.setdefault('_markdown_rendered', {})[self.attname] = (value, flags)
+        if self.index_links:
+            instance.__dict__.setdefault('_markdown_links', {})[self.name] = result['links']
+
+    def set_pending(self, instance, value, flags):
+        """
+        Populate html field of object with fallback html and schedule rendering in background after saving
+
+        :param instance: model object
+        :param value: saved markdown
+        :param flags: flags from get_render_flags
+        """
+        # Snapshot is dropped, so the next saving of this object does not write fallback html again,
+        # it checks the render cache or renders in background again
+        instance.__dict__.get('_markdown_snapshots', {}).pop(self.attname, None)
+        instance.__dict__[self.get_html_field_name()] = self.get_fallback_html(instance)
+        instance.__dict__.setdefault('_markdown_pending', {})[self.attname] = (value, flags)
+
+    def set_markdown(self, instance=None, update_fields=None, **kwargs):
+        """
+        Render markdown of this field only, render_markdown_fields renders all fields of object on saving
+        """
+        prepared = self.prepare_rendering(instance, update_fields)
+        if prepared is None:
+            return
+        value, flags = prepared
+        if self.background_rendering:
+            result = EMarkdownWorker(value).get_cached(*flags)
+            if result is None:
+                self.set_pending(instance, value, flags)
+                return
+        else:
+            result = self.render(instance, flags)
+        self.set_rendered(instance, value, flags, result)
+
+    def schedule_rendering(self, instance=None, raw=False, using=None, **kwargs):
+        pending = instance.__dict__.get('_markdown_pending', {}).pop(self.attname, None)
+        if pending is not None and not raw:
+            value, flags = pending
+            transaction.on_commit(partial(submit_background_rendering, self, instance.pk, value, flags, using),
+                                  using=using)
+
+    def save_links(self, instance=None, raw=False, **kwargs):
+        links = instance.__dict__.get('_markdown_links', {}).pop(self.name, None)
+        if links is not None and not raw:
+            from .models import EContentLink
+            EContentLink.objects.index(instance, self.name, links)
+
+    def delete_links(self, instance=None, **kwargs):
+        from .models import EContentLink
+        EContentLink.objects.for_object(instance, self.name).delete()
 
     def contribute_to_class(self, cls, name, **kwargs):
         super().contribute_to_class(cls, name, **kwargs)
-        pre_save.connect(self.set_markdown, sender=cls)
+        # Language of django-modeltranslation field is resolved once, not on every saving
+        self.language_suffix = self._get_language_suffix(name)
+        if cls not in _model_markdown_fields:
+            pre_save.connect(render_markdown_fields, sender=cls)
+        _model_markdown_fields.setdefault(cls, []).append(self)
+        post_init.connect(self.snapshot_markdown, sender=cls)
+        post_save.connect(self.update_snapshot, sender=cls)
+        if self.background_rendering:
+            post_save.connect(self.schedule_rendering, sender=cls)
+        if self.index_links:
+            post_save.connect(self.save_links, sender=cls)
+            post_delete.connect(self.delete_links, sender=cls)
 
     def __init__(self, html_field=None, *args, **kwargs):
         self.html_field = html_field
@@ -46,6 +454,14 @@ class EMarkdownField(models.TextField):
         self.extended_mode = kwargs.pop("extended_mode", True)
         self.fullscreen = kwargs.pop("fullscreen", True)
         self.add_header_anchors = kwargs.pop('add_header_anchors', False)
+        self.toc_field = kwargs.pop('toc_field', None)
+        self.excerpt_field = kwargs.pop('excerpt_field', None)
+        self.language_suffix = ''
+        self.compact_html = kwargs.pop('compact_html', getattr(settings, 'MARKDOWN_COMPACT_HTML', False))
+        self.index_links = kwargs.pop('index_links', getattr(settings, 'MARKDOWN_INDEX_LINKS', False))
+        self.background_rendering = kwargs.pop(
+            'background_rendering', getattr(settings, 'MARKDOWN_BACKGROUND_RENDERING', False)
+        )
         if not self.upload_link:
             self.upload_link = getattr(settings, 'MARKDOWN_UPLOAD_LINK', None)
         if not self.upload_file_link:
@@ -85,3 +501,27 @@ class EMarkdownFormField(forms.fields.CharField):
             fullscreen=fullscreen
         )})
         super().__init__(*args, **kwargs)
+
+
+def reset_markdown_snapshots(instance):
+    """
+    Forget loaded markdown of object, so all EMarkdownField fields will be rendered on the next saving
+
+    :param instance: model object
+    """
+    instance.__dict__.pop('_markdown_snapshots', None)
+
+
+def get_markdown_fields(models=None):
+    """
+    Get EMarkdownField fields of models
+
+    :param models: list of models, all installed models by default
+    :return: list of tuples (model, field)
+    """
+    fields = []
+    for model in models if models is not None else apps.get_models():
+        for field in model._meta.concrete_fields:
+            if isinstance(field, EMarkdownField):
+                fields.append((model, field))
+    return fields
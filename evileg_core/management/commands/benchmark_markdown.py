@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...benchmarks import CORPUS_DIR, EMarkdownBenchmark, compare_results, load_corpus
+
+
+class Command(BaseCommand):
+    help = 'Benchmark stages of markdown to html pipeline over a corpus of documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('stages', nargs='*', metavar='stage',
+                            help='Stages for benchmarking, all stages by default: {}'.format(
+                                ', '.join(EMarkdownBenchmark.STAGES)))
+        parser.add_argument('--corpus', default=CORPUS_DIR,
+                            help='Directory with .md files, the bundled corpus by default')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of timed runs of every stage, the best run is reported')
+        parser.add_argument('--dofollow', action='store_true', help='Render with dofollow flag')
+        parser.add_argument('--anchors', action='store_true', help='Render with header anchors')
+        parser.add_argument('--compact', action='store_true', help='Render compact html')
+        parser.add_argument('--output', default=None, help='Save results to JSON file')
+        parser.add_argument('--compare', default=None,
+                            help='JSON file with results of previous run, which are compared with current results')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='Slowdown in percents, which is reported as regression')
+
+    def handle(self, *args, **options):
+        corpus = load_corpus(options['corpus']) if os.path.isdir(options['corpus']) else None
+        if not corpus:
+            raise CommandError('There are no .md files in corpus directory: {!r}'.format(options['corpus']))
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be positive')
+        unknown = set(options['stages']) - set(EMarkdownBenchmark.STAGES)
+        if unknown:
+            raise CommandError('Unknown stages: {}'.format(', '.join(sorted(unknown))))
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+
+        benchmark = EMarkdownBenchmark(
+            corpus, repeat=options['repeat'], dofollow=options['dofollow'],
+            add_header_anchors=options['anchors'], compact=options['compact']
+        )
+        results = benchmark.run(options['stages'] or None)
+        meta = results['meta']
+        self.stdout.write('{documents} documents, {bytes} bytes, sanitizer {sanitizer}, repeat {repeat}'.format(**meta))
+        self.stdout.write('{:<12} {:>10} {:>10} {:>10} {:>12}'.format('stage', 'best ms', 'mean ms', 'docs/s', 'peak KiB'))
+        for name, result in results['stages'].items():
+            self.stdout.write('{:<12} {:>10.2f} {:>10.2f} {:>10.1f} {:>12.1f}'.format(
+                name, result['best'] * 1000, result['mean'] * 1000, result['docs_per_sec'], result['peak_kib']
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('Results are saved to {}'.format(options['output']))
+
+        if previous is not None:
+            self._compare(previous, results, options['threshold'] / 100)
+
+    def _compare(self, previous, current, threshold):
+        self.stdout.write('Comparison with run of {}:'.format(previous.get('meta', {}).get('date', 'unknown date')))
+        regressions = 0
+        for name, before, after, change, regression in compare_results(previous, current, threshold):
+            line = '{:<12} {:>10.2f} -> {:>10.2f} ms {:>+8.1f}%'.format(name, before * 1000, after * 1000, change * 100)
+            if regression:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line + ' regression'))
+            elif change < -threshold:
+                self.stdout.write(self.style.SUCCESS(line))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            self.stdout.write(self.style.WARNING('{} stages are slower by more than {:.0f}%'.format(
+                regressions, threshold * 100
+            )))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...fields import get_markdown_fields
+
+
+class Command(BaseCommand):
+    help = 'Rewrite html of EMarkdownField fields with compact_html=True from markdown without calling save()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Models for rewriting, all models by default')
+        parser.add_argument('--chunk-size', type=int, default=500, dest='chunk_size',
+                            help='Number of rows, which are fetched and updated at once')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(label) for label in options['models']] or None
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        write_empty = getattr(settings, 'MARKDOWN_WRITE_EMPTY_CONTENT', False)
+        chunk_size = options['chunk_size']
+        for model, field in get_markdown_fields(models):
+            if not field.compact_html:
+                continue
+
+            html_field_name = field.get_html_field_name()
+            only = ['pk', field.attname, html_field_name]
+            if 'dofollow' in {f.attname for f in model._meta.concrete_fields}:
+                only.append('dofollow')
+
+            updated = 0
+            batch = []
+            for instance in model._base_manager.only(*only).order_by('pk').iterator(chunk_size=chunk_size):
+                value = getattr(instance, field.attname)
+                if not value and not write_empty:
+                    continue
+                html = field.render(instance)['html']
+                if html != getattr(instance, html_field_name):
+                    setattr(instance, html_field_name, html)
+                    batch.append(instance)
+                if len(batch) >= chunk_size:
+                    model._base_manager.bulk_update(batch, [html_field_name])
+                    updated += len(batch)
+                    batch = []
+            if batch:
+                model._base_manager.bulk_update(batch, [html_field_name])
+                updated += len(batch)
+
+            self.stdout.write('{}.{}: {} rows rewritten'.format(model._meta.label, field.name, updated))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import os
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from ...fields import get_markdown_fields
+from ...utils import EImageUrlsGetter
+
+
+class Command(BaseCommand):
+    help = 'Find files in MEDIA_ROOT, which are referenced neither by content of EMarkdownField fields ' \
+           'nor by FileField fields, and optionally delete them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete orphaned files, they are only reported by default')
+        parser.add_argument('--older-than', type=float, default=1, dest='older_than', metavar='DAYS',
+                            help='Skip files modified less than DAYS days ago, they may be uploaded for unsaved content')
+        parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                            help='Skip files, which paths relative to MEDIA_ROOT match glob PATTERN, '
+                                 'for example "CACHE/*", it can be used several times')
+        parser.add_argument('--chunk-size', type=int, default=2000, dest='chunk_size',
+                            help='Number of rows, which are fetched from database at once')
+
+    def handle(self, *args, **options):
+        if not settings.MEDIA_ROOT or not os.path.isdir(settings.MEDIA_ROOT):
+            raise CommandError('MEDIA_ROOT is not a directory: {!r}'.format(settings.MEDIA_ROOT))
+
+        self.options = options
+        started = time.monotonic()
+        referenced = self._collect_referenced()
+        self.stdout.write('{} referenced paths collected in {:.1f}s'.format(
+            len(referenced), time.monotonic() - started
+        ))
+
+        count = 0
+        size = 0
+        for path, relative_path, stat in self._iter_orphaned(referenced):
+            count += 1
+            size += stat.st_size
+            if options['delete']:
+                os.remove(path)
+            if options['verbosity'] > 1 or not options['delete']:
+                self.stdout.write(relative_path)
+
+        self.stdout.write(self.style.SUCCESS('{} orphaned files, {:.1f} MB {}'.format(
+            count, size / 1024 / 1024, 'deleted' if options['delete'] else 'found'
+        )))
+
+    def _collect_referenced(self):
+        """
+        Stream content and file columns of all models and collect referenced paths relative to MEDIA_ROOT
+        """
+        columns = {}
+        for model, field in get_markdown_fields():
+            columns.setdefault(model, set()).update((field.attname, field.get_html_field_name()))
+        for model in apps.get_models():
+            for field in model._meta.concrete_fields:
+                if isinstance(field, models.FileField):
+                    columns.setdefault(model, set()).add(field.attname)
+
+        referenced = set()
+        for model, names in columns.items():
+            names = sorted(names)
+            file_fields = {field.attname for field in model._meta.concrete_fields
+                           if isinstance(field, models.FileField)}
+            rows = model._base_manager.order_by().values_list(*names).iterator(chunk_size=self.options['chunk_size'])
+            for row in rows:
+                for name, value in zip(names, row):
+                    if not value:
+                        continue
+                    if name in file_fields:
+                        referenced.add(value)
+                    else:
+                        referenced.update(EImageUrlsGetter.iter_media_paths(value))
+            if self.options['verbosity'] > 1:
+                self.stdout.write('{}: {}'.format(model._meta.label, ', '.join(names)))
+        return referenced
+
+    def _iter_orphaned(self, referenced):
+        """
+        Walk MEDIA_ROOT without following of symbolic links and yield files, which are not referenced
+
+        :return: generator of (path, relative path, stat) tuples
+        """
+        deadline = time.time() - self.options['older_than'] * 24 * 60 * 60
+        excludes = self.options['exclude']
+        stack = [(settings.MEDIA_ROOT, '')]
+        while stack:
+            directory, prefix = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relative_path = prefix + entry.name
+                    if excludes and any(fnmatch.fnmatch(relative_path, pattern) for pattern in excludes):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, relative_path + '/'))
+                    elif entry.is_file(follow_symlinks=False) and relative_path not in referenced:
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_mtime < deadline:
+                            yield entry.path, relative_path, stat
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import ESearchDocument
+from ...search import get_searchable_models
+
+
+class Command(BaseCommand):
+    help = ('Rebuild full-text search index of lookup_fields of models with EPostManager. '
+            'Run it before enabling EVILEG_CORE_SEARCH_BACKEND and after QuerySet.update() or bulk_create() '
+            'of these models, because they do not write the index')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Models for indexing, all models with EPostManager by default')
+        parser.add_argument('--chunk-size', type=int, default=1000, dest='chunk_size',
+                            help='Number of objects, which are fetched from database and written to index at once')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(label) for label in options['models']] or get_searchable_models()
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        for model in models:
+            if not getattr(model, 'lookup_fields', None):
+                raise CommandError('{} has no lookup_fields'.format(model._meta.label))
+            started = time.monotonic()
+            count = self._index_model(model, options['chunk_size'])
+            self.stdout.write('{}: {} objects in {:.1f}s'.format(model._meta.label, count, time.monotonic() - started))
+
+    def _index_model(self, model, chunk_size):
+        content_type = ContentType.objects.get_for_model(model)
+        fields = [field for field in model.lookup_fields if '__' not in field]
+        count = 0
+        with transaction.atomic(using=ESearchDocument.objects.db):
+            ESearchDocument.objects.filter(content_type=content_type).delete()
+            chunk = []
+            for obj in model._base_manager.order_by().only('pk', *fields).iterator(chunk_size=chunk_size):
+                chunk.append(ESearchDocument(
+                    content_type=content_type, object_id=obj.pk, text=ESearchDocument.objects.get_text(obj)
+                ))
+                if len(chunk) >= chunk_size:
+                    ESearchDocument.objects.bulk_create(chunk)
+                    count += len(chunk)
+                    chunk = []
+            ESearchDocument.objects.bulk_create(chunk)
+            count += len(chunk)
+        return count
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from ...activities import get_activity_models
+from ...models import EAbstractActivity, EActivityCounter
+
+
+class Command(BaseCommand):
+    help = 'Write actual numbers of activities to activity counters, it can be run periodically'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Activity models, all models of EAbstractActivity by default')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(label) for label in options['models']] or get_activity_models()
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        for model in models:
+            if not issubclass(model, EAbstractActivity):
+                raise CommandError('{} is not activity model'.format(model._meta.label))
+            started = time.monotonic()
+            created, updated, deleted = EActivityCounter.objects.reconcile(model)
+            self.stdout.write('{}: {} created, {} updated, {} deleted in {:.1f}s'.format(
+                model._meta.label, created, updated, deleted, time.monotonic() - started
+            ))
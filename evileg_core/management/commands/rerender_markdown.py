@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import difflib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from ...fields import get_markdown_fields
+from ...search import update_index
+from ...signals import markdown_render_context
+from ...utils import EMarkdownWorker
+
+
+def _init_worker():
+    django.setup()
+
+
+def _render_rows(rows, label, add_header_anchors, compact_html):
+    """
+    Render chunk of rows in worker process. The render cache is not used, because all texts are unique.
+
+    :param rows: list of (pk, markdown, dofollow) tuples
+    :param label: label of field for markdown_render_context
+    :return: list of (pk, render result) tuples
+    """
+    rendered = []
+    for pk, value, dofollow in rows:
+        with markdown_render_context(label, pk):
+            rendered.append(
+                (pk, EMarkdownWorker(value).render(dofollow, add_header_anchors, compact_html, use_cache=False))
+            )
+    return rendered
+
+
+class Command(BaseCommand):
+    help = 'Regenerate html of EMarkdownField fields from markdown in parallel processes without calling save()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.ModelName',
+                            help='Models for rendering, all models with EMarkdownField by default')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes, 1 renders in the current process')
+        parser.add_argument('--chunk-size', type=int, default=500, dest='chunk_size',
+                            help='Number of rows, which are fetched from database and sent to worker at once')
+        parser.add_argument('--batch-size', type=int, default=500, dest='batch_size',
+                            help='Number of rows, which are updated in one transaction')
+        parser.add_argument('--checkpoint', default=None,
+                            help='JSON file with last rendered primary keys, rendering is resumed from it')
+        parser.add_argument('--links', action='store_true',
+                            help='Rewrite EContentLink index of all rows, not only of changed rows')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='Do not write anything, show diff of changed html instead')
+        parser.add_argument('--diff-limit', type=int, default=10, dest='diff_limit',
+                            help='Maximal number of diffs in dry run mode')
+
+    def handle(self, *args, **options):
+        try:
+            models = [apps.get_model(label) for label in options['models']] or None
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        self.options = options
+        self.diffs = 0
+        self.checkpoint = self._load_checkpoint()
+        workers = options['workers']
+        self.max_pending = workers * 2
+        executor = None
+        if workers > 1:
+            # Forked workers must not inherit open database connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+        started = time.monotonic()
+        total = 0
+        try:
+            for model, field in get_markdown_fields(models):
+                total += self._render_field(model, field, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS('{} rows in {:.1f}s, {:.1f} rows/s'.format(
+            total, elapsed, total / elapsed if elapsed else 0
+        )))
+
+    def _load_checkpoint(self):
+        path = self.options['checkpoint']
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_checkpoint(self, key, pk):
+        path = self.options['checkpoint']
+        if not path or self.options['dry_run']:
+            return
+        self.checkpoint[key] = pk
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.checkpoint, f, default=str)
+        os.replace(path + '.tmp', path)
+
+    def _render_field(self, model, field, executor):
+        key = '{}.{}'.format(model._meta.label, field.name)
+        stored_names = field.get_rendered_field_names()
+        values = ['pk', field.attname] + stored_names
+        has_dofollow = 'dofollow' in {f.attname for f in model._meta.concrete_fields}
+        if has_dofollow:
+            values.append('dofollow')
+
+        qs = model._base_manager.order_by('pk')
+        last_pk = self.checkpoint.get(key)
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+            self.stdout.write('{}: resuming after pk={}'.format(key, last_pk))
+
+        write_empty = getattr(settings, 'MARKDOWN_WRITE_EMPTY_CONTENT', False)
+        pending = deque()
+        chunk = []
+        stats = {'rows': 0, 'changed': 0, 'skipped': 0, 'started': time.monotonic()}
+
+        def submit(rows):
+            old_values = {row[0]: dict(zip(stored_names, row[2:2 + len(stored_names)])) for row in rows}
+            # Rendered markdown and dofollow are conditions of updating, rows saved meanwhile are not overwritten
+            for row in rows:
+                old_values[row[0]][field.attname] = row[1]
+                if has_dofollow:
+                    old_values[row[0]]['dofollow'] = row[-1]
+            tasks = [(row[0], row[1], row[-1] if has_dofollow else False) for row in rows
+                     if row[1] or write_empty]
+            if executor is not None:
+                future = executor.submit(_render_rows, tasks, key, field.add_header_anchors, field.compact_html)
+            else:
+                future = Future()
+                future.set_result(_render_rows(tasks, key, field.add_header_anchors, field.compact_html))
+            pending.append((rows[-1][0], old_values, future))
+            while len(pending) >= self.max_pending:
+                self._write(model, field, key, stats, *pending.popleft())
+
+        for row in qs.values_list(*values).iterator(chunk_size=self.options['chunk_size']):
+            chunk.append(row)
+            if len(chunk) >= self.options['chunk_size']:
+                submit(chunk)
+                chunk = []
+        if chunk:
+            submit(chunk)
+        while pending:
+            self._write(model, field, key, stats, *pending.popleft())
+
+        self.stdout.write('{}: {} rows, {} changed, {} skipped as saved meanwhile, {:.1f} rows/s'.format(
+            key, stats['rows'], stats['changed'], stats['skipped'], self._throughput(stats)
+        ))
+        return stats['rows']
+
+    def _write(self, model, field, key, stats, last_pk, old_values, future):
+        rendered = future.result()
+        changed = []
+        for pk, result in rendered:
+            values = field.get_rendered_values(result)
+            if any(value != (old_values[pk][name] or '') for name, value in values.items()):
+                changed.append((pk, result, values))
+
+        if self.options['dry_run']:
+            html_field_name = field.get_html_field_name()
+            for pk, result, values in changed:
+                if self.diffs < self.options['diff_limit']:
+                    self.diffs += 1
+                    self.stdout.writelines(difflib.unified_diff(
+                        (old_values[pk][html_field_name] or '').splitlines(True), result['html'].splitlines(True),
+                        '{} pk={} (stored)'.format(key, pk), '{} pk={} (rendered)'.format(key, pk)
+                    ))
+                    self.stdout.write('')
+        elif changed or (field.index_links and self.options['links']):
+            written = set()
+            batch_size = self.options['batch_size']
+            for start in range(0, len(changed), batch_size):
+                with transaction.atomic(using=model._base_manager.db):
+                    for pk, result, values in changed[start:start + batch_size]:
+                        if self._update_row(model, field, pk, old_values[pk], values):
+                            written.add(pk)
+            # Links and search index of rows saved meanwhile are updated by their saving
+            skipped = {pk for pk, result, values in changed if pk not in written}
+            stats['skipped'] += len(skipped)
+            changed = [item for item in changed if item[0] in written]
+            with transaction.atomic(using=model._base_manager.db):
+                if field.index_links:
+                    from ...models import EContentLink
+                    indexed = rendered if self.options['links'] else [(pk, result) for pk, result, values in changed]
+                    for pk, result in indexed:
+                        if pk not in skipped:
+                            EContentLink.objects.index(model(pk=pk), field.name, result['links'])
+                update_index(model, [pk for pk, result, values in changed], model._base_manager.db)
+
+        stats['rows'] += len(old_values)
+        stats['changed'] += len(changed)
+        self._save_checkpoint(key, last_pk)
+        if self.options['verbosity'] > 1:
+            self.stdout.write('{}: {} rows, {:.1f} rows/s'.format(key, stats['rows'], self._throughput(stats)))
+
+    @staticmethod
+    def _update_row(model, field, pk, old_values, values):
+        """
+        Write rendered values, if markdown and dofollow of the row were not changed since reading,
+        like background rendering of EMarkdownField does
+
+        :return: True, if the row was updated
+        """
+        lookups = {'pk': pk, field.attname: old_values[field.attname]}
+        if 'dofollow' in old_values:
+            lookups['dofollow'] = old_values['dofollow']
+        return bool(model._base_manager.filter(**lookups).update(**values))
+
+    @staticmethod
+    def _throughput(stats):
+        elapsed = time.monotonic() - stats['started']
+        return stats['rows'] / elapsed if elapsed else 0
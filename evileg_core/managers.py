@@ -1,20 +1,62 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+from urllib.parse import urlsplit
 
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q
+from django.db.models.query import ModelIterable
+
+from .search import get_search_backend
+
+
+def apply_list_projection(qs, select_related=None, defer=None):
+    """
+    Apply list projection of model to QuerySet, that is relations, which are selected,
+    and fields, which are deferred in lists of objects, see list_select_related and list_defer of EAbstractPost.
+    If loaded fields were already chosen by only() or defer(), they are kept,
+    and only relations, which are loaded, are selected.
+
+    :param qs: QuerySet
+    :param select_related: list of relations, list_select_related of model by default
+    :param defer: list of deferred fields, list_defer of model by default
+    :return: QuerySet
+    """
+    if qs._fields is not None:
+        return qs
+    if select_related is None:
+        select_related = getattr(qs.model, 'list_select_related', ())
+    if defer is None:
+        defer = getattr(qs.model, 'list_defer', ())
+    field_names, deferred = qs.query.deferred_loading
+    if field_names:
+        # Deferred relation can not be selected, and defer() after only() would drop fields chosen by caller
+        if deferred:
+            select_related = [name for name in select_related if name.split('__')[0] not in field_names]
+        else:
+            loaded = {name.split('__')[0] for name in field_names}
+            select_related = [name for name in select_related if name.split('__')[0] in loaded]
+        defer = ()
+    if select_related:
+        qs = qs.select_related(*select_related)
+    if defer:
+        qs = qs.defer(*defer)
+    return qs
 
 
 class EPostManager(models.Manager):
     """
     EPostManager is a manager for search in ESNF-C models. It is set to EAbstractPost.
-    It searches content by lookup fields, related lookup fields, user, and pub_date range
+    It searches content by lookup fields, related lookup fields, user, and pub_date range.
+    Query is searched by search backend from evileg_core.search module
     """
     use_for_related_fields = True
 
     def search(self, query=None, in_related=False, user=None, approved=True, date_from=None, date_to=None,
                select_related=None, prefetch_related=None,  only=None, order_by=None, distinct=False, annotation=None,
-               **kwargs):
+               list_projection=True, **kwargs):
         """
         Method for search content
 
@@ -26,21 +68,14 @@ class EPostManager(models.Manager):
         :param date_to: "To date" for pub_date range searching
         :param select_related: list of select related query sets
         :param prefetch_related: list of prefetch related query sets
-        :param order_by: list of fields for ordering
+        :param order_by: list of fields for ordering, by default results of full-text search are ordered by relevance
+        :param list_projection: apply list_select_related and list_defer of model
         :return: QuerySet of model objects
         """
         qs = self.approved() if approved else self.get_queryset()
         if query is not None:
-            or_lookup = Q()
-            if self.model.lookup_fields:
-                for field in self.model.lookup_fields:
-                    or_lookup |= Q(**{"{}__icontains".format(field): query})
-
-            if in_related and self.model.related_lookup_fields:
-                for related_field in self.model.related_lookup_fields:
-                    or_lookup |= Q(**{"{}__icontains".format(related_field): query})
-
-            qs = qs.filter(or_lookup)
+            qs = get_search_backend(qs.db).search(qs, query, self.model.lookup_fields or (),
+                                                  self.model.related_lookup_fields if in_related else ())
 
         if user is not None:
             qs = qs.filter(user=user)
@@ -60,8 +95,13 @@ class EPostManager(models.Manager):
         if only:
             qs = qs.only(*only)
 
+        if list_projection:
+            qs = apply_list_projection(qs)
+
         if order_by:
             qs = qs.order_by(*order_by)
+        elif 'search_rank' in qs.query.annotations:
+            qs = qs.order_by('-search_rank', *(qs.query.order_by or self.model._meta.ordering or ['-pk']))
 
         if distinct:
             qs = qs.distinct()
@@ -78,6 +118,40 @@ class EPostManager(models.Manager):
         return self.get_queryset()
 
 
+class EActivityQuerySet(models.QuerySet):
+    """
+    QuerySet of activity models with loading of content objects of activities
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prefetch_targets = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._prefetch_targets = self._prefetch_targets
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if not fetched and self._prefetch_targets is not None and self._iterable_class is ModelIterable:
+            from .activities import prefetch_targets
+            prefetch_targets(self._result_cache, self._prefetch_targets)
+
+    def prefetch_targets(self, select_related=None):
+        """
+        Load content objects of fetched activities with one query per model of content,
+        see evileg_core.activities.prefetch_targets
+
+        :param select_related: dict of lists of relations by content models or their labels
+        :return: QuerySet
+        """
+        clone = self._chain()
+        clone._prefetch_targets = select_related or {}
+        return clone
+
+
 class EActivityManager(models.Manager):
     """
     EActivityManager is a manager for search in ESNF-C activity models. It is set to EAbstractActivity.
@@ -85,6 +159,12 @@ class EActivityManager(models.Manager):
     """
     use_for_related_fields = True
 
+    def get_queryset(self):
+        return EActivityQuerySet(self.model, using=self._db)
+
+    def prefetch_targets(self, select_related=None):
+        return self.get_queryset().prefetch_targets(select_related)
+
     def search(self, model=None, query=None, in_related=False, date_from=None, date_to=None, approved_dict=None,
                prefetch_related=None, only=None, **kwargs):
         model_name = model.__name__.lower()
@@ -127,3 +207,324 @@ class EActivityManager(models.Manager):
             qs = qs.only(*only)
 
         return qs.order_by('user__username')
+
+    def get_count(self, obj):
+        """
+        Number of activities of object from EActivityCounter
+
+        :param obj: content object
+        :return: number of activities
+        """
+        from .models import EActivityCounter
+        return EActivityCounter.objects.get_count(self.model, obj)
+
+    def get_counts(self, objects):
+        """
+        Numbers of activities of page of objects from EActivityCounter with one query per model of objects
+
+        :param objects: list of content objects
+        :return: dict of numbers of activities by objects
+        """
+        from .models import EActivityCounter
+        return EActivityCounter.objects.get_counts(self.model, objects)
+
+    def attach_counts(self, objects, attname=None):
+        """
+        Set numbers of activities to objects for templates, for example, post.likes_count for Like model
+
+        :param objects: list of content objects
+        :param attname: name of attribute, '<activity model name>s_count' by default
+        :return: list of objects
+        """
+        objects = list(objects)
+        attname = attname or '{}s_count'.format(self.model._meta.model_name)
+        for obj, count in self.get_counts(objects).items():
+            setattr(obj, attname, count)
+        return objects
+
+
+class EActivityCounterManager(models.Manager):
+    """
+    EActivityCounterManager is a manager of activity counters. It is set to EActivityCounter.
+    Counters are created from number of existing activities, when they are changed or read first time,
+    so counters are valid for activities, which were created before counters.
+    """
+
+    def _get_lookup(self, activity_model, content_type_id, object_id):
+        return {
+            'activity_type': ContentType.objects.db_manager(self.db).get_for_model(activity_model),
+            'content_type_id': content_type_id,
+            'object_id': object_id,
+        }
+
+    def _count_activities(self, activity_model, content_type_id, object_ids):
+        return dict(
+            activity_model._base_manager.using(self.db).filter(
+                content_type_id=content_type_id, object_id__in=object_ids
+            ).order_by().values('object_id').annotate(count=Count('pk')).values_list('object_id', 'count')
+        )
+
+    def change(self, activity_model, content_type_id, object_id, delta):
+        """
+        Atomically change counter of object after creating or deleting of activity
+
+        :param activity_model: model of activity
+        :param content_type_id: ID of ContentType of object
+        :param object_id: ID of object
+        :param delta: 1 after creating, -1 after deleting
+        """
+        lookup = self._get_lookup(activity_model, content_type_id, object_id)
+        qs = self.filter(**lookup)
+        if qs.filter(count__gte=-delta).update(count=F('count') + delta) or qs.exists():
+            return
+        count = self._count_activities(activity_model, content_type_id, [object_id]).get(object_id, 0)
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(count=count, **lookup)
+        except IntegrityError:
+            # Counter was created concurrently, it may already count this activity, reconciliation fixes it
+            qs.filter(count__gte=-delta).update(count=F('count') + delta)
+
+    def get_count(self, activity_model, obj):
+        """
+        :param activity_model: model of activity
+        :param obj: content object
+        :return: number of activities of object
+        """
+        return self.get_counts(activity_model, [obj])[obj]
+
+    def get_counts(self, activity_model, objects):
+        """
+        Numbers of activities of objects, missing counters are created from numbers of activities.
+        Activities are counted without counters, if EVILEG_CORE_ACTIVITY_COUNTERS setting is False
+
+        :param activity_model: model of activity
+        :param objects: list of content objects
+        :return: dict of numbers of activities by objects
+        """
+        objects_by_type = {}
+        for obj in objects:
+            content_type = ContentType.objects.db_manager(self.db).get_for_model(obj)
+            objects_by_type.setdefault(content_type.pk, {})[obj.pk] = obj
+
+        counts = {}
+        for content_type_id, objects_by_pk in objects_by_type.items():
+            found = self.get_counts_by_ids(activity_model, content_type_id, list(objects_by_pk))
+            counts.update((obj, found[pk]) for pk, obj in objects_by_pk.items())
+        return counts
+
+    def get_counts_by_ids(self, activity_model, content_type_id, object_ids):
+        """
+        Numbers of activities of objects of one model by IDs
+
+        :param activity_model: model of activity
+        :param content_type_id: ID of ContentType of objects
+        :param object_ids: list of IDs of objects
+        :return: dict of numbers of activities by IDs
+        """
+        if not getattr(settings, 'EVILEG_CORE_ACTIVITY_COUNTERS', True):
+            activities = self._count_activities(activity_model, content_type_id, object_ids)
+            return {pk: activities.get(pk, 0) for pk in object_ids}
+
+        activity_type = ContentType.objects.db_manager(self.db).get_for_model(activity_model)
+        found = dict(self.filter(
+            activity_type=activity_type, content_type_id=content_type_id, object_id__in=object_ids
+        ).values_list('object_id', 'count'))
+        missing = [pk for pk in object_ids if pk not in found]
+        if missing:
+            activities = self._count_activities(activity_model, content_type_id, missing)
+            self.bulk_create([
+                self.model(activity_type=activity_type, content_type_id=content_type_id, object_id=pk,
+                           count=activities.get(pk, 0))
+                for pk in missing
+            ], ignore_conflicts=True)
+            found.update((pk, activities.get(pk, 0)) for pk in missing)
+        return found
+
+    def reconcile(self, activity_model):
+        """
+        Write actual numbers of activities to counters of activity model, counters without activities are deleted
+
+        :param activity_model: model of activity
+        :return: (created, updated, deleted) numbers of counters
+        """
+        activity_type = ContentType.objects.db_manager(self.db).get_for_model(activity_model)
+        actual = {
+            (content_type_id, object_id): count
+            for content_type_id, object_id, count in activity_model._base_manager.using(self.db).order_by().values(
+                'content_type_id', 'object_id'
+            ).annotate(count=Count('pk')).values_list('content_type_id', 'object_id', 'count').iterator()
+        }
+        updated = deleted = 0
+        with transaction.atomic(using=self.db):
+            stale = []
+            for pk, content_type_id, object_id, count in self.filter(activity_type=activity_type).values_list(
+                    'pk', 'content_type_id', 'object_id', 'count').iterator():
+                actual_count = actual.pop((content_type_id, object_id), 0)
+                if not actual_count:
+                    stale.append(pk)
+                elif actual_count != count:
+                    self.filter(pk=pk).update(count=actual_count)
+                    updated += 1
+            for index in range(0, len(stale), 500):
+                deleted += self.filter(pk__in=stale[index:index + 500]).delete()[0]
+            self.bulk_create([
+                self.model(activity_type=activity_type, content_type_id=content_type_id, object_id=object_id,
+                           count=count)
+                for (content_type_id, object_id), count in actual.items()
+            ], batch_size=500)
+        return len(actual), updated, deleted
+
+
+class EContentLinkManager(models.Manager):
+    """
+    EContentLinkManager is a manager of links index. It is set to EContentLink.
+    It writes links of rendered content and searches objects by urls without parsing of html
+    """
+
+    @staticmethod
+    def make_url_hash(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_internal_url(url, site_url=None):
+        """
+        Url is internal, if it is relative or starts with SITE_URL. Protocol-relative urls like //host/path
+        are external.
+
+        :param url: url
+        :param site_url: SITE_URL, internal urls are only relative, if it is not set
+        :return: bool
+        """
+        if url.startswith('//'):
+            return False
+        if url.startswith('/'):
+            return True
+        if not site_url:
+            return False
+        site_url = site_url.rstrip('/')
+        return url == site_url or url.startswith(site_url + '/') or url[len(site_url):len(site_url) + 1] in ('?', '#')
+
+    def index(self, instance, field_name, links):
+        """
+        Replace indexed links of field of model object
+
+        :param instance: model object
+        :param field_name: name of EMarkdownField
+        :param links: list of (kind, url) tuples
+        """
+        content_type = ContentType.objects.get_for_model(instance)
+        site_url = getattr(settings, "SITE_URL", None)
+        objs = []
+        for kind, url in sorted(set(links)):
+            objs.append(self.model(
+                content_type=content_type,
+                object_id=instance.pk,
+                field_name=field_name,
+                kind=kind,
+                url=url,
+                url_hash=self.make_url_hash(url),
+                host=(urlsplit(url).hostname or '')[:255],
+                internal=self.is_internal_url(url, site_url)
+            ))
+
+        with transaction.atomic(using=self.db):
+            self.for_object(instance, field_name).delete()
+            self.bulk_create(objs)
+
+    def for_object(self, instance, field_name=None):
+        """
+        Links of model object
+
+        :param instance: model object
+        :param field_name: name of EMarkdownField, all fields by default
+        :return: QuerySet of links
+        """
+        qs = self.get_queryset().filter(content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk)
+        if field_name is not None:
+            qs = qs.filter(field_name=field_name)
+        return qs
+
+    def for_url(self, url, kind=None):
+        """
+        Links to url, for example for searching of pages, which link to dead url
+
+        :param url: exact url
+        :param kind: kind of link, all kinds by default
+        :return: QuerySet of links
+        """
+        qs = self.get_queryset().filter(url_hash=self.make_url_hash(url))
+        if kind is not None:
+            qs = qs.filter(kind=kind)
+        return qs
+
+    def for_host(self, host):
+        """
+        Links to host, for example for changing of nofollow policy for domain
+
+        :param host: host name
+        :return: QuerySet of links
+        """
+        return self.get_queryset().filter(host=host.lower())
+
+    def for_media(self, path):
+        """
+        References to media file from images and links
+
+        :param path: url of media file, for example '/media/uploads/image.png'
+        :return: QuerySet of links
+        """
+        return self.for_url(path).filter(internal=True)
+
+
+class ESearchDocumentManager(models.Manager):
+    """
+    ESearchDocumentManager is a manager of full-text search index. It is set to ESearchDocument.
+    It writes plain text of lookup_fields of objects, which is searched by full-text search backend
+    """
+
+    @staticmethod
+    def get_text(instance):
+        """
+        Plain text of lookup fields of model object, html is stripped.
+        Lookup fields with related lookups like 'user__username' are not indexed.
+
+        :param instance: model object
+        :return: text
+        """
+        from .utils import get_plain_text
+        values = []
+        for field_name in instance.lookup_fields:
+            if '__' not in field_name:
+                value = getattr(instance, field_name)
+                if value:
+                    values.append(get_plain_text(str(value)))
+        return '\n'.join(values)
+
+    def index(self, instance):
+        """
+        Write text of model object to index
+
+        :param instance: model object
+        """
+        self.update_or_create(
+            content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk,
+            defaults={'text': self.get_text(instance)}
+        )
+
+    def remove(self, instance):
+        """
+        Remove model object from index
+
+        :param instance: model object
+        """
+        self.for_model(type(instance)).filter(object_id=instance.pk).delete()
+
+    def for_model(self, model):
+        """
+        Documents of model
+
+        :param model: model class
+        :return: QuerySet of documents
+        """
+        return self.get_queryset().filter(content_type=ContentType.objects.get_for_model(model))
@@ -0,0 +1,38 @@
+# Generated by Django 3.0.14 on 2026-10-18 09:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EContentLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('field_name', models.CharField(max_length=100, verbose_name='Field name')),
+                ('kind', models.CharField(choices=[('link', 'Link'), ('image', 'Image'), ('embed', 'Embedded frame')], max_length=5, verbose_name='Kind')),
+                ('url', models.TextField(verbose_name='URL')),
+                ('url_hash', models.CharField(db_index=True, max_length=64, verbose_name='URL hash')),
+                ('host', models.CharField(blank=True, db_index=True, max_length=255, verbose_name='Host')),
+                ('internal', models.BooleanField(default=False, verbose_name='Internal')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Content link',
+                'verbose_name_plural': 'Content links',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='econtentlink',
+            index=models.Index(fields=['content_type', 'object_id', 'field_name'], name='evileg_core_content_9a45d2_idx'),
+        ),
+    ]
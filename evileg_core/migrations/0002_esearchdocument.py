@@ -0,0 +1,89 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+SQLITE_FTS = (
+    "CREATE VIRTUAL TABLE evileg_core_esearchdocument_fts USING fts5("
+    "text, content='evileg_core_esearchdocument', content_rowid='id')",
+    "CREATE TRIGGER evileg_core_esearchdocument_ai AFTER INSERT ON evileg_core_esearchdocument BEGIN "
+    "INSERT INTO evileg_core_esearchdocument_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER evileg_core_esearchdocument_ad AFTER DELETE ON evileg_core_esearchdocument BEGIN "
+    "INSERT INTO evileg_core_esearchdocument_fts(evileg_core_esearchdocument_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER evileg_core_esearchdocument_au AFTER UPDATE ON evileg_core_esearchdocument BEGIN "
+    "INSERT INTO evileg_core_esearchdocument_fts(evileg_core_esearchdocument_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO evileg_core_esearchdocument_fts(rowid, text) VALUES (new.id, new.text); END",
+)
+
+SQLITE_FTS_DROP = (
+    "DROP TRIGGER IF EXISTS evileg_core_esearchdocument_ai",
+    "DROP TRIGGER IF EXISTS evileg_core_esearchdocument_ad",
+    "DROP TRIGGER IF EXISTS evileg_core_esearchdocument_au",
+    "DROP TABLE IF EXISTS evileg_core_esearchdocument_fts",
+)
+
+POSTGRESQL_INDEX = (
+    "CREATE INDEX evileg_core_esearchdocument_text_gin ON evileg_core_esearchdocument "
+    "USING GIN (to_tsvector('simple', text))",
+)
+
+POSTGRESQL_INDEX_DROP = (
+    "DROP INDEX IF EXISTS evileg_core_esearchdocument_text_gin",
+)
+
+
+def _has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.evileg_core_fts5_check USING fts5(text)")
+        except Exception:
+            return False
+        cursor.execute("DROP TABLE temp.evileg_core_fts5_check")
+        return True
+
+
+def create_full_text_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite' and _has_fts5(connection):
+        statements = SQLITE_FTS
+    elif connection.vendor == 'postgresql':
+        statements = POSTGRESQL_INDEX
+    else:
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_full_text_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for statement in SQLITE_FTS_DROP if vendor == 'sqlite' else POSTGRESQL_INDEX_DROP if vendor == 'postgresql' else ():
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('evileg_core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ESearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('text', models.TextField(blank=True, verbose_name='Text')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Search document',
+                'verbose_name_plural': 'Search documents',
+                'unique_together': {('content_type', 'object_id')},
+            },
+        ),
+        migrations.RunPython(create_full_text_index, drop_full_text_index),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.14 on 2026-10-18 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('evileg_core', '0002_esearchdocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EActivityCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('activity_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Activity counter',
+                'verbose_name_plural': 'Activity counters',
+                'unique_together': {('activity_type', 'content_type', 'object_id')},
+            },
+        ),
+    ]
@@ -7,6 +7,7 @@ from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
+from django.db.models import QuerySet
 from django.db.models.fields import BLANK_CHOICE_DASH
 from django.http import HttpResponseRedirect
 from django.http.response import HttpResponseBase
@@ -19,6 +20,8 @@ from django.utils.translation import ugettext_lazy as _
 from django.views.generic.edit import FormMixin
 
 from .forms import EActionForm
+from .paginator import ECursorPaginator, EUnsupportedOrdering
+from .utils import get_excerpt
 
 
 class EInterfaceMixin:
@@ -62,6 +65,18 @@ class EInterfaceMixin:
     def get_meta_description(self):
         raise NotImplementedError("Please return meta description about content or None")
 
+    def get_excerpt(self):
+        """
+        Plain text excerpt of content for previews and meta description: content_excerpt field,
+        which is populated by EMarkdownField with excerpt_field, or excerpt of html content,
+        if the object has no excerpt yet
+
+        :return: plain text, it must be escaped in templates
+        """
+        return getattr(self, 'content_excerpt', None) or get_excerpt(
+            getattr(self, 'content', ''), getattr(settings, 'MARKDOWN_EXCERPT_LENGTH', 500)
+        )
+
     def was_edited(self):
         raise NotImplementedError("Please return information if object was edited")
 
@@ -114,7 +129,16 @@ class EPaginateMixin:
     """
     Mixin for adding page pagination functionality into Class Based View.
     Mixin support get and post requests
+
+    :param cursor_pagination: paginate QuerySet with ECursorPaginator by cursor tokens instead of page numbers,
+        which does not count objects and does not skip previous pages with OFFSET.
+        EVILEG_CORE_CURSOR_PAGINATION setting is read on every request, if it is None, False by default.
+        QuerySets ordered by relations or expressions are paginated by page numbers
+    :param pagination_ordering: ordering of cursor pagination, ordering of QuerySet by default
     """
+    cursor_pagination = None
+    pagination_ordering = None
+
     def get_paginated_page(self, objects, number=10):
         """
         Method get queryset for creating paginated page by page number form request
@@ -123,8 +147,23 @@ class EPaginateMixin:
         :param number: number of objects on the page
         :return: page with objects
         """
-        return Paginator(objects, number).get_page(
-            self.request.GET.get('page') if self.request.method == 'GET' else self.request.POST.get('page'))
+        page = self.request.GET.get('page') if self.request.method == 'GET' else self.request.POST.get('page')
+        if self.get_cursor_pagination() and isinstance(objects, QuerySet):
+            try:
+                paginator = ECursorPaginator(
+                    objects, number, ordering=self.pagination_ordering, url=self.get_pagination_url()
+                )
+            except EUnsupportedOrdering:
+                # Ordering by relations or expressions can be paginated only by page numbers
+                pass
+            else:
+                return paginator.get_page(page)
+        return Paginator(objects, number).get_page(page)
+
+    def get_cursor_pagination(self):
+        if self.cursor_pagination is None:
+            return getattr(settings, 'EVILEG_CORE_CURSOR_PAGINATION', False)
+        return self.cursor_pagination
 
     def get_pagination_url(self):
         """
@@ -11,11 +11,12 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.html import strip_tags
 from django.utils.translation import ugettext_lazy as _
 
 from .fields import EMarkdownField
-from .managers import EPostManager, EActivityManager
+from .managers import (
+    EPostManager, EActivityManager, EActivityCounterManager, EContentLinkManager, ESearchDocumentManager
+)
 from .mixins import EInterfaceMixin
 
 
@@ -31,6 +32,8 @@ class EAbstractPost(models.Model):
     :param lastmod: last modification date, django.db.models.DateTimeField
     :param lookup_fields: fields for search via EPostManager
     :param related_lookup_fields: fields for search in related models via EPostManager
+    :param list_select_related: relations, which are selected in lists of objects
+    :param list_defer: fields, which are not loaded in lists of objects, because preview templates do not use them
     """
 
     edit_url_name = None
@@ -43,6 +46,8 @@ class EAbstractPost(models.Model):
 
     lookup_fields = ('content',)
     related_lookup_fields = ()
+    list_select_related = ('user',)
+    list_defer = ('content_markdown',)
 
     objects = EPostManager()
 
@@ -140,13 +145,23 @@ class EModerationMixin(models.Model):
 class EAbstractPostWithInterface(EAbstractPost, EInterfaceMixin):
     """
     This class is the EAbstractPost with template interface
+
+    :param content_excerpt: plain text excerpt of content for previews and meta description,
+                            it is populated by content_markdown field
     """
 
+    content_markdown = EMarkdownField(verbose_name=_('Content - Markdown'), html_field='content', default='',
+                                      excerpt_field='content_excerpt')
+    content_excerpt = models.TextField(verbose_name=_('Content - Excerpt'), blank=True, default='')
+
+    # Previews show content_excerpt, html content is loaded only by full representation
+    list_defer = EAbstractPost.list_defer + ('content',)
+
     def get_preview(self, *args, **kwargs):
         return self.content
 
     def get_meta_description(self):
-        return strip_tags(self.content)[0:200]
+        return self.get_excerpt()[0:200]
 
     class Meta:
         abstract = True
@@ -196,13 +211,23 @@ class EAbstractArticle(EAbstractPost):
 class EAbstractArticleWithInterface(EAbstractArticle, EInterfaceMixin):
     """
     This class is the EAbstractArticle with template interface
+
+    :param content_excerpt: plain text excerpt of content for previews and meta description,
+                            it is populated by content_markdown field
     """
 
+    content_markdown = EMarkdownField(verbose_name=_('Content - Markdown'), html_field='content', default='',
+                                      excerpt_field='content_excerpt')
+    content_excerpt = models.TextField(verbose_name=_('Content - Excerpt'), blank=True, default='')
+
+    # Previews show content_excerpt, html content is loaded only by full representation
+    list_defer = EAbstractPost.list_defer + ('content',)
+
     def get_preview(self, *args, **kwargs):
         return self.content
 
     def get_meta_description(self):
-        return "{}. {}".format(self.title, strip_tags(self.content)[0:200])
+        return "{}. {}".format(self.title, self.get_excerpt()[0:200])
 
     class Meta:
         abstract = True
@@ -231,11 +256,18 @@ class EAbstractSection(EAbstractArticle):
 
 class EAbstractSectionWithInterface(EAbstractSection, EInterfaceMixin):
 
+    content_markdown = EMarkdownField(verbose_name=_('Content - Markdown'), html_field='content', default='',
+                                      excerpt_field='content_excerpt')
+    content_excerpt = models.TextField(verbose_name=_('Content - Excerpt'), blank=True, default='')
+
+    # Previews show content_excerpt, html content is loaded only by full representation
+    list_defer = EAbstractPost.list_defer + ('content',)
+
     def get_preview(self, *args, **kwargs):
         return self.content
 
     def get_meta_description(self):
-        return "{}. {}".format(self.title, strip_tags(self.content)[0:200])
+        return "{}. {}".format(self.title, self.get_excerpt()[0:200])
 
     class Meta:
         abstract = True
@@ -271,7 +303,7 @@ class EAbstractActivity(models.Model):
 
     def __str__(self):
         if hasattr(self.content_type.model_class(), '_base_manager'):
-            return self.content_object.__str__()[:150]
+            return self.get_self().__str__()[:150]
         return ''
 
     def get_self(self):
@@ -279,8 +311,10 @@ class EAbstractActivity(models.Model):
         This method return object, which has view representation for rendering in template.
         Activity object has Foreign key to Post object, and will return Post object instead of self.
 
-        :return: object
+        :return: object or None, if object was deleted
         """
+        if getattr(self, '_missing_target', None) == (self.content_type_id, self.object_id):
+            return None
         return self.content_object
 
     def invalidate_cache(self):
@@ -288,3 +322,102 @@ class EAbstractActivity(models.Model):
 
     class Meta:
         abstract = True
+
+
+class EActivityCounter(models.Model):
+    """
+    Number of activities of one activity model, like likes or bookmarks, of content object.
+    Counters are changed atomically after creating and deleting of activities,
+    and can be reconciled with reconcile_activity_counters management command.
+
+    :param activity_type: ContentType of activity model
+    :param content_type: ContentType of object
+    :param object_id: ID of object
+    :param content_object: object
+    :param count: number of activities
+    """
+    activity_type = models.ForeignKey(ContentType, related_name='+', on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+    count = models.PositiveIntegerField(_('Count'), default=0)
+
+    objects = EActivityCounterManager()
+
+    def __str__(self):
+        return str(self.count)
+
+    class Meta:
+        verbose_name = _('Activity counter')
+        verbose_name_plural = _('Activity counters')
+        unique_together = (('activity_type', 'content_type', 'object_id'),)
+
+
+class EContentLink(models.Model):
+    """
+    Index of urls in rendered content of EMarkdownField with index_links=True.
+    Links are written when markdown is rendered, so pages which link to url or reference media file
+    can be found without parsing of html.
+
+    :param content_type: ContentType of object with content
+    :param object_id: ID of object with content
+    :param content_object: object with content
+    :param field_name: name of EMarkdownField
+    :param kind: link, image or embedded frame
+    :param url: url after clean up of content
+    :param url_hash: sha256 of url for indexed search by exact url
+    :param host: host of url, empty for relative urls
+    :param internal: True if url is relative or starts with SITE_URL
+    """
+    KIND_CHOICES = (
+        ('link', _('Link')),
+        ('image', _('Image')),
+        ('embed', _('Embedded frame')),
+    )
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+    field_name = models.CharField(_('Field name'), max_length=100)
+    kind = models.CharField(_('Kind'), max_length=5, choices=KIND_CHOICES)
+    url = models.TextField(_('URL'))
+    url_hash = models.CharField(_('URL hash'), max_length=64, db_index=True)
+    host = models.CharField(_('Host'), max_length=255, blank=True, db_index=True)
+    internal = models.BooleanField(_('Internal'), default=False)
+
+    objects = EContentLinkManager()
+
+    def __str__(self):
+        return self.url[:150]
+
+    class Meta:
+        verbose_name = _('Content link')
+        verbose_name_plural = _('Content links')
+        indexes = [models.Index(fields=['content_type', 'object_id', 'field_name'])]
+
+
+class ESearchDocument(models.Model):
+    """
+    Full-text search index of objects with EPostManager. Text of lookup_fields of objects is written
+    after saving of them, when full-text search backend is used, see evileg_core.search module.
+    The index can be rebuilt with rebuild_search_index management command.
+
+    :param content_type: ContentType of indexed object
+    :param object_id: ID of indexed object
+    :param content_object: indexed object
+    :param text: plain text of lookup fields of object
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+    text = models.TextField(_('Text'), blank=True)
+
+    objects = ESearchDocumentManager()
+
+    def __str__(self):
+        return self.text[:150]
+
+    class Meta:
+        verbose_name = _('Search document')
+        verbose_name_plural = _('Search documents')
+        unique_together = (('content_type', 'object_id'),)
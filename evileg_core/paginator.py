@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keyset (cursor) pagination.
+
+Django Paginator counts all objects and skips previous pages with OFFSET, so deep pages of large tables
+are slow. ECursorPaginator filters objects after the last object of the current page by values of ordering fields,
+so every page is fetched with one indexed query without counting. Pages are addressed with opaque cursor tokens
+instead of numbers, and only previous and next pages are available.
+
+NULLs of ordering fields are placed after all values, the primary key is added to ordering
+for unique position of every object. Ordering by relations and expressions is not supported.
+"""
+
+import base64
+import binascii
+import datetime
+import json
+from collections.abc import Sequence
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from django.utils.http import urlencode
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class EInvalidCursor(ValueError):
+    pass
+
+
+class EUnsupportedOrdering(ValueError):
+    pass
+
+
+class ECursorEncoder(DjangoJSONEncoder):
+    """
+    DjangoJSONEncoder truncates microseconds, but keyset values must be exact
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class ECursorPage(Sequence):
+    """
+    Page of ECursorPaginator. It has interface of Django Page without page numbers
+    """
+    is_cursor_page = True
+
+    def __init__(self, object_list, paginator, cursor=None, has_next=False, has_previous=False):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.cursor = cursor
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Page {}>'.format(self.cursor or 'first')
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if not self._has_next or not self.object_list:
+            return None
+        return self.paginator.encode_cursor(self.object_list[-1], NEXT)
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous or not self.object_list:
+            return None
+        return self.paginator.encode_cursor(self.object_list[0], PREVIOUS)
+
+    def get_next_url(self, url=''):
+        """
+        :param url: query string of current request, '?page=...' is replaced with cursor of the next page
+        :return: query string of the next page or None
+        """
+        return self.paginator.get_page_url(url, self.next_cursor)
+
+    def get_previous_url(self, url=''):
+        return self.paginator.get_page_url(url, self.previous_cursor)
+
+    @property
+    def next_url(self):
+        return self.get_next_url(self.paginator.url)
+
+    @property
+    def previous_url(self):
+        return self.get_previous_url(self.paginator.url)
+
+
+class ECursorPaginator:
+    """
+    Paginator of QuerySet by values of ordering fields of the last object of the page.
+    Ordering is taken from ordering argument, QuerySet or Meta.ordering of model, '-pk' by default.
+
+    :param object_list: QuerySet
+    :param per_page: number of objects on the page
+    :param ordering: list of field names or annotations with optional '-' prefix
+    :param url: query string of current request for building of url of previous and next pages
+    :param parameter_name: name of GET parameter with cursor
+    """
+
+    def __init__(self, object_list, per_page, ordering=None, url='', parameter_name='page'):
+        self.per_page = int(per_page)
+        self.url = url
+        self.parameter_name = parameter_name
+        self.object_list = object_list
+        ordering = list(ordering or object_list.query.order_by or object_list.model._meta.ordering or ['-pk'])
+        for field in ordering:
+            if not isinstance(field, str) or field == '?' or '__' in field:
+                raise EUnsupportedOrdering('Cursor pagination supports ordering only by fields and annotations')
+        pk_names = {'pk', object_list.model._meta.pk.name, object_list.model._meta.pk.attname}
+        if not pk_names & {field.lstrip('-') for field in ordering}:
+            ordering.append('-pk' if ordering[0].startswith('-') else 'pk')
+        self.ordering = [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+        self.nullable = [self._get_output_field(name).null for name, descending in self.ordering]
+        self.object_list = object_list.order_by(*[
+            # NULLs are placed after all values in both directions, whatever the database does by default
+            (F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_last=True)) if nullable else
+            ('-' + name if descending else name)
+            for (name, descending), nullable in zip(self.ordering, self.nullable)
+        ])
+
+    def _get_output_field(self, name):
+        annotation = self.object_list.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        opts = self.object_list.model._meta
+        if name == 'pk':
+            return opts.pk
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            raise EUnsupportedOrdering('Unknown ordering field {}'.format(name))
+        if field.is_relation and (not field.many_to_one or name == field.name):
+            # Ordering by relation uses ordering of related model, only its ID can be used like user_id
+            raise EUnsupportedOrdering('Cursor pagination does not support ordering by relation {}'.format(name))
+        return field
+
+    def encode_cursor(self, obj, direction):
+        """
+        :param obj: first object of the page for the previous page or last object for the next page
+        :param direction: NEXT or PREVIOUS
+        :return: opaque cursor token
+        """
+        values = [getattr(obj, name) for name, descending in self.ordering]
+        data = json.dumps([direction] + values, cls=ECursorEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """
+        :param cursor: cursor token
+        :return: (direction, values) tuple
+        :raise EInvalidCursor: if cursor is damaged
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+            direction, values = data[0], data[1:]
+            if direction not in (NEXT, PREVIOUS) or len(values) != len(self.ordering):
+                raise EInvalidCursor(cursor)
+            values = [
+                self._get_output_field(name).to_python(value)
+                for (name, descending), value in zip(self.ordering, values)
+            ]
+        except (binascii.Error, UnicodeDecodeError, TypeError, ValueError, LookupError, ValidationError) as e:
+            raise EInvalidCursor(cursor) from e
+        if any(value is None and not nullable for value, nullable in zip(values, self.nullable)):
+            raise EInvalidCursor(cursor)
+        return direction, values
+
+    def get_keyset_lookup(self, values, direction):
+        """
+        Lookup of objects after values of ordering fields in direction of pagination:
+        (a > x) OR (a = x AND b > y) OR ... NULLs are placed after all values,
+        so they follow any value in the next direction and precede NULL in the previous direction.
+
+        :return: Q
+        """
+        lookup = Q()
+        forward = direction == NEXT
+        for index, (name, descending) in enumerate(self.ordering):
+            value = values[index]
+            if value is None:
+                if forward:
+                    # Nothing follows NULL, objects with NULL are ordered by the next fields
+                    continue
+                condition = Q(**{'{}__isnull'.format(name): False})
+            else:
+                condition = Q(**{'{}__{}'.format(name, 'lt' if descending == forward else 'gt'): value})
+                if forward and self.nullable[index]:
+                    condition |= Q(**{'{}__isnull'.format(name): True})
+            for previous_index, (previous_name, previous_descending) in enumerate(self.ordering[:index]):
+                previous_value = values[previous_index]
+                if previous_value is None:
+                    condition &= Q(**{'{}__isnull'.format(previous_name): True})
+                else:
+                    condition &= Q(**{previous_name: previous_value})
+            lookup |= condition
+        return lookup
+
+    def page(self, cursor=None):
+        """
+        :param cursor: cursor token, the first page is returned for empty cursor
+                       and for cursor, after which there are no objects
+        :return: ECursorPage
+        :raise EInvalidCursor: if cursor is damaged
+        """
+        if not cursor:
+            objects = list(self.object_list[:self.per_page + 1])
+            return ECursorPage(objects[:self.per_page], self, cursor, has_next=len(objects) > self.per_page)
+
+        direction, values = self.decode_cursor(cursor)
+        qs = self.object_list.filter(self.get_keyset_lookup(values, direction))
+        if direction == PREVIOUS:
+            qs = qs.reverse()
+        objects = list(qs[:self.per_page + 1])
+        if not objects:
+            # Cursor is stale, objects after it were deleted, there is no page to link from
+            return self.page()
+        has_more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if direction == PREVIOUS:
+            objects.reverse()
+            return ECursorPage(objects, self, cursor, has_next=True, has_previous=has_more)
+        return ECursorPage(objects, self, cursor, has_next=has_more, has_previous=True)
+
+    def get_page(self, cursor=None):
+        """
+        Page by cursor, the first page is returned for damaged cursor like Paginator.get_page
+
+        :param cursor: cursor token
+        :return: ECursorPage
+        """
+        try:
+            return self.page(cursor)
+        except EInvalidCursor:
+            return self.page()
+
+    def get_page_url(self, url, cursor):
+        """
+        :param url: query string of current request
+        :param cursor: cursor token
+        :return: query string with cursor in parameter_name or None, if cursor is None
+        """
+        if cursor is None:
+            return None
+        params = [
+            item for item in url.lstrip('?').split('&')
+            if item and item.split('=', 1)[0] != self.parameter_name
+        ]
+        params.append(urlencode({self.parameter_name: cursor}))
+        return '?' + '&'.join(params)
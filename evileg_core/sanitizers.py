@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from lxml import etree
+
+from .signals import ERenderStageTimer
+from .utils import ESoup, ETreeRewriter
+
+
+class EStreamTag:
+    """
+    Lightweight tag of EStreamSoup.
+    It supports the part of BeautifulSoup Tag API, which is used by clean up rules of ESoup:
+    name, attrs, get(), has_attr(), access to attributes by key, text in rules registered with on_leave=True
+    and insert() of new tags at the beginning of the tag.
+    Values of multi-valued attributes like class are lists, as in BeautifulSoup.
+    """
+    __slots__ = [
+        'name', 'attrs', 'parse_name', 'inserted', '_text', '_extracted', '_leave_rules', '_string_kind',
+        '_pending', '_has_contents', '_buffer', '_start_layout', '_inner_state'
+    ]
+
+    # The same multi-valued attributes as BeautifulSoup uses for HTML
+    multi_valued_attrs = {
+        '*': {'class', 'accesskey', 'dropzone'},
+        'a': {'rel', 'rev'},
+        'link': {'rel', 'rev'},
+        'td': {'headers'},
+        'th': {'headers'},
+        'form': {'accept-charset'},
+        'object': {'archive'},
+        'area': {'rel'},
+        'icon': {'sizes'},
+        'iframe': {'sandbox'},
+        'output': {'for'},
+    }
+    nonwhitespace_re = re.compile(r'\S+')
+
+    def __init__(self, name, attrs=None):
+        self.name = name
+        self.parse_name = name
+        self.attrs = {}
+        self.inserted = []
+        self._text = None
+        self._extracted = False
+        self._leave_rules = None
+        self._string_kind = None
+        self._pending = False
+        self._has_contents = False
+        self._buffer = None
+        self._start_layout = None
+        self._inner_state = None
+        if attrs:
+            multi_valued = self.multi_valued_attrs['*'] | self.multi_valued_attrs.get(name, set())
+            for key, value in attrs.items():
+                self.attrs[key] = self.nonwhitespace_re.findall(value) if key in multi_valued else value
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def has_attr(self, key):
+        return key in self.attrs
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __setitem__(self, key, value):
+        if value is None:
+            value = ''
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        self.attrs[key] = value
+
+    def __delitem__(self, key):
+        del self.attrs[key]
+
+    def __contains__(self, key):
+        return key in self.attrs
+
+    @property
+    def text(self):
+        """
+        Text of the tag, it is complete only in rules registered with on_leave=True
+        """
+        return ''.join(self._text or ())
+
+    def insert(self, position, tag):
+        if position != 0 or not isinstance(tag, EStreamTag):
+            raise NotImplementedError('Only new tags can be inserted at the beginning of streaming tag')
+        self.inserted.insert(0, tag)
+
+
+class EStreamRewriter:
+    """
+    Engine for rewriting of html in one pass over the event stream of lxml parser, without building of a tree.
+    It applies rules of ETreeRewriter to EStreamTag tags and serializes body of the document
+    in the same way as BeautifulSoup serializes it with decode_contents() or prettify().
+    Only tags with rules registered with on_leave=True are buffered until their end, for example headers,
+    so the memory usage does not depend on the size of the document, except of the output.
+    """
+    START = 'start'
+    END = 'end'
+    EMPTY = 'empty'
+    STRING = 'string'
+
+    ascii_spaces = '\x20\x0a\x09\x0c\x0d'
+    void_tags = frozenset((
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+        'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'
+    ))
+    preserve_whitespace_tags = frozenset(('pre', 'textarea'))
+    string_container_tags = frozenset(('rt', 'rp', 'style', 'script', 'template'))
+    cdata_containing_tags = frozenset(('script', 'style'))
+    preformatted_strings = {'comment': ('<!--', '-->'), 'pi': ('<?', '>'), 'doctype': ('<!DOCTYPE ', '>\n')}
+
+    def __init__(self, rewriter, pretty=True):
+        self.extracting = rewriter.extracting
+        self.rules = rewriter.rules
+        self.common_rules = rewriter.rules.get(ETreeRewriter.ALL_TAGS, ())
+        self.leave_rules = rewriter.leave_rules
+        self.pretty = pretty
+        self.stack = []
+        self.current_data = []
+        self.preserving = 0
+        self.containers = []
+        self.collecting = []
+        self.body = None
+        self.in_body = False
+        self.buffers = [[]]
+        self.level = 0
+        self.literal = None
+
+    def new_tag(self, name):
+        return EStreamTag(name)
+
+    # Target interface of lxml parser
+
+    def start(self, name, attrs, nsmap=None):
+        self._end_data()
+        parent = self.stack[-1] if self.stack else None
+        tag = EStreamTag(name, attrs)
+        self.stack.append(tag)
+        if name in self.preserve_whitespace_tags:
+            self.preserving += 1
+        if name in self.string_container_tags:
+            self.containers.append(name)
+
+        if (parent is not None and parent._extracted) or name in self.extracting:
+            tag._extracted = True
+            return
+
+        leave_rules = self.leave_rules.get(name)
+        for rule in self.common_rules:
+            rule(tag)
+        for rule in self.rules.get(name, ()):
+            rule(tag)
+        if leave_rules:
+            tag._leave_rules = leave_rules
+            tag._text = []
+            tag._string_kind = name if name in self.string_container_tags else None
+            self.collecting.append(tag)
+
+        if self.body is None and name == 'body':
+            self.body = tag
+            self.in_body = True
+            if self.pretty:
+                self._open(tag)
+        elif self.in_body:
+            self._add_contents(parent)
+            self._open(tag)
+
+    def end(self, name):
+        self._end_data()
+        if any(tag.parse_name == name for tag in self.stack):
+            while True:
+                tag = self._pop()
+                if tag.parse_name == name:
+                    break
+
+    def data(self, data):
+        self.current_data.append(data)
+
+    def comment(self, text):
+        self._end_data()
+        self.current_data.append(text)
+        self._end_data('comment')
+
+    def pi(self, target, data):
+        self._end_data()
+        self.current_data.append(target + ' ' + data)
+        self._end_data('pi')
+
+    def doctype(self, name, pubid, system):
+        self._end_data()
+        value = name or ''
+        if pubid is not None:
+            value += ' PUBLIC "{}"'.format(pubid)
+            if system is not None:
+                value += ' "{}"'.format(system)
+        elif system is not None:
+            value += ' SYSTEM "{}"'.format(system)
+        self.current_data.append(value)
+        self._end_data('doctype')
+
+    def close(self):
+        self._end_data()
+        while self.stack:
+            self._pop()
+        if self.body is None:
+            return ''
+        html = ''.join(self.buffers[0])
+        if self.pretty:
+            html = re.sub('<body>|</body>', '', html)
+        return html
+
+    # Parsing
+
+    def _end_data(self, kind=None):
+        if not self.current_data:
+            return
+        text = ''.join(self.current_data)
+        self.current_data = []
+        if not self.preserving and not text.strip(self.ascii_spaces):
+            text = '\n' if '\n' in text else ' '
+
+        parent = self.stack[-1] if self.stack else None
+        if parent is None or parent._extracted:
+            return
+        if kind is None:
+            kind = self.containers[-1] if self.containers else None
+            for tag in self.collecting:
+                if tag._string_kind == kind:
+                    tag._text.append(text)
+        if not self.in_body:
+            return
+
+        self._add_contents(parent)
+        if kind in self.preformatted_strings:
+            prefix, suffix = self.preformatted_strings[kind]
+            text = prefix + text + suffix
+        elif parent.name not in self.cdata_containing_tags:
+            text = self._escape(text)
+        self._write(self.STRING, None, text)
+
+    def _pop(self):
+        tag = self.stack.pop()
+        if tag.parse_name in self.preserve_whitespace_tags:
+            self.preserving -= 1
+        if tag.parse_name in self.string_container_tags:
+            self.containers.pop()
+        if tag._extracted:
+            return tag
+
+        if tag._leave_rules:
+            self.collecting.remove(tag)
+            for rule in tag._leave_rules:
+                rule(tag)
+
+        if tag is self.body:
+            if self.pretty:
+                self._close(tag)
+            self.in_body = False
+        elif self.in_body:
+            self._close(tag)
+        return tag
+
+    # Serialization
+
+    def _open(self, tag):
+        if tag._leave_rules:
+            # Start tag is written on closing, because leave rules can change the tag
+            tag._start_layout = self._layout(self.START, tag)
+            tag._inner_state = (self.level, self.literal)
+            tag._buffer = []
+            self.buffers.append(tag._buffer)
+        elif tag.parse_name in self.void_tags:
+            # Void tag is written as empty element, if it has no contents
+            tag._pending = True
+        else:
+            self._write(self.START, tag, self._format_tag(tag))
+
+    def _add_contents(self, tag):
+        if tag is None:
+            return
+        tag._has_contents = True
+        if tag._pending:
+            tag._pending = False
+            self._write(self.START, tag, self._format_tag(tag))
+
+    def _close(self, tag):
+        if tag._pending:
+            self._write(self.EMPTY, tag, self._format_tag(tag, empty=True))
+            return
+        if tag._buffer is None:
+            self._write(self.END, tag, self._format_tag(tag, opening=False))
+            return
+
+        self.buffers.pop()
+        prefix, suffix = tag._start_layout or ('', '')
+        if tag.parse_name in self.void_tags and not tag._has_contents and not tag.inserted:
+            self.buffers[-1].append(prefix + self._format_tag(tag, empty=True) + suffix)
+            if self.pretty:
+                self.level -= 1
+            return
+
+        self.buffers[-1].append(prefix + self._format_tag(tag) + suffix)
+        state = self.level, self.literal
+        self.level, self.literal = tag._inner_state
+        for child in tag.inserted:
+            if child.parse_name in self.void_tags:
+                self._write(self.EMPTY, child, self._format_tag(child, empty=True))
+            else:
+                self._write(self.START, child, self._format_tag(child))
+                self._write(self.END, child, self._format_tag(child, opening=False))
+        self.level, self.literal = state
+        self.buffers[-1].extend(tag._buffer)
+        self._write(self.END, tag, self._format_tag(tag, opening=False))
+
+    def _layout(self, event, tag):
+        """
+        Whitespace before and after of the element in prettify mode, the same as BeautifulSoup adds.
+        Contents of pre and textarea are written as is.
+
+        :return: tuple of prefix and suffix
+        """
+        if not self.pretty:
+            return None
+        if event is self.END:
+            self.level -= 1
+
+        if self.literal is not None:
+            before = after = False
+        else:
+            before = after = True
+        if event is self.START and self.literal is None and tag.name in self.preserve_whitespace_tags:
+            after = False
+            self.literal = tag
+        elif event is self.END and tag is self.literal:
+            before = False
+            after = True
+            self.literal = None
+
+        if event is self.START:
+            self.level += 1
+            prefix = ' ' * (self.level - 1) if before else ''
+        else:
+            prefix = ' ' * self.level if before else ''
+        return prefix, '\n' if after else ''
+
+    def _write(self, event, tag, piece):
+        layout = self._layout(event, tag)
+        if layout is not None:
+            prefix, suffix = layout
+            if prefix or suffix:
+                if event is self.STRING:
+                    piece = piece.strip()
+                if piece:
+                    piece = prefix + piece + suffix
+        self.buffers[-1].append(piece)
+
+    @staticmethod
+    def _escape(value):
+        return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    def _format_tag(self, tag, opening=True, empty=False):
+        if not opening:
+            return '</{}>'.format(tag.name)
+
+        attrs = []
+        for key, value in sorted(tag.attrs.items(), key=lambda item: item[0]):
+            if value is None:
+                attrs.append(key)
+                continue
+            if isinstance(value, (list, tuple)):
+                value = ' '.join(value)
+            elif not isinstance(value, str):
+                value = str(value)
+            value = self._escape(value)
+            quote = '"'
+            if '"' in value:
+                if "'" in value:
+                    value = value.replace('"', '&quot;')
+                else:
+                    quote = "'"
+            attrs.append('{}={}{}{}'.format(key, quote, value, quote))
+        return '<{}{}{}>'.format(tag.name, ' ' + ' '.join(attrs) if attrs else '', '/' if empty else '')
+
+
+class EStreamSoup(ESoup):
+    """
+    Streaming variant of ESoup, which does not build BeautifulSoup tree.
+    The document is parsed by lxml parser with EStreamRewriter as target,
+    the same clean up rules are applied and the same html is produced.
+    Own rules added in get_rewriter() must use only EStreamTag API.
+
+    Use it via MARKDOWN_SANITIZER_ENGINE = 'evileg_core.sanitizers.EStreamSoup'
+    """
+    __slots__ = ['text']
+
+    def __init__(self, text, tags_for_extracting=(), dofollow=False, add_header_anchors=False, compact=False):
+        super().__init__('', tags_for_extracting, dofollow, add_header_anchors, compact)
+        self.text = text
+
+    def clean(self):
+        if not self.text:
+            return ''
+        # The same preparation as BeautifulSoup does for lxml
+        text = self.text[1:] if self.text[0] == '\N{BYTE ORDER MARK}' else self.text
+        # Rules create new tags via self.soup
+        with ERenderStageTimer(type(self), 'sanitize', len(text)) as timer:
+            self.soup = EStreamRewriter(self.get_rewriter(), pretty=not self.compact)
+            parser = etree.HTMLParser(target=self.soup, recover=True)
+            parser.feed(text)
+            html = parser.close()
+            timer.output_size = len(html)
+        return html
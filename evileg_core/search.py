@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Search backends of EPostManager.search.
+
+ELikeSearchBackend searches with icontains lookups without index, it is used by default.
+Full-text backends search in ESearchDocument index, which is written after saving of objects with EPostManager,
+and rank the most relevant results. They are enabled by EVILEG_CORE_SEARCH_BACKEND setting,
+'auto' selects full-text backend by vendor of database::
+
+    EVILEG_CORE_SEARCH_BACKEND = 'auto'
+    EVILEG_CORE_SEARCH_BACKEND = 'evileg_core.search.ESQLiteSearchBackend'
+
+The index of existing objects must be built by rebuild_search_index management command before enabling,
+otherwise existing objects are not found. The index is written by saving and deleting of objects,
+background rendering of EMarkdownField and rerender_markdown management command.
+QuerySet.update() and bulk_create() do not write it, run rebuild_search_index after them.
+"""
+
+import re
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import F, FloatField, Func, OuterRef, Q, Subquery, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+SEARCH_DOCUMENT_TABLE = 'evileg_core_esearchdocument'
+SQLITE_FTS_TABLE = 'evileg_core_esearchdocument_fts'
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+class ELikeSearchBackend:
+    """
+    Search by icontains lookups of lookup_fields and related_lookup_fields without index and ranking
+    """
+    uses_index = False
+
+    def get_like_lookup(self, fields, query):
+        lookup = Q()
+        for field in fields:
+            lookup |= Q(**{"{}__icontains".format(field): query})
+        return lookup
+
+    def search(self, qs, query, fields, related_fields=()):
+        """
+        Filter QuerySet by search query
+
+        :param qs: QuerySet of model with EPostManager
+        :param query: search request
+        :param fields: lookup fields of model
+        :param related_fields: related lookup fields of model for search in related content
+        :return: QuerySet
+        """
+        lookup = self.get_like_lookup(tuple(fields) + tuple(related_fields), query)
+        return qs.filter(lookup) if lookup else qs
+
+
+class EFullTextSearchBackend(ELikeSearchBackend):
+    """
+    Base class of full-text search backends. Objects, which match all words of query, are found in ESearchDocument
+    and annotated with search_rank, which is greater for more relevant objects and 0 for objects found by other lookups.
+    Lookup fields with related lookups and related lookup fields are searched with icontains lookups.
+    Matching and ranking are subqueries of QuerySet, so they run together with the query of the page of results.
+    """
+    uses_index = True
+
+    def get_words(self, query):
+        return _word_re.findall(query)
+
+    def is_available(self, connection):
+        return True
+
+    def get_match_sql(self, content_type_id, words):
+        """
+        :return: (sql, params) of query, which selects object_id of matching documents
+        """
+        raise NotImplementedError('Return SQL of matching documents')
+
+    def get_rank_expression(self, words):
+        """
+        :return: expression of relevance of ESearchDocument, which is greater for more relevant documents,
+                 and 0 or NULL for documents, which do not match
+        """
+        raise NotImplementedError('Return expression of relevance of document')
+
+    def search(self, qs, query, fields, related_fields=()):
+        words = self.get_words(query)
+        connection = connections[qs.db]
+        if not words or not self.is_available(connection):
+            return super().search(qs, query, fields, related_fields)
+
+        content_type_id = ContentType.objects.db_manager(qs.db).get_for_model(qs.model).pk
+        lookup = Q(pk__in=RawSQL(*self.get_match_sql(content_type_id, words)))
+        lookup |= self.get_like_lookup([field for field in fields if '__' in field] + list(related_fields), query)
+        from .models import ESearchDocument
+        rank = ESearchDocument.objects.filter(content_type_id=content_type_id, object_id=OuterRef('pk')).annotate(
+            search_rank=self.get_rank_expression(words)
+        ).values('search_rank')[:1]
+        return qs.filter(lookup).annotate(
+            search_rank=Coalesce(Subquery(rank, output_field=FloatField()), Value(0.0), output_field=FloatField())
+        )
+
+
+class ESQLiteSearchBackend(EFullTextSearchBackend):
+    """
+    Full-text search via SQLite FTS5 table, which is synchronized with ESearchDocument by triggers.
+    Words of query are searched as prefixes, relevance is bm25.
+    If SQLite is built without FTS5, the table is not created and ELikeSearchBackend is used.
+    """
+
+    def __init__(self):
+        self._available = {}
+
+    def is_available(self, connection):
+        if connection.alias not in self._available:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SQLITE_FTS_TABLE])
+                self._available[connection.alias] = cursor.fetchone() is not None
+        return self._available[connection.alias]
+
+    def get_fts_query(self, words):
+        return ' '.join('"{}"*'.format(word) for word in words)
+
+    def get_match_sql(self, content_type_id, words):
+        return (
+            'SELECT d.object_id FROM {fts} JOIN {table} d ON d.id = {fts}.rowid '
+            'WHERE {fts} MATCH %s AND d.content_type_id = %s'.format(fts=SQLITE_FTS_TABLE, table=SEARCH_DOCUMENT_TABLE),
+            [self.get_fts_query(words), content_type_id]
+        )
+
+    def get_rank_expression(self, words):
+        # bm25 is negative, it is smaller for more relevant documents. Id is an expression,
+        # because table of ESearchDocument has an alias in subquery
+        return Func(
+            F('id'), Value(self.get_fts_query(words)),
+            template='(SELECT -bm25({fts}) FROM {fts} WHERE {fts}.rowid = %(expressions)s)'.format(
+                fts=SQLITE_FTS_TABLE),
+            arg_joiner=' AND {} MATCH '.format(SQLITE_FTS_TABLE), output_field=FloatField()
+        )
+
+
+class EPostgreSQLSearchBackend(EFullTextSearchBackend):
+    """
+    Full-text search via GIN index of to_tsvector('simple', text) of ESearchDocument.
+    Words of query are searched as prefixes, relevance is ts_rank.
+    The 'simple' configuration is used, because content can be written in any language,
+    the index must be changed together with config for using of another configuration.
+    """
+    config = 'simple'
+
+    def get_tsquery(self, words):
+        return ' & '.join('{}:*'.format(word) for word in words)
+
+    def get_match_sql(self, content_type_id, words):
+        return (
+            "SELECT object_id FROM {table} WHERE content_type_id = %s "
+            "AND to_tsvector('{config}', text) @@ to_tsquery('{config}', %s)".format(
+                table=SEARCH_DOCUMENT_TABLE, config=self.config),
+            [content_type_id, self.get_tsquery(words)]
+        )
+
+    def get_rank_expression(self, words):
+        return Func(
+            Func(Value(self.config), F('text'), function='to_tsvector'),
+            Func(Value(self.config), Value(self.get_tsquery(words)), function='to_tsquery'),
+            function='ts_rank', output_field=FloatField()
+        )
+
+
+VENDOR_SEARCH_BACKENDS = {
+    'sqlite': ESQLiteSearchBackend,
+    'postgresql': EPostgreSQLSearchBackend,
+}
+
+_search_backends = {}
+
+
+@receiver(setting_changed)
+def _reset_search_backends(setting, **kwargs):
+    if setting == 'EVILEG_CORE_SEARCH_BACKEND':
+        _search_backends.clear()
+
+
+def get_search_backend(using='default'):
+    """
+    Get search backend from EVILEG_CORE_SEARCH_BACKEND setting, ELikeSearchBackend by default.
+    'auto' selects full-text backend by vendor of database.
+
+    :param using: database alias
+    :return: search backend
+    """
+    if using not in _search_backends:
+        path = getattr(settings, 'EVILEG_CORE_SEARCH_BACKEND', None)
+        if path == 'auto':
+            backend_class = VENDOR_SEARCH_BACKENDS.get(connections[using].vendor, ELikeSearchBackend)
+        elif path:
+            backend_class = import_string(path)
+        else:
+            backend_class = ELikeSearchBackend
+        _search_backends[using] = backend_class()
+    return _search_backends[using]
+
+
+def get_searchable_models():
+    """
+    Models with EPostManager, which are indexed by full-text search backends
+
+    :return: list of models
+    """
+    from .managers import EPostManager
+    return [
+        model for model in apps.get_models()
+        if getattr(model, 'lookup_fields', None) and isinstance(model._default_manager, EPostManager)
+    ]
+
+
+def index_object(sender, instance=None, raw=False, update_fields=None, using=None, **kwargs):
+    if raw or (update_fields is not None and not set(update_fields) & set(sender.lookup_fields)):
+        return
+    from .models import ESearchDocument
+    ESearchDocument.objects.db_manager(using).index(instance)
+
+
+def remove_object(sender, instance=None, using=None, **kwargs):
+    from .models import ESearchDocument
+    ESearchDocument.objects.db_manager(using).remove(instance)
+
+
+def update_index(model, pks, using=None):
+    """
+    Write index of objects, which were changed without saving, for example by QuerySet.update().
+    Nothing is written, if full-text search backend is not used or model is not searchable.
+
+    :param model: model class
+    :param pks: list of primary keys of objects
+    :param using: database alias
+    """
+    if not pks or not get_search_backend().uses_index or model not in get_searchable_models():
+        return
+    from .models import ESearchDocument
+    manager = ESearchDocument.objects.db_manager(using)
+    fields = [field for field in model.lookup_fields if '__' not in field]
+    for obj in model._base_manager.using(using).filter(pk__in=pks).only('pk', *fields):
+        manager.index(obj)
+
+
+def connect_search_index():
+    """
+    Connect writing of ESearchDocument index to saving and deleting of searchable models,
+    if full-text search backend is used. It is called when the application is ready.
+    """
+    if not get_search_backend().uses_index:
+        return
+    for model in get_searchable_models():
+        post_save.connect(index_object, sender=model, dispatch_uid='evileg_core_search_index')
+        post_delete.connect(remove_object, sender=model, dispatch_uid='evileg_core_search_index')
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+# Sent after every stage of markdown rendering, only when it has receivers, with arguments:
+#   stage - 'markdown', 'parse', 'sanitize', 'serialize' or 'render' for the whole rendering of a cache miss,
+#           streaming sanitizers do parsing, clean up and serialization in one 'sanitize' stage
+#   duration - wall time of stage in seconds
+#   input_size - length of input text of stage in characters, None for stages, which take a tree
+#   output_size - length of output text of stage in characters, None for stages, which produce a tree
+#   label - label of rendered content from markdown_render_context, for example 'blog.Article.content_markdown'
+#   pk - primary key of rendered object from markdown_render_context
+markdown_render_stage = Signal()
+
+_render_context = threading.local()
+
+
+@contextmanager
+def markdown_render_context(label, pk=None):
+    """
+    Mark rendering in the current thread with label of content and primary key of object,
+    they are sent with markdown_render_stage signal. EMarkdownField sets it for rendering on saving.
+
+    :param label: label of content, for example 'blog.Article.content_markdown'
+    :param pk: primary key of rendered object
+    """
+    previous = getattr(_render_context, 'value', None)
+    _render_context.value = (label, pk)
+    try:
+        yield
+    finally:
+        _render_context.value = previous
+
+
+class ERenderStageTimer:
+    """
+    Context manager, which measures stage of rendering and sends markdown_render_stage signal.
+    Time is not measured at all, when the signal has no receivers.
+
+    **Example**::
+
+        with ERenderStageTimer(EMarkdownWorker, 'markdown', len(text)) as timer:
+            html = convert(text)
+            timer.output_size = len(html)
+    """
+    __slots__ = ['sender', 'stage', 'input_size', 'output_size', 'started']
+
+    def __init__(self, sender, stage, input_size):
+        self.sender = sender
+        self.stage = stage
+        self.input_size = input_size
+        self.output_size = None
+        self.started = None
+
+    def __enter__(self):
+        if markdown_render_stage.receivers:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.started is not None and exc_type is None:
+            label, pk = getattr(_render_context, 'value', None) or (None, None)
+            markdown_render_stage.send(
+                sender=self.sender, stage=self.stage, duration=time.perf_counter() - self.started,
+                input_size=self.input_size, output_size=self.output_size, label=label, pk=pk
+            )
+
+
+class ERenderStageCollector:
+    """
+    Collector of durations of rendering stages from markdown_render_stage signal.
+    It keeps last max_samples durations per label and stage for percentiles
+    and the slowest renderings for search of pathological documents.
+
+    **Example**::
+
+        collector = ERenderStageCollector()
+        collector.connect()
+        ...
+        for (label, stage), stats in collector.get_percentiles().items():
+            statsd.timing('markdown.{}.{}.p99'.format(label, stage), stats['p99'] * 1000)
+
+    :param max_samples: number of last durations kept per label and stage
+    :param max_slowest: number of the slowest renderings kept
+    """
+
+    def __init__(self, max_samples=1000, max_slowest=20):
+        self.max_samples = max_samples
+        self.max_slowest = max_slowest
+        self._lock = threading.Lock()
+        self.reset()
+
+    def connect(self):
+        markdown_render_stage.connect(self.receive, dispatch_uid=id(self))
+
+    def disconnect(self):
+        markdown_render_stage.disconnect(dispatch_uid=id(self))
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+            self._counts = {}
+            self._slowest = []
+            self._sequence = itertools.count()
+
+    def receive(self, sender, stage, duration, input_size, output_size=None, label=None, pk=None, **kwargs):
+        key = (label, stage)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.max_samples)
+            samples.append(duration)
+            self._counts[key] = self._counts.get(key, 0) + 1
+            # Sequence number keeps items comparable, when durations are equal
+            item = (duration, next(self._sequence), stage, label, pk, input_size)
+            if len(self._slowest) < self.max_slowest:
+                heapq.heappush(self._slowest, item)
+            elif duration > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def get_percentiles(self, percents=(50, 90, 99)):
+        """
+        Get percentiles of durations per label and stage
+
+        :param percents: percentiles for calculation
+        :return: dict of (label, stage) to dict with 'count' of all received durations,
+                 'max' and 'p<percent>' durations in seconds of kept samples
+        """
+        with self._lock:
+            items = [(key, sorted(samples), self._counts[key]) for key, samples in self._samples.items()]
+        result = {}
+        for key, samples, count in items:
+            stats = {'count': count, 'max': samples[-1]}
+            for percent in percents:
+                # Nearest rank method
+                index = max(-(-percent * len(samples) // 100) - 1, 0)
+                stats['p{}'.format(percent)] = samples[index]
+            result[key] = stats
+        return result
+
+    def get_slowest(self):
+        """
+        Get the slowest stages
+
+        :return: list of (duration, stage, label, pk, input_size) tuples, the slowest first
+        """
+        with self._lock:
+            items = sorted(self._slowest, reverse=True)
+        return [(duration, *rest) for duration, sequence, *rest in items]
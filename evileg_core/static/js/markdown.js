@@ -1,4 +1,5 @@
 let allEditors = {};
+let previewBlocks = {};
 let LANGUAGES = {
     "": "text/x-c++src",
     "lang-bsh": "text/x-sh",
@@ -376,14 +377,24 @@ class EMarkdownEditor {
 
     static updatePreview(e) {
         let widgetId = e.data.widgetId;
+        let blocks = previewBlocks[widgetId] || {};
         $.ajax({
             url: '/evileg_core/markdown/',
             type: 'POST',
-            data: {'content': jQuery('#' + widgetId).val(),},
+            data: {'content': jQuery('#' + widgetId).val(), 'incremental': 1, 'known': Object.keys(blocks)},
+            traditional: true,
             dataType: 'json',
 
             success: function (json) {
-                jQuery('#' + widgetId + '_preview').html(json.preview);
+                // Only changed blocks are rendered, html of other blocks is taken from the previous preview
+                let currentBlocks = {};
+                let html = [];
+                for (let [hash, blockHtml] of json.blocks) {
+                    currentBlocks[hash] = blockHtml !== null ? blockHtml : blocks[hash];
+                    html.push(currentBlocks[hash]);
+                }
+                previewBlocks[widgetId] = currentBlocks;
+                jQuery('#' + widgetId + '_preview').html(html.join('\n'));
                 PR.prettyPrint();
             }
         });
@@ -1,4 +1,4 @@
-var allEditors={},LANGUAGES={"":"text/x-c++src","lang-bsh":"text/x-sh","lang-c":"text/x-csrc","lang-cc":"text/x-csrc","lang-cpp":"text/x-c++src","lang-cs":"text/x-c++src","lang-csh":"text/x-c++src","lang-cyc":"text/x-c++src","lang-cv":"text/x-c++src","lang-htm":"text/html","lang-html":"text/html","lang-java":"text/x-java","lang-js":"text/javascript","lang-m":"text/html","lang-mxml":"text/html","lang-perl":"text/x-perl","lang-pl":"text/x-sh","lang-pm":"text/x-sh","lang-py":"text/x-python","lang-rb":"text/x-ruby",
+var allEditors={},previewBlocks={},LANGUAGES={"":"text/x-c++src","lang-bsh":"text/x-sh","lang-c":"text/x-csrc","lang-cc":"text/x-csrc","lang-cpp":"text/x-c++src","lang-cs":"text/x-c++src","lang-csh":"text/x-c++src","lang-cyc":"text/x-c++src","lang-cv":"text/x-c++src","lang-htm":"text/html","lang-html":"text/html","lang-java":"text/x-java","lang-js":"text/javascript","lang-m":"text/html","lang-mxml":"text/html","lang-perl":"text/x-perl","lang-pl":"text/x-sh","lang-pm":"text/x-sh","lang-py":"text/x-python","lang-rb":"text/x-ruby",
 "lang-sh":"text/x-sh","lang-xhtml":"htmlmixed","lang-xml":"text/html","lang-xsl":"text/html"};function escapeRegExp(a){return a.replace(/([.*+?^=!:${}()|\[\]\/\\])/g,"\\$1")}function replaceAll(a,c,b){return a.replace(new RegExp(escapeRegExp(c),"g"),b)}
 var EMarkdownEditor=function(a,c,b){c=void 0===c?"":c;b=void 0===b?"":b;var d=this;this.fullscreen=!1;this.id=a;this.widget=jQuery("#"+a+"_markdown_widget");this.textarea=jQuery("#"+a);this.tabPreviewLink=jQuery("#"+a+"_tab_preview_link");this.tabPreviewLink.bind("shown.bs.tab",{widgetId:a},EMarkdownEditor.updatePreview);this.fullScreenButton=jQuery("#"+a+"_fullscreen_btn");this.fullScreenButton.on("click",(a)=>{a.preventDefault();d.fullScreen()});this.linkDialog=jQuery("#"+a+"_add_link_dialog");
 this.addLinkBtn=jQuery("#"+a+"_add_link_btn");this.addLinkBtn.bind("click",{dialog:this.linkDialog},EMarkdownEditor.showDialog);this.insertLinkBtn=jQuery("#"+a+"_insert_link_btn");this.insertLinkBtn.bind("click",{widgetId:a},EMarkdownEditor.insertLink);this.linkText=jQuery("#"+a+"_link_text");this.linkUrl=jQuery("#"+a+"_link_url");this.codeDialog=jQuery("#"+a+"_code_dialog");this.addCodeBtn=jQuery("#"+a+"_add_code_btn");this.addCodeBtn.bind("click",{dialog:this.codeDialog},EMarkdownEditor.showDialog);
@@ -16,4 +16,4 @@ EMarkdownEditor.showUploadFileDialog=(a)=>{a.preventDefault();var c=a.data.widge
 EMarkdownEditor.insertCode=(a)=>{a.preventDefault();if(a=EMarkdownEditor.get(a.data.widgetId)){var c=a.codeInput.val(),b=a.selectCode.val();if(0<c.length)return a.markdownMirrorEditor.replaceSelection("\n```"+b+"\n"+c+"\n```\n"),a.codeInput.val(""),a.mirrorEditor.getDoc().setValue(""),!0}return!1};
 EMarkdownEditor.insertLink=(a)=>{a.preventDefault();if(a=EMarkdownEditor.get(a.data.widgetId)){var c=a.linkUrl.val();if(0<c.length){var b=a.linkText.val(),d=void 0,d=0<b.length?"["+b+"]("+c+")":"["+c+"]("+c+")";a.markdownMirrorEditor.replaceSelection(d);a.linkUrl.val("");a.linkText.val("");return!0}}return!1};EMarkdownEditor.showDialog=(a)=>{a.data.dialog.modal("show");a.data.dialog.css("z-index",2E3);return!1};
 EMarkdownEditor.create=(a,c,b)=>{c=new EMarkdownEditor(a,void 0===c?"":c,b);return allEditors[a]=c};EMarkdownEditor.remove=(a)=>{delete allEditors[a]};EMarkdownEditor.get=(a)=>allEditors[a];EMarkdownEditor.saveSelection=()=>{if(window.getSelection){var a=window.getSelection();if(a.getRangeAt&&a.rangeCount)return a.getRangeAt(0)}else if(document.selection&&document.selection.createRange)return document.selection.createRange();return null};
-EMarkdownEditor.updatePreview=(a)=>{var c=a.data.widgetId;$.ajax({url:"/evileg_core/markdown/",type:"POST",data:{content:jQuery("#"+c).val()},dataType:"json",success(a){jQuery("#"+c+"_preview").html(a.preview);PR.prettyPrint()}})};
+EMarkdownEditor.updatePreview=(a)=>{var c=a.data.widgetId,d=previewBlocks[c]||{};$.ajax({url:"/evileg_core/markdown/",type:"POST",data:{content:jQuery("#"+c).val(),incremental:1,known:Object.keys(d)},traditional:!0,dataType:"json",success(a){var b={},e=[];for(var[f,g]of a.blocks)b[f]=null!==g?g:d[f],e.push(b[f]);previewBlocks[c]=b;jQuery("#"+c+"_preview").html(e.join("\n"));PR.prettyPrint()}})};
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import json
 import random
 from urllib.parse import urlparse
 
 from bootstrap4.utils import add_css_class
 from django import template
+from django.apps import apps
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.template.base import FilterExpression, kwarg_re
@@ -12,6 +14,7 @@ from django.template.loader import render_to_string
 from django.templatetags.static import static
 from django.utils.translation import ugettext_lazy as _
 
+from ..activities import count_activities
 from ..json_ld import generate_site_navigation_element_json_ld
 
 register = template.Library()
@@ -133,9 +136,41 @@ def render_object(context, obj, template_name='TEMPLATE_FULL', **kwargs):
 
 @register.filter
 def activities_count(activity_set, model_name):
-    if model_name:
-        return activity_set.search(model=ContentType.objects.get(model=model_name).model_class()).count()
-    return activity_set.count()
+    return count_activities(activity_set, model_name)
+
+
+@register.simple_tag
+def activity_counts(objects, activity_model):
+    """
+    Set numbers of activities from activity counters to page of objects with one query per model of objects
+
+    **Example**::
+
+        {% activity_counts object_list 'blog.Like' as objects %}
+        {% for object in objects %}{{ object.likes_count }}{% endfor %}
+
+    :param objects: list of content objects
+    :param activity_model: label of activity model
+    :return: list of objects
+    """
+    return apps.get_model(activity_model).objects.attach_counts(objects)
+
+
+@register.filter
+def markdown_toc(value):
+    """
+    Load table of contents, which is stored by EMarkdownField with toc_field
+
+    **Example**::
+
+        {% for header in article.content_toc|markdown_toc %}
+            <a class="toc-{{ header.level }}" href="#{{ header.anchor }}">{{ header.text }}</a>
+        {% endfor %}
+
+    :param value: JSON text of toc field
+    :return: list of dicts with 'level', 'text' and 'anchor' keys
+    """
+    return json.loads(value) if value else []
 
 
 @register.simple_tag
@@ -1,3 +1,747 @@
-from django.test import TestCase
+import asyncio
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from itertools import product
+from unittest import mock
 
-# Create your tests here.
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.db.models import Case, F, IntegerField, When
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.html import escape
+
+from . import fields
+from .activities import _content_types_by_model_name, connect_activity_counters, count_activities
+from .fields import EMarkdownField
+from .managers import EContentLinkManager, apply_list_projection
+from .mixins import EInterfaceMixin
+from .models import EAbstractActivity, EAbstractPost, EActivityCounter, ESearchDocument
+from .paginator import ECursorPage, ECursorPaginator
+from .search import (
+    ELikeSearchBackend, EPostgreSQLSearchBackend, ESQLiteSearchBackend, get_search_backend
+)
+from .sanitizers import EStreamSoup
+from .signals import ERenderStageCollector, markdown_render_context
+from .utils import EImageUrlsGetter, ESoup, EMarkdownWorker, get_excerpt, get_sanitizer_class
+from . import views
+from .views import EActivityView, EFilterByActivityView, EMarkdownView, EPaginatedView, markdown_preview_async
+
+MARKDOWN_SAMPLES = (
+    '# Header\n\nSome *text* with [link](https://example.com/page) and [local link](/ru/page/).',
+    '## Code\n\n```\nint main() { return a < b && c > d; }\n```\n\n    indented\n    code',
+    '| a | b |\n|---|---|\n| 1 | 2 |\n\n![image](/media/image.png) ![remote](https://example.com/x.png)',
+    '* one\n* two\n\n1. first\n2. second\n\n> quote\n> more',
+    'Video https://www.youtube.com/watch?v=dQw4w9WgXcQ and text\nwith line break',
+    '### Header with `code` and **bold**\n\nx^2^ and H~2~O',
+)
+
+HTML_SAMPLES = (
+    '<p>a &amp; b &lt; c</p><p>   </p><p>\n\n</p><p>\xa0</p>',
+    '<div class="prettyprint lang-py unknown" onclick="alert(1)" id="x">text</div>',
+    '<script>alert(1)</script><style>p {}</style><p>after</p>',
+    '<a href="https://evileg.com/en/page" rel="me" class="a">site</a><a href="http://other.com">other</a>',
+    '<img src="/ru/media/x.png" alt=\'say "hi"\' width="10" class="youtube-iframe"><img src="" alt="it\'s &quot;x&quot;">',
+    '<pre>  keep\n\n   spaces  </pre><textarea>\n  raw <b>\n</textarea><code> a </code>',
+    '<h1>Title <em>one</em></h1><h2>  </h2><h3><ruby>base<rt>ruby</rt></ruby> text</h3><h4><!-- c --></h4>',
+    '<!-- comment --><p>text<!----><!--\n\n--></p><?php echo 1 ?><!DOCTYPE html>',
+    '<p>unclosed <b>bold <i>italic</p>text</b> tail</div><li>item',
+    '<iframe src="//www.youtube.com/embed/x" allowfullscreen class="youtube-iframe"></iframe><br><hr>',
+    '<table><tr><td headers="a b">1</td></tr></table><template><p>t</p></template><input disabled>',
+    '<body class="prettyprint"><p>body with class</p></body>',
+)
+
+
+@override_settings(SITE_URL='https://evileg.com', LANGUAGES=[('en', 'English'), ('ru', 'Russian')])
+class SanitizerConformanceTest(SimpleTestCase):
+    """
+    EStreamSoup must produce the same html and links as ESoup
+    """
+
+    def assertSameOutput(self, text, **kwargs):
+        expected = ESoup(text, **kwargs)
+        actual = EStreamSoup(text, **kwargs)
+        self.assertEqual(actual.clean(), expected.clean())
+        self.assertEqual(actual.get_links(), expected.get_links())
+        self.assertEqual(actual.get_toc(), expected.get_toc())
+
+    def check_samples(self, samples):
+        for text, dofollow, add_header_anchors, compact in product(samples, *([(False, True)] * 3)):
+            with self.subTest(text=text, dofollow=dofollow, add_header_anchors=add_header_anchors, compact=compact):
+                self.assertSameOutput(text, dofollow=dofollow, add_header_anchors=add_header_anchors, compact=compact)
+
+    def test_markdown(self):
+        self.check_samples([EMarkdownWorker(text).markdown_text for text in MARKDOWN_SAMPLES])
+
+    def test_html(self):
+        self.check_samples(HTML_SAMPLES)
+
+    def test_tags_for_extracting(self):
+        for text in HTML_SAMPLES:
+            with self.subTest(text=text):
+                self.assertSameOutput(text, tags_for_extracting=('iframe', 'h1', 'pre'))
+
+    @override_settings(LANGUAGES=[('en', 'English')])
+    def test_single_language(self):
+        self.check_samples(HTML_SAMPLES[3:5])
+
+    def test_empty(self):
+        self.assertEqual(EStreamSoup('').clean(), '')
+        self.assertEqual(EStreamSoup('').get_links(), [])
+
+
+class SanitizerEngineTest(SimpleTestCase):
+
+    def test_default_engine(self):
+        self.assertIs(get_sanitizer_class(), ESoup)
+
+    @override_settings(MARKDOWN_SANITIZER_ENGINE='evileg_core.sanitizers.EStreamSoup', MARKDOWN_RENDER_CACHE=False)
+    def test_stream_engine(self):
+        self.assertIs(get_sanitizer_class(), EStreamSoup)
+        result = EMarkdownWorker(MARKDOWN_SAMPLES[0]).render(add_header_anchors=True, compact=True)
+        self.assertEqual(result['html'], ESoup.clean_text(
+            EMarkdownWorker(MARKDOWN_SAMPLES[0]).markdown_text, add_header_anchors=True, compact=True
+        ))
+
+
+@override_settings(MARKDOWN_RENDER_CACHE=False)
+class TableOfContentsTest(SimpleTestCase):
+    text = '# Intro\n\n## Setup\n\n## Setup\n\n## Setup_2\n\n### Usage with `code`'
+
+    def test_toc(self):
+        for engine in ('evileg_core.utils.ESoup', 'evileg_core.sanitizers.EStreamSoup'):
+            with self.subTest(engine=engine), self.settings(MARKDOWN_SANITIZER_ENGINE=engine):
+                result = EMarkdownWorker(self.text).render(add_header_anchors=True)
+                self.assertEqual(result['toc'], [
+                    {'level': 1, 'text': 'Intro', 'anchor': 'header_Intro'},
+                    {'level': 2, 'text': 'Setup', 'anchor': 'header_Setup'},
+                    {'level': 2, 'text': 'Setup', 'anchor': 'header_Setup_2'},
+                    {'level': 2, 'text': 'Setup_2', 'anchor': 'header_Setup_2_2'},
+                    {'level': 3, 'text': 'Usage with code', 'anchor': 'header_Usage_with_code'},
+                ])
+                for item in result['toc']:
+                    self.assertEqual(result['html'].count('id="{}"'.format(item['anchor'])), 1)
+
+    def test_without_anchors(self):
+        self.assertEqual(EMarkdownWorker(self.text).render()['toc'], [])
+
+
+class ExcerptTest(SimpleTestCase):
+
+    def test_excerpt(self):
+        html = EMarkdownWorker('# Title\n\nSome *text* &amp; `a < b`\n\n' + 'word ' * 20).get_text()
+        excerpt = get_excerpt(html, 40)
+        self.assertTrue(excerpt.startswith('Title Some text & a < b word word'))
+        self.assertEqual(len(excerpt), 40)
+        self.assertEqual(get_excerpt(''), '')
+
+    def test_interface_fallback(self):
+        obj = EInterfaceMixin()
+        obj.content = '<p>std::vector&lt;int&gt;</p>'
+        self.assertEqual(obj.get_excerpt(), 'std::vector<int>')
+        # Templates escape excerpt once
+        self.assertEqual(escape(obj.get_excerpt()), 'std::vector&lt;int&gt;')
+        obj.content_excerpt = 'Excerpt'
+        self.assertEqual(obj.get_excerpt(), 'Excerpt')
+
+
+@override_settings(MARKDOWN_RENDER_CACHE=False)
+class RenderStageSignalTest(SimpleTestCase):
+
+    def setUp(self):
+        self.collector = ERenderStageCollector(max_slowest=3)
+        self.collector.connect()
+        self.addCleanup(self.collector.disconnect)
+
+    def test_stages(self):
+        with markdown_render_context('blog.Article.content_markdown', 42):
+            EMarkdownWorker(MARKDOWN_SAMPLES[0]).render()
+        EMarkdownWorker(MARKDOWN_SAMPLES[1]).render()
+
+        percentiles = self.collector.get_percentiles()
+        for stage in ('markdown', 'parse', 'sanitize', 'serialize', 'render'):
+            self.assertEqual(percentiles[('blog.Article.content_markdown', stage)]['count'], 1)
+            self.assertEqual(percentiles[(None, stage)]['count'], 1)
+        stats = percentiles[(None, 'render')]
+        self.assertTrue(0 < stats['p50'] <= stats['p99'] <= stats['max'])
+
+        slowest = self.collector.get_slowest()
+        self.assertEqual(len(slowest), 3)
+        self.assertEqual(slowest, sorted(slowest, key=lambda item: item[0], reverse=True))
+
+    @override_settings(MARKDOWN_SANITIZER_ENGINE='evileg_core.sanitizers.EStreamSoup')
+    def test_stream_engine(self):
+        EMarkdownWorker(MARKDOWN_SAMPLES[0]).render()
+        self.assertEqual(
+            {stage for label, stage in self.collector.get_percentiles()}, {'markdown', 'sanitize', 'render'}
+        )
+
+    def test_percentiles(self):
+        for duration in range(1, 101):
+            self.collector.receive(None, 'render', duration / 1000, 10)
+        stats = self.collector.get_percentiles()[(None, 'render')]
+        self.assertEqual((stats['count'], stats['p50'], stats['p90'], stats['p99']), (100, 0.05, 0.09, 0.099))
+
+
+class CursorPaginatorTest(TestCase):
+
+    def setUp(self):
+        content_type = ContentType.objects.get_for_model(ESearchDocument)
+        ESearchDocument.objects.bulk_create([
+            ESearchDocument(content_type=content_type, object_id=index, text='abc'[index % 3]) for index in range(11)
+        ])
+        self.qs = ESearchDocument.objects.order_by('-text')
+        self.expected = list(self.qs.order_by('-text', '-pk'))
+
+    def test_forward_and_backward(self):
+        paginator = ECursorPaginator(self.qs, 4, url='?q=a&page=1')
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([obj for page in pages for obj in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [4, 4, 3])
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[0].next_url.startswith('?q=a&page='))
+
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = paginator.get_page(page.previous_cursor)
+            self.assertEqual(list(page), list(expected))
+        self.assertFalse(page.has_previous())
+
+    def test_stale_cursor(self):
+        paginator = ECursorPaginator(self.qs, 4)
+        page = paginator.get_page(paginator.get_page().next_cursor)
+        next_cursor, previous_cursor = page.next_cursor, page.previous_cursor
+        # Objects after the next cursor and before the previous cursor are deleted
+        ESearchDocument.objects.exclude(pk__in=[obj.pk for obj in self.expected[4:8]]).delete()
+        for cursor in (next_cursor, previous_cursor):
+            page = paginator.get_page(cursor)
+            self.assertEqual(list(page), self.expected[4:8])
+            self.assertFalse(page.has_previous())
+            self.assertIsNone(page.previous_url)
+            self.assertFalse(page.has_next())
+            self.assertIsNone(page.next_url)
+        self.assertIsNone(ECursorPage([], paginator, has_next=True, has_previous=True).next_cursor)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(list(ECursorPaginator(self.qs, 4).get_page('!broken')), self.expected[:4])
+
+    def test_nullable_ordering(self):
+        for descending in (True, False):
+            qs = ESearchDocument.objects.annotate(position=Case(
+                When(object_id__gt=4, then=F('object_id')), default=None, output_field=IntegerField(null=True)
+            ))
+            ordering = '-position' if descending else 'position'
+            paginator = ECursorPaginator(qs, 3, ordering=[ordering])
+            pages = [paginator.get_page()]
+            while pages[-1].has_next():
+                pages.append(paginator.get_page(pages[-1].next_cursor))
+            values = [(obj.position, obj.object_id) for page in pages for obj in page]
+            non_null = sorted(value for value in values if value[0] is not None)
+            nulls = sorted((value for value in values if value[0] is None), reverse=descending)
+            self.assertEqual(values, (non_null[::-1] if descending else non_null) + nulls)
+
+            page = pages[-1]
+            for expected in reversed(pages[:-1]):
+                page = paginator.get_page(page.previous_cursor)
+                self.assertEqual(list(page), list(expected))
+
+    def test_cursor_pagination_setting(self):
+        view = EPaginatedView()
+        view.request = RequestFactory().get('/')
+        with self.settings(EVILEG_CORE_CURSOR_PAGINATION=True):
+            self.assertTrue(view.get_paginated_page(self.qs, 4).is_cursor_page)
+        with self.settings(EVILEG_CORE_CURSOR_PAGINATION=False):
+            self.assertEqual(view.get_paginated_page(self.qs, 4).number, 1)
+            view.cursor_pagination = True
+            self.assertTrue(view.get_paginated_page(self.qs, 4).is_cursor_page)
+
+    def test_unsupported_ordering(self):
+        view = EPaginatedView(cursor_pagination=True)
+        view.request = RequestFactory().get('/')
+        page = view.get_paginated_page(ESearchDocument.objects.order_by('content_type__model', 'pk'), 4)
+        self.assertFalse(getattr(page, 'is_cursor_page', False))
+        self.assertEqual(page.number, 1)
+
+
+class PaginatedViewTest(TestCase):
+
+    def test_queryset_is_not_evaluated(self):
+        content_type = ContentType.objects.get_for_model(ESearchDocument)
+        ESearchDocument.objects.bulk_create([
+            ESearchDocument(content_type=content_type, object_id=index) for index in range(25)
+        ])
+        view = EPaginatedView(queryset=ESearchDocument.objects.order_by('pk'))
+        view.request = RequestFactory().get('/', {'page': 2})
+        with CaptureQueriesContext(connection) as queries:
+            page = view.get_context_data()['object_list']
+            self.assertEqual([obj.object_id for obj in page], list(range(10, 20)))
+        self.assertEqual(len(queries), 2)
+        self.assertIn('COUNT', queries[0]['sql'])
+        self.assertIn('LIMIT', queries[1]['sql'])
+
+
+class MediaPathsTest(SimpleTestCase):
+
+    def test_paths(self):
+        text = (
+            '<img src="/media/image (1).png" alt="a"><img src=\'https://evileg.com/media/a&amp;b.png?x=1\'>'
+            '<a href="/media/files/doc%20(2).pdf#page=2">doc</a>\n'
+            '![image](/media/markdown%20(3).png) and /media/plain.png, [link](/media/link.png)'
+        )
+        self.assertEqual(list(EImageUrlsGetter.iter_media_paths(text, '/media/')), [
+            'image (1).png', 'a&b.png', 'files/doc (2).pdf', 'markdown (3).png', 'plain.png', 'link.png'
+        ])
+
+
+class InternalUrlTest(SimpleTestCase):
+
+    def test_internal_url(self):
+        is_internal = EContentLinkManager.is_internal_url
+        self.assertTrue(is_internal('/media/a.png'))
+        self.assertFalse(is_internal('//evil.com/x'))
+        self.assertFalse(is_internal('//evil.com/x', 'https://evileg.com'))
+        self.assertFalse(is_internal('https://evileg.com/x'))
+        self.assertTrue(is_internal('https://evileg.com/x', 'https://evileg.com'))
+        self.assertTrue(is_internal('https://evileg.com', 'https://evileg.com/'))
+        self.assertFalse(is_internal('https://evileg.com.evil.org/x', 'https://evileg.com'))
+
+
+class SearchBackendTest(TestCase):
+
+    @override_settings(EVILEG_CORE_SEARCH_BACKEND=None)
+    def test_backend_selection(self):
+        self.assertIsInstance(get_search_backend(), ELikeSearchBackend)
+        self.assertFalse(get_search_backend().uses_index)
+        with self.settings(EVILEG_CORE_SEARCH_BACKEND='auto'):
+            if connection.vendor == 'sqlite':
+                self.assertIsInstance(get_search_backend(), ESQLiteSearchBackend)
+        with self.settings(EVILEG_CORE_SEARCH_BACKEND='evileg_core.search.EPostgreSQLSearchBackend'):
+            self.assertIsInstance(get_search_backend(), EPostgreSQLSearchBackend)
+        self.assertIsInstance(get_search_backend(), ELikeSearchBackend)
+
+    def test_like_lookup(self):
+        lookup = ELikeSearchBackend().get_like_lookup(['content', 'title'], 'qt')
+        self.assertEqual(lookup.children, [('content__icontains', 'qt'), ('title__icontains', 'qt')])
+        self.assertEqual(lookup.connector, 'OR')
+
+    def test_postgresql_query(self):
+        backend = EPostgreSQLSearchBackend()
+        self.assertEqual(backend.get_tsquery(backend.get_words('Qt, signals!')), 'Qt:* & signals:*')
+
+    def test_sqlite_ranking(self):
+        backend = ESQLiteSearchBackend()
+        if connection.vendor != 'sqlite' or not backend.is_available(connection):
+            self.skipTest('SQLite FTS5 is not available')
+        # Documents index themselves, so ESearchDocument is searched like a model with EPostManager
+        content_type = ContentType.objects.get_for_model(ESearchDocument)
+        ESearchDocument.objects.bulk_create([
+            ESearchDocument(content_type=content_type, object_id=1000 + index, text=text) for index, text in enumerate([
+                'Qt signals and slots', 'Qt signal signal signal', 'Django signals'
+            ])
+        ])
+        ESearchDocument.objects.update(object_id=F('id'))
+        documents = {document.text: document for document in ESearchDocument.objects.all()}
+
+        with self.assertNumQueries(0):
+            qs = backend.search(ESearchDocument.objects.all(), 'qt signal', ['text'])
+        with self.assertNumQueries(1):
+            ranked = list(qs.order_by('-search_rank')[:10])
+        self.assertEqual(ranked, [documents['Qt signal signal signal'], documents['Qt signals and slots']])
+        self.assertGreater(ranked[0].search_rank, ranked[1].search_rank)
+
+
+class CounterActivity(EAbstractActivity):
+
+    class Meta:
+        app_label = 'evileg_core'
+        # Table is created by test case
+        managed = False
+
+
+class CounterTarget(models.Model):
+    activities = GenericRelation(CounterActivity)
+
+    class Meta:
+        app_label = 'evileg_core'
+        # Table is created by test case
+        managed = False
+
+
+class ActivityTest(TestCase):
+    """
+    Counters and targets of activity model, which tables are created only for these tests
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(CounterActivity)
+            editor.create_model(CounterTarget)
+        connect_activity_counters()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(CounterTarget)
+            editor.delete_model(CounterActivity)
+        # Content types of test models are rolled back together with the test data
+        ContentType.objects.clear_cache()
+        _content_types_by_model_name.clear()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [get_user_model().objects.create(username='user{}'.format(index)) for index in range(3)]
+        cls.targets = [CounterTarget.objects.create() for index in range(3)]
+        cls.content_type = ContentType.objects.get_for_model(CounterTarget)
+        ContentType.objects.get_for_model(CounterActivity)
+
+    def like(self, user, target):
+        return CounterActivity.objects.create(user=user, content_type=self.content_type, object_id=target.pk)
+
+    def test_change(self):
+        # Counter is created from number of activities, which were created without signals
+        CounterActivity.objects.bulk_create([
+            CounterActivity(user=self.users[0], content_type=self.content_type, object_id=self.targets[0].pk)
+        ])
+        activity = self.like(self.users[1], self.targets[0])
+        self.assertEqual(CounterActivity.objects.get_count(self.targets[0]), 2)
+        self.like(self.users[2], self.targets[0])
+        self.assertEqual(CounterActivity.objects.get_count(self.targets[0]), 3)
+
+        activity.delete()
+        CounterActivity.objects.filter(object_id=self.targets[0].pk).delete()
+        counter = EActivityCounter.objects.get(object_id=self.targets[0].pk)
+        self.assertEqual(counter.count, 0)
+        EActivityCounter.objects.change(CounterActivity, self.content_type.pk, self.targets[0].pk, -1)
+        counter.refresh_from_db()
+        self.assertEqual(counter.count, 0)
+
+    def test_bulk_lookup(self):
+        self.like(self.users[0], self.targets[1])
+        self.like(self.users[1], self.targets[1])
+        EActivityCounter.objects.all().delete()
+        with self.assertNumQueries(3):
+            counts = EActivityCounter.objects.get_counts_by_ids(
+                CounterActivity, self.content_type.pk, [target.pk for target in self.targets]
+            )
+        self.assertEqual(counts, {self.targets[0].pk: 0, self.targets[1].pk: 2, self.targets[2].pk: 0})
+        with self.assertNumQueries(1):
+            objects = CounterActivity.objects.attach_counts(self.targets)
+        self.assertEqual([obj.counteractivitys_count for obj in objects], [0, 2, 0])
+
+    def test_count_activities(self):
+        self.like(self.users[0], self.targets[0])
+        self.like(self.users[0], self.targets[1])
+        CounterActivity.objects.get_count(self.targets[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(count_activities(self.targets[0].activities), 1)
+        self.assertEqual(count_activities(self.users[0].counteractivitys, 'countertarget'), 2)
+        self.assertEqual(count_activities(self.users[1].counteractivitys), 0)
+
+    def test_reconcile(self):
+        self.like(self.users[0], self.targets[0])
+        self.like(self.users[1], self.targets[1])
+        CounterActivity.objects.bulk_create([
+            CounterActivity(user=self.users[1], content_type=self.content_type, object_id=self.targets[0].pk),
+            CounterActivity(user=self.users[0], content_type=self.content_type, object_id=self.targets[2].pk),
+        ])
+        CounterActivity.objects.filter(object_id=self.targets[1].pk).update(object_id=self.targets[2].pk + 100)
+        self.assertEqual(EActivityCounter.objects.reconcile(CounterActivity), (2, 1, 1))
+        self.assertEqual(list(CounterActivity.objects.get_counts(self.targets).values()), [2, 0, 1])
+        call_command('reconcile_activity_counters', 'evileg_core.CounterActivity', stdout=StringIO())
+
+    def test_view(self):
+        view = EActivityView.as_view(activity_model=CounterActivity)
+        for data in ({}, {'obj': 'x', 'content_type': self.content_type.pk}, {'obj': 1, 'content_type': 0}):
+            request = RequestFactory().post('/', data)
+            request.user = self.users[0]
+            self.assertEqual(view(request).status_code, 400)
+        request = RequestFactory().post('/', {'obj': self.targets[0].pk, 'content_type': self.content_type.pk})
+        request.user = self.users[0]
+        self.assertJSONEqual(view(request).content, {'result': True, 'count': 1})
+
+    def test_prefetch_targets(self):
+        activities = [
+            CounterActivity(user=user, content_type=self.content_type, object_id=target.pk)
+            for user, target in product(self.users, self.targets[:2])
+        ]
+        # Activity of deleted object
+        activities[-1].object_id = self.targets[2].pk + 100
+        CounterActivity.objects.bulk_create(activities)
+        ContentType.objects.get_for_id(self.content_type.pk)
+        with CaptureQueriesContext(connection) as queries:
+            activities = list(CounterActivity.objects.prefetch_targets().order_by('pk'))
+            targets = [activity.get_self() for activity in activities]
+            names = [str(activity) for activity in activities]
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(len(names), 6)
+        self.assertEqual(targets, [self.targets[0], self.targets[1]] * 2 + [self.targets[0], None])
+
+    def test_filter_by_activity(self):
+        other = get_user_model().objects.create(username='other')
+        for target in (self.targets[1], self.targets[0], self.targets[2]):
+            self.like(self.users[0], target)
+        self.like(other, self.targets[1])
+        view = EFilterByActivityView(
+            model=CounterTarget, activity_model=CounterActivity, queryset=CounterTarget.objects.order_by('pk'),
+            cursor_pagination=True
+        )
+        view.request = RequestFactory().get('/')
+        view.request.user = self.users[0]
+        qs = view.get_queryset()
+        self.assertIn('IN (SELECT', str(qs.query))
+        self.assertEqual(list(qs), [self.targets[2], self.targets[0], self.targets[1]])
+
+        page = view.get_paginated_page(qs, 2)
+        self.assertTrue(page.is_cursor_page)
+        self.assertEqual(list(page), [self.targets[2], self.targets[0]])
+        view.request = RequestFactory().get('/', {'page': page.next_cursor})
+        view.request.user = self.users[0]
+        page = view.get_paginated_page(view.get_queryset(), 2)
+        self.assertEqual(list(page), [self.targets[1]])
+        self.assertFalse(page.has_next())
+        self.assertEqual(list(page.paginator.page(page.previous_cursor)), [self.targets[2], self.targets[0]])
+
+
+class ProjectionPost(EAbstractPost):
+
+    class Meta:
+        app_label = 'evileg_core'
+        # Table is created by test case
+        managed = False
+
+
+class ListProjectionTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(ProjectionPost)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(ProjectionPost)
+
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create(username='author')
+        ProjectionPost.objects.create(user=user, content_markdown='Text')
+
+    def test_projection(self):
+        qs = ProjectionPost.objects.search(approved=False)
+        self.assertEqual(qs.query.select_related, {'user': {}})
+        self.assertEqual(qs.query.deferred_loading, ({'content_markdown'}, True))
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.get().user.username, 'author')
+
+    def test_search_only(self):
+        qs = ProjectionPost.objects.search(approved=False, only=['content'])
+        self.assertFalse(qs.query.select_related)
+        self.assertEqual(qs.query.deferred_loading, ({'content'}, False))
+        self.assertIn('Text', qs.get().content)
+
+        qs = ProjectionPost.objects.search(approved=False, only=['content', 'user__username'])
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.get().user.username, 'author')
+
+    def test_deferred_queryset(self):
+        qs = apply_list_projection(ProjectionPost.objects.defer('user', 'content'))
+        self.assertFalse(qs.query.select_related)
+        self.assertEqual(qs.query.deferred_loading, ({'user', 'content'}, True))
+        self.assertEqual(qs.get().content_markdown, 'Text')
+
+
+class RenderPost(models.Model):
+    content = models.TextField(blank=True)
+    content_markdown = EMarkdownField(html_field='content', default='')
+    summary = models.TextField(blank=True)
+    summary_markdown = EMarkdownField(html_field='summary', default='')
+    note = models.TextField(blank=True)
+    note_markdown = EMarkdownField(html_field='note', default='', background_rendering=True)
+    dofollow = models.BooleanField(default=False)
+
+    class Meta:
+        app_label = 'evileg_core'
+        # Table is created by test case
+        managed = False
+
+
+class MarkdownFieldTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(RenderPost)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(RenderPost)
+
+    def test_render_pool(self):
+        executor = ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup
+        )
+        try:
+            with mock.patch.object(fields, '_render_executor', executor), mock.patch.object(fields, 'logger') as logger:
+                post = RenderPost.objects.create(content_markdown='# Pool', summary_markdown='**Pool** summary')
+        finally:
+            executor.shutdown()
+        logger.exception.assert_not_called()
+        self.assertIn('<h1>', post.content)
+        self.assertIn('<strong>', post.summary)
+        # Results of worker processes are put to the render cache of the saving process
+        compact_html = RenderPost._meta.get_field('content_markdown').compact_html
+        self.assertEqual(EMarkdownWorker('# Pool').get_cached(False, False, compact_html)['html'], post.content)
+
+    def test_render_pool_single_miss(self):
+        EMarkdownWorker('Cached').render(False, False, RenderPost._meta.get_field('content_markdown').compact_html)
+        executor = mock.Mock()
+        with mock.patch.object(fields, '_render_executor', executor):
+            post = RenderPost.objects.create(content_markdown='Cached', summary_markdown='Not cached')
+        executor.submit.assert_not_called()
+        self.assertIn('Cached', post.content)
+        self.assertIn('Not cached', post.summary)
+
+    def assertRenders(self, count, save):
+        with mock.patch.object(EMarkdownField, 'render', autospec=True, side_effect=EMarkdownField.render) as render:
+            save()
+        self.assertEqual(render.call_count, count)
+
+    def test_dirty_tracking(self):
+        post = RenderPost(content_markdown='Text')
+        self.assertRenders(1, post.save)
+        self.assertRenders(1, lambda: RenderPost.objects.create(content_markdown='Text'))
+
+        post = RenderPost.objects.get(pk=post.pk)
+        self.assertRenders(0, post.save)
+        post.content_markdown = 'Changed'
+        self.assertRenders(0, lambda: post.save(update_fields=['dofollow']))
+        self.assertRenders(1, lambda: post.save(update_fields=['content_markdown']))
+        self.assertRenders(0, post.save)
+
+        post = RenderPost.objects.get(pk=post.pk)
+        post.dofollow = True
+        self.assertRenders(1, post.save)
+        self.assertRenders(0, post.save)
+        with mock.patch.object(RenderPost._meta.get_field('content_markdown'), 'add_header_anchors', True):
+            self.assertRenders(1, post.save)
+            self.assertRenders(0, post.save)
+
+    def test_rerender_keeps_rows_saved_meanwhile(self):
+        from .management.commands import rerender_markdown
+        posts = [RenderPost.objects.create(content_markdown='Text {}'.format(index)) for index in range(2)]
+        RenderPost.objects.update(content='')
+
+        def render_rows(*args):
+            rendered = render_rows.original(*args)
+            # Editor saves the first row after it was read by the command
+            RenderPost.objects.filter(pk=posts[0].pk).update(content_markdown='Edited', content='<p>Edited</p>')
+            return rendered
+
+        render_rows.original = rerender_markdown._render_rows
+        stdout = StringIO()
+        with mock.patch.object(rerender_markdown, '_render_rows', render_rows):
+            call_command('rerender_markdown', 'evileg_core.RenderPost', workers=1, stdout=stdout)
+        self.assertIn('1 skipped', stdout.getvalue())
+        posts = list(RenderPost.objects.order_by('pk'))
+        self.assertEqual(posts[0].content, '<p>Edited</p>')
+        self.assertIn('Text 1', posts[1].content)
+
+
+@override_settings(MARKDOWN_BACKGROUND_WORKERS=0)
+class BackgroundRenderingTest(TransactionTestCase):
+    """
+    Rendering runs after commit, so the test is not wrapped in transaction
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(RenderPost)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(RenderPost)
+
+    def test_fill_in_after_commit(self):
+        with transaction.atomic():
+            post = RenderPost.objects.create(note_markdown='Background *text*')
+            self.assertEqual(post.note, '<div class="markdown-pending"><p>Background *text*</p></div>')
+            self.assertEqual(RenderPost.objects.get(pk=post.pk).note, post.note)
+        rendered = RenderPost.objects.get(pk=post.pk).note
+        self.assertIn('<em>', rendered)
+
+        # Rendered markdown is taken from the render cache without fallback html
+        post = RenderPost.objects.create(note_markdown='Background *text*')
+        self.assertEqual(post.note, rendered)
+
+    def test_markdown_changed_before_rendering(self):
+        with transaction.atomic():
+            post = RenderPost.objects.create(note_markdown='Stale *text*')
+            RenderPost.objects.filter(pk=post.pk).update(note_markdown='Edited', note='<p>Edited</p>')
+        self.assertEqual(RenderPost.objects.get(pk=post.pk).note, '<p>Edited</p>')
+
+
+class MarkdownPreviewTest(SimpleTestCase):
+
+    def preview(self, data, view=EMarkdownView.as_view()):
+        request = RequestFactory().post('/', data)
+        if asyncio.iscoroutinefunction(view):
+            response = asyncio.run(view(request))
+        else:
+            response = view(request)
+        return response.status_code, json.loads(response.content.decode())
+
+    @override_settings(MARKDOWN_PREVIEW_MAX_LENGTH=10)
+    def test_too_long(self):
+        for view in (EMarkdownView.as_view(), markdown_preview_async):
+            self.assertEqual(self.preview({'content': 'x' * 11}, view)[0], 413)
+            self.assertEqual(self.preview({'content': 'x' * 10}, view)[0], 200)
+
+    def test_busy(self):
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch.object(views, 'markdown_preview_slots', slots):
+            for index, view in enumerate((EMarkdownView.as_view(), markdown_preview_async)):
+                status, data = self.preview({'content': 'Busy preview {}'.format(index)}, view)
+                self.assertEqual(status, 429)
+            # Cached preview does not need free slot
+            EMarkdownWorker('Cached preview').render()
+            status, data = self.preview({'content': 'Cached preview'}, markdown_preview_async)
+            self.assertEqual(status, 200)
+            self.assertIn('Cached preview', data['preview'])
+
+    def test_incremental(self):
+        content = '# Title\n\nFirst paragraph\n\nSecond paragraph'
+        for view in (EMarkdownView.as_view(), markdown_preview_async):
+            status, data = self.preview({'content': content, 'incremental': '1'}, view)
+            self.assertEqual(status, 200)
+            self.assertEqual(len(data['blocks']), 3)
+            self.assertTrue(all(html for block_hash, html in data['blocks']))
+
+            known = [data['blocks'][0][0], data['blocks'][2][0]]
+            changed = content.replace('First', 'Changed')
+            status, data = self.preview({'content': changed, 'incremental': '1', 'known': known}, view)
+            self.assertEqual([block_hash for block_hash, html in data['blocks']][::2], known)
+            self.assertEqual([html for block_hash, html in data['blocks']][::2], [None, None])
+            self.assertIn('Changed paragraph', data['blocks'][1][1])
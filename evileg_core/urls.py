@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import django
 from django.apps import apps
 from django.urls import path
 
-from .views import EMarkdownView
+from .views import EMarkdownView, markdown_preview_async
 
 app_name = 'evileg_core'
 urlpatterns = [
     path('markdown/', EMarkdownView.as_view(), name='markdown')
 ]
 
+if django.VERSION >= (3, 1):
+    urlpatterns.append(path('markdown/async/', markdown_preview_async, name='markdown_async'))
+
 if apps.is_installed('dal') and apps.is_installed('dal_select2') and apps.is_installed('tagging'):
 
     from django.contrib.auth.decorators import login_required
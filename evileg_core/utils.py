@@ -1,26 +1,101 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import re
+import threading
+from functools import lru_cache, partial
+from html import unescape
+from urllib.parse import urlsplit
 
 import markdown
 import six
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 from django.conf import settings
 from django.contrib.auth.models import Group, Permission
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.functional import lazy
+from django.utils.html import strip_tags
 from django.utils.http import is_safe_url, urlunquote
+from django.utils.module_loading import import_string
 from django.utils.safestring import mark_safe
+from django.utils.text import Truncator
 
+from .cache import ERenderCache
 from .shortcuts import get_object_or_none
+from .signals import ERenderStageTimer
 
 mark_safe_lazy = lazy(mark_safe, six.text_type)
 
+# Bump this version, when changes of the rendering pipeline produce another html for the same markdown
+MARKDOWN_PIPELINE_VERSION = 3
+
+markdown_render_cache = ERenderCache(prefix='evileg_core:markdown')
+markdown_block_cache = ERenderCache(prefix='evileg_core:markdown_block', size_setting='MARKDOWN_BLOCK_CACHE_SIZE',
+                                    size=4096)
+
+DEFAULT_MARKDOWN_EXTENSIONS = (
+    'markdown.extensions.attr_list',
+    'markdown.extensions.tables',
+    'markdown.extensions.fenced_code',
+    'markdown.extensions.nl2br',
+    'evileg_core.extensions.video',
+    'superscript',
+    'subscript'
+)
+
+_markdown_converters = threading.local()
+_markdown_converters_generation = 0
+
+
+@receiver(setting_changed)
+def _reset_markdown_converters(setting, **kwargs):
+    global _markdown_converters_generation
+    if setting in ('MARKDOWN_EXTENSIONS', 'MARKDOWN_EXTENSION_CONFIGS'):
+        _markdown_converters_generation += 1
+
+
+def get_markdown_converter():
+    """
+    Get Markdown converter of the current thread.
+    The converter is built once per thread with extensions from MARKDOWN_EXTENSIONS
+    and MARKDOWN_EXTENSION_CONFIGS settings, and it is reset before each use.
+
+    Changing of MARKDOWN_EXTENSIONS changes rendered html, so bump MARKDOWN_RENDER_CACHE_VERSION too.
+
+    :return: markdown.Markdown
+    """
+    converter = getattr(_markdown_converters, 'converter', None)
+    if converter is None or _markdown_converters.generation != _markdown_converters_generation:
+        converter = markdown.Markdown(
+            extensions=list(getattr(settings, 'MARKDOWN_EXTENSIONS', DEFAULT_MARKDOWN_EXTENSIONS)),
+            extension_configs=getattr(settings, 'MARKDOWN_EXTENSION_CONFIGS', {}),
+            output_format='html5'
+        )
+        _markdown_converters.converter = converter
+        _markdown_converters.generation = _markdown_converters_generation
+    return converter.reset()
+
+
+def get_sanitizer_class():
+    """
+    Get class of html sanitizer from MARKDOWN_SANITIZER_ENGINE setting.
+    Default engine is ESoup, which is based on BeautifulSoup tree.
+    'evileg_core.sanitizers.EStreamSoup' is faster and uses less memory, it produces the same html.
+
+    :return: ESoup or its subclass
+    """
+    return import_string(getattr(settings, 'MARKDOWN_SANITIZER_ENGINE', 'evileg_core.utils.ESoup'))
+
 
 class EImageUrlsGetter:
     __slots__ = ['soup']
 
     def __init__(self, text):
-        self.soup = BeautifulSoup(text, "lxml") if text else None
+        self.soup = None
+        if text:
+            with ERenderStageTimer(type(self), 'parse', len(text)):
+                self.soup = BeautifulSoup(text, "lxml")
 
     def handle(self):
         if self.soup:
@@ -37,32 +112,151 @@ class EImageUrlsGetter:
         soup = EImageUrlsGetter(text=text)
         return soup.handle()
 
+    @classmethod
+    def iter_media_paths(cls, text, media_url=None):
+        """
+        Fast variant of get_urls without parsing of html.
+        It finds all references to MEDIA_URL in html or markdown, not only sources of images,
+        so it suits for scanning of big amount of content.
+
+        :param text: html or markdown text
+        :param media_url: url of media files, MEDIA_URL by default
+        :return: generator of unquoted paths relative to media_url
+        """
+        if text:
+            for match in _get_media_url_re(media_url or settings.MEDIA_URL).finditer(text):
+                # Punctuation after url in text is not a part of it
+                path = match.group(1) or match.group(2) or match.group(3).rstrip('.,;:!')
+                yield urlunquote(path.replace('&amp;', '&'))
+
+
+@lru_cache(maxsize=8)
+def _get_media_url_re(media_url):
+    """
+    Urls in quoted attributes end only at the quote, so names of files may contain spaces and parentheses.
+    Urls in markdown and text end at whitespace and brackets, balanced parentheses are allowed like in markdown links.
+    Any fragment of text in quotes, which contains media url, is a reference, it keeps files instead of deleting.
+    """
+    # The host of absolute MEDIA_URL is optional, because content may contain relative and absolute links
+    path = re.escape(urlsplit(media_url).path)
+    return re.compile(
+        r'"[^"<>]*?{path}([^"<>?#]+)|\'[^\'<>]*?{path}([^\'<>?#]+)|'
+        r'{path}((?:[^\s"\'<>()\[\]?#]|\([^\s"\'<>()\[\]?#]*\))+)'.format(path=path)
+    )
+
+
+class ETreeRewriter:
+    """
+    Engine for rewriting of BeautifulSoup tree in one traversal.
+    Rules are callables, which accept tag, and they are registered per tag name.
+    Rules registered for ALL_TAGS are applied to every tag before rules of the tag name.
+    Rules registered with on_leave=True are applied after all children of the tag were visited.
+    Tags from extracting list are removed together with their content and are not visited.
+    """
+    __slots__ = ['extracting', 'rules', 'leave_rules']
+
+    ALL_TAGS = '*'
+
+    def __init__(self, extracting=()):
+        self.extracting = frozenset(extracting)
+        self.rules = {}
+        self.leave_rules = {}
+
+    def register(self, tags, rule, on_leave=False):
+        """
+        Register rewrite rule
+
+        :param tags: tag name or iterable of tag names
+        :param rule: callable, which accepts tag
+        :param on_leave: apply rule after visiting of all children of the tag
+        :return: self
+        """
+        rules = self.leave_rules if on_leave else self.rules
+        for tag in ((tags,) if isinstance(tags, str) else tags):
+            rules.setdefault(tag, []).append(rule)
+        return self
+
+    def rewrite(self, soup):
+        common_rules = self.rules.get(self.ALL_TAGS, ())
+        stack = [(tag, None) for tag in reversed(soup.contents) if isinstance(tag, Tag)]
+        while stack:
+            tag, leave_rules = stack.pop()
+            if leave_rules is not None:
+                for rule in leave_rules:
+                    rule(tag)
+                continue
+
+            if tag.name in self.extracting:
+                tag.extract()
+                continue
+
+            tag_rules = self.rules.get(tag.name, ())
+            leave_rules = self.leave_rules.get(tag.name)
+            for rule in common_rules:
+                rule(tag)
+            for rule in tag_rules:
+                rule(tag)
+
+            if leave_rules:
+                stack.append((tag, leave_rules))
+            stack.extend((child, None) for child in reversed(tag.contents) if isinstance(child, Tag))
+        return soup
+
 
 class ESoup:
-    __slots__ = ['soup', 'tags_for_extracting', 'dofollow', 'add_header_anchors']
+    __slots__ = ['soup', 'tags_for_extracting', 'dofollow', 'add_header_anchors', 'compact', 'links', 'toc', 'anchors']
 
     """
-    Clean up class for extracting unwanted content from text, which was posted by users
+    Clean up class for extracting unwanted content from text, which was posted by users.
+    All clean up rules are applied in one traversal of the tree via ETreeRewriter.
+    In compact mode html is serialized as is, without indentation and line breaks, which are added by prettify.
+    Urls of links, images and embedded frames are collected during clean up to links list of (kind, url) tuples.
+    When header anchors are added, ids of anchors are unique and headers are collected to toc list
+    of dicts with 'level', 'text' and 'anchor' keys.
     """
-    def __init__(self, text, tags_for_extracting=(), dofollow=False, add_header_anchors=False):
-        self.soup = BeautifulSoup(text, "lxml") if text else None
+    LINK = 'link'
+    IMAGE = 'image'
+    EMBED = 'embed'
+
+    whitelist_tags = ('img', 'a', 'iframe')
+    whitelist_attrs = ('src', 'href', 'name', 'width', 'height', 'alt')
+    whitelist_classes = (
+        'youtube-wrapper', 'youtube-iframe', 'prettyprint', 'lang-bsh', 'lang-c', 'lang-cc', 'lang-cpp',
+        'lang-cs', 'lang-csh', 'lang-cyc', 'lang-cv', 'lang-htm', 'lang-html', 'lang-java', 'lang-js',
+        'lang-m', 'lang-mxml', 'lang-perl', 'lang-pl', 'lang-pm', 'lang-py', 'lang-rb', 'lang-sh',
+        'lang-xhtml', 'lang-xml', 'lang-xsl'
+    )
+    header_tags = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+    def __init__(self, text, tags_for_extracting=(), dofollow=False, add_header_anchors=False, compact=False):
+        self.soup = None
+        if text:
+            with ERenderStageTimer(type(self), 'parse', len(text)):
+                self.soup = BeautifulSoup(text, "lxml")
         self.tags_for_extracting = ('script', 'style',) + tags_for_extracting
         self.dofollow = dofollow
         self.add_header_anchors = add_header_anchors
-
-    def _add_header_anchors(self, soup):
-        for header_tag in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6']):
-            anchor = soup.new_tag('a')
-            anchor['class'] = 'anchor'
-            anchor['id'] = 'header_{}'.format(header_tag.text.replace(' ', '_'))
-            header_tag.insert(0, anchor)
-        return soup
-
-    def _extract_tags(self, soup, tags=()):
-        for tag in tags:
-            for current_tag in soup.find_all(tag):
-                current_tag.extract()
-        return soup
+        self.compact = compact
+        self.links = []
+        self.toc = []
+        self.anchors = set()
+
+    def _add_header_anchor(self, tag):
+        text = tag.text
+        anchor_id = 'header_{}'.format(text.replace(' ', '_'))
+        if anchor_id in self.anchors:
+            # Repeated headers get numbered ids: header_Example, header_Example_2, header_Example_3
+            number = 2
+            while '{}_{}'.format(anchor_id, number) in self.anchors:
+                number += 1
+            anchor_id = '{}_{}'.format(anchor_id, number)
+        self.anchors.add(anchor_id)
+        self.toc.append({'level': int(tag.name[1]), 'text': text.strip(), 'anchor': anchor_id})
+
+        anchor = self.soup.new_tag('a')
+        anchor['class'] = 'anchor'
+        anchor['id'] = anchor_id
+        tag.insert(0, anchor)
 
     def _remove_attrs(self, soup):
         for tag in soup.find_all(True):
@@ -75,108 +269,218 @@ class ESoup:
                 tag.attrs = {}
         return soup
 
-    def _remove_all_attrs_except_saving(self, soup, whitelist_tags=(), whitelist_attrs=(), whitelist_classes=()):
-        for tag in soup.find_all(True):
-            saved_classes = []
-            if tag.has_attr('class'):
-                classes = tag['class']
-                for class_str in whitelist_classes:
-                    if class_str in classes:
-                        saved_classes.append(class_str)
+    def _remove_all_attrs_except_saving(self, tag):
+        saved_classes = []
+        if tag.has_attr('class'):
+            classes = tag['class']
+            for class_str in self.whitelist_classes:
+                if class_str in classes:
+                    saved_classes.append(class_str)
 
-            if tag.name not in whitelist_tags:
-                tag.attrs = {}
-            else:
-                attrs = dict(tag.attrs)
-                for attr in attrs:
-                    if attr not in whitelist_attrs:
-                        del tag.attrs[attr]
-
-            if len(saved_classes) > 0:
-                tag['class'] = ' '.join(saved_classes)
-
-        return soup
-
-    def _add_rel_attr(self, soup, tag, attr):
-        site_url = getattr(settings, "SITE_URL", '/')
-        for tag in soup.find_all(tag):
-            attr_content = tag.get(attr)
-            if attr_content and not attr_content.startswith(site_url) and not attr_content.startswith('/'):
-                tag['rel'] = ['nofollow']
-        return soup
+        if tag.name not in self.whitelist_tags:
+            tag.attrs = {}
+        else:
+            for attr in list(tag.attrs):
+                if attr not in self.whitelist_attrs:
+                    del tag.attrs[attr]
 
-    def _add_class_attr(self, soup, tag, classes=()):
-        for tag in soup.find_all(tag):
-            saved_classes = []
-            if tag.has_attr('class'):
-                saved_classes.append(tag['class'])
-            saved_classes.extend(list(classes))
+        if len(saved_classes) > 0:
             tag['class'] = ' '.join(saved_classes)
-        return soup
 
-    def _add_attr(self, soup, tag, attr, value):
-        for tag in soup.find_all(tag):
-            tag[attr] = value
-        return soup
+    def _add_rel_attr(self, tag, attr, site_url):
+        attr_content = tag.get(attr)
+        if attr_content and not attr_content.startswith(site_url) and not attr_content.startswith('/'):
+            tag['rel'] = ['nofollow']
+
+    def _add_class_attr(self, tag, classes=()):
+        saved_classes = []
+        if tag.has_attr('class'):
+            saved_classes.append(tag['class'])
+        saved_classes.extend(list(classes))
+        tag['class'] = ' '.join(saved_classes)
+
+    def _add_attr(self, tag, attr, value):
+        tag[attr] = value
+
+    def _correct_url(self, tag, attr, site_url, site_url_parser, relational_url_parser):
+        attr_content = tag.get(attr)
+        if attr_content:
+            attr_content = site_url_parser.sub(site_url, attr_content)
+            attr_content = relational_url_parser.sub('', attr_content)
+            tag[attr] = attr_content
+
+    def _change_tag_name(self, tag, new_tag):
+        tag.name = new_tag
+
+    def _collect_link(self, tag, attr, kind):
+        url = tag.get(attr)
+        if url:
+            self.links.append((kind, url))
+
+    def get_rewriter(self):
+        """
+        Build ETreeRewriter with clean up rules. Override it for adding of own rules.
+
+        :return: ETreeRewriter
+        """
+        rewriter = ETreeRewriter(extracting=self.tags_for_extracting)
+        rewriter.register(ETreeRewriter.ALL_TAGS, self._remove_all_attrs_except_saving)
+
+        if not self.dofollow:
+            site_url = getattr(settings, "SITE_URL", '/')
+            rewriter.register('a', partial(self._add_rel_attr, attr='href', site_url=site_url))
+            rewriter.register('img', partial(self._add_rel_attr, attr='src', site_url=site_url))
 
-    def _correct_url(self, soup, tag, attr):
         site_url = getattr(settings, "SITE_URL", None)
         languages = getattr(settings, "LANGUAGES", None)
-
         if site_url is not None and languages is not None and len(languages) > 1:
-            site_url_parser = re.compile('({})'.format('|'.join(['^{}/{}'.format(site_url, code) for code, language in languages])))
-            relational_url_parser = re.compile('({})'.format('|'.join(['^/{}'.format(code) for code, language in languages])))
-
-            for tag in soup.find_all(tag):
-                attr_content = tag.get(attr)
-                if attr_content:
-                    attr_content = site_url_parser.sub(site_url, attr_content)
-                    attr_content = relational_url_parser.sub('', attr_content)
-                    tag[attr] = attr_content
-
-        return soup
-
-    def _change_tag_name(self, soup, old_tag, new_tag):
-        for tag in soup.find_all(old_tag):
-            tag.name = new_tag
-        return soup
+            parsers = {
+                'site_url': site_url,
+                'site_url_parser': re.compile('({})'.format(
+                    '|'.join(['^{}/{}'.format(site_url, code) for code, language in languages]))),
+                'relational_url_parser': re.compile('({})'.format(
+                    '|'.join(['^/{}'.format(code) for code, language in languages])))
+            }
+            rewriter.register('a', partial(self._correct_url, attr='href', **parsers))
+            rewriter.register('img', partial(self._correct_url, attr='src', **parsers))
+
+        rewriter.register('img', partial(self._add_attr, attr='loading', value='lazy'))
+        rewriter.register('img', partial(self._add_class_attr, classes=('img-fluid',)))
+        rewriter.register('table', partial(self._add_class_attr, classes=('table', 'table-bordered', 'table-hover')))
+        rewriter.register('code', partial(self._add_class_attr, classes=('prettyprint linenums',)))
+        rewriter.register('code', partial(self._change_tag_name, new_tag='pre'))
+        rewriter.register('a', partial(self._collect_link, attr='href', kind=self.LINK))
+        rewriter.register('img', partial(self._collect_link, attr='src', kind=self.IMAGE))
+        rewriter.register('iframe', partial(self._collect_link, attr='src', kind=self.EMBED))
+
+        if self.add_header_anchors:
+            rewriter.register(self.header_tags, self._add_header_anchor, on_leave=True)
+        return rewriter
 
     def clean(self):
         if self.soup:
-            soup = self._extract_tags(soup=self.soup, tags=self.tags_for_extracting)
-            soup = self._remove_all_attrs_except_saving(
-                soup=soup,
-                whitelist_tags=('img', 'a', 'iframe'),
-                whitelist_attrs=('src', 'href', 'name', 'width', 'height', 'alt'),
-                whitelist_classes=(
-                    'youtube-wrapper', 'youtube-iframe', 'prettyprint', 'lang-bsh', 'lang-c', 'lang-cc', 'lang-cpp',
-                    'lang-cs', 'lang-csh', 'lang-cyc', 'lang-cv', 'lang-htm', 'lang-html', 'lang-java', 'lang-js',
-                    'lang-m', 'lang-mxml', 'lang-perl', 'lang-pl', 'lang-pm', 'lang-py', 'lang-rb', 'lang-sh',
-                    'lang-xhtml', 'lang-xml', 'lang-xsl'
-                )
-            )
-            if not self.dofollow:
-                soup = self._add_rel_attr(soup=soup, tag='a', attr='href')
-                soup = self._add_rel_attr(soup=soup, tag='img', attr='src')
-            soup = self._correct_url(soup=soup, tag='a', attr='href')
-            soup = self._correct_url(soup=soup, tag='img', attr='src')
-            soup = self._add_attr(soup=soup, tag='img', attr='loading', value='lazy')
-            soup = self._add_class_attr(soup=soup, tag='img', classes=('img-fluid',))
-            soup = self._add_class_attr(soup=soup, tag='table', classes=('table', 'table-bordered', 'table-hover'))
-            soup = self._add_class_attr(soup=soup, tag='code', classes=('prettyprint linenums',))
-            soup = self._change_tag_name(soup=soup, old_tag='code', new_tag='pre')
-            if self.add_header_anchors:
-                soup = self._add_header_anchors(soup=soup)
-
-            return re.sub('<body>|</body>', '', soup.body.prettify())
+            with ERenderStageTimer(type(self), 'sanitize', None):
+                soup = self.get_rewriter().rewrite(self.soup)
+            with ERenderStageTimer(type(self), 'serialize', None) as timer:
+                if self.compact:
+                    html = soup.body.decode_contents()
+                else:
+                    html = re.sub('<body>|</body>', '', soup.body.prettify())
+                timer.output_size = len(html)
+            return html
         return ''
 
+    def get_links(self):
+        return self.links
+
+    def get_toc(self):
+        """
+        Table of contents, which is collected during clean up, when header anchors are added
+
+        :return: list of dicts with 'level' of header, 'text' of header and 'anchor' id in document order
+        """
+        return self.toc
+
     @classmethod
-    def clean_text(cls, text, tags_for_extracting=(), dofollow=False, add_header_anchors=False):
-        soup = ESoup(text=text, tags_for_extracting=tags_for_extracting, dofollow=dofollow, add_header_anchors=add_header_anchors)
+    def clean_text(cls, text, tags_for_extracting=(), dofollow=False, add_header_anchors=False, compact=False):
+        soup = cls(text=text, tags_for_extracting=tags_for_extracting, dofollow=dofollow,
+                   add_header_anchors=add_header_anchors, compact=compact)
         return soup.clean()
 
 
+_fence_re = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_list_item_re = re.compile(r'^ {0,3}([*+-]|\d+\.)[ \t]')
+_html_block_re = re.compile(r'^<([a-zA-Z][a-zA-Z0-9]*)')
+_reference_re = re.compile(r'^ {0,3}\[[^\]]+\]:', re.MULTILINE)
+
+
+def split_markdown_blocks(text):
+    """
+    Split markdown to top level blocks, which can be rendered separately with the same result.
+    Blocks are separated by blank lines. Fenced code, indented continuations, lists, blockquotes
+    and raw html blocks are not split. Text with reference links is not split at all,
+    because references are defined for the whole document.
+
+    :param text: markdown text
+    :return: list of blocks
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if _reference_re.search(text):
+        return [text]
+
+    blocks = []
+    lines = []
+    fence = None
+    html_tag = None
+    blank = False
+    previous = ''
+    for line in text.split('\n'):
+        if fence is None and html_tag is None and blank and line.strip() and lines:
+            continued = (
+                line[0] in ' \t' or
+                (_list_item_re.match(line) and (_list_item_re.match(previous) or previous.startswith((' ', '\t')))) or
+                (line.startswith('>') and previous.startswith('>'))
+            )
+            if not continued:
+                blocks.append('\n'.join(lines))
+                lines = []
+
+        lines.append(line)
+        stripped = line.strip()
+        if fence is not None:
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
+        elif html_tag is not None:
+            if '</{}>'.format(html_tag) in line:
+                html_tag = None
+        else:
+            match = _fence_re.match(line)
+            if match:
+                fence = match.group(1)
+            elif blank or len(lines) == 1:
+                match = _html_block_re.match(line)
+                if match and '</{}>'.format(match.group(1)) not in line:
+                    html_tag = match.group(1)
+
+        if stripped:
+            previous = line
+            blank = False
+        else:
+            blank = True
+
+    if lines:
+        blocks.append('\n'.join(lines))
+    return blocks
+
+
+def get_markdown_block_hash(block):
+    """
+    Short hash of markdown block for identification of blocks in incremental preview
+    """
+    return hashlib.sha256(block.encode('utf-8')).hexdigest()[:20]
+
+
+def get_plain_text(html):
+    """
+    Plain text of html with collapsed whitespace
+
+    :param html: html text
+    :return: plain text, it must be escaped in templates
+    """
+    return ' '.join(unescape(strip_tags(html)).split())
+
+
+def get_excerpt(html, length=500):
+    """
+    Plain text of html truncated to length characters
+
+    :param html: html text
+    :param length: maximal length of excerpt
+    :return: plain text, it must be escaped in templates
+    """
+    return Truncator(get_plain_text(html)).chars(length)
+
+
 def set_adding_header_anchors(model, add_header_anchors=True, field_name='content_markdown'):
     model._meta.get_field(field_name).add_header_anchors = add_header_anchors
     for code, language in getattr(settings, "LANGUAGES", []):
@@ -184,32 +488,109 @@ def set_adding_header_anchors(model, add_header_anchors=True, field_name='conten
 
 
 class EMarkdownWorker:
-    __slots__ = ['pre_markdown_text', 'markdown_text']
+    __slots__ = ['pre_markdown_text', '_markdown_text']
 
     """
-    Markdown converter. It will convert markdown text to html text with clean up from unwanted content, using ESoap class
+    Markdown converter. It will convert markdown text to html text with clean up from unwanted content, using ESoap class.
+    Results are cached in markdown_render_cache by hash of markdown text, rendering flags and pipeline version,
+    so markdown is converted only when html is not found in the cache.
     """
     def __init__(self, text):
         self.pre_markdown_text = text
-        self.markdown_text = None
-        self.make_html_from_markdown()
+        self._markdown_text = None
+
+    @property
+    def markdown_text(self):
+        if self._markdown_text is None:
+            self.make_html_from_markdown()
+        return self._markdown_text
 
     def make_html_from_markdown(self):
         if self.pre_markdown_text:
-            self.markdown_text = markdown.markdown(
-                self.pre_markdown_text,
-                extensions=['markdown.extensions.attr_list',
-                            'markdown.extensions.tables',
-                            'markdown.extensions.fenced_code',
-                            'markdown.extensions.nl2br',
-                            'evileg_core.extensions.video',
-                            'superscript',
-                            'subscript'],
-                output_format='html5'
+            with ERenderStageTimer(EMarkdownWorker, 'markdown', len(self.pre_markdown_text)) as timer:
+                self._markdown_text = get_markdown_converter().convert(self.pre_markdown_text)
+                timer.output_size = len(self._markdown_text)
+
+    def _get_cache_key(self, cache, dofollow, add_header_anchors, compact):
+        return cache.make_key(
+            self.pre_markdown_text, MARKDOWN_PIPELINE_VERSION, int(dofollow), int(add_header_anchors), int(compact)
+        )
+
+    def _render(self, cache, dofollow, add_header_anchors, compact, cached_only=False):
+        if not self.pre_markdown_text:
+            return {'html': '', 'links': [], 'toc': []}
+
+        key = None
+        if cache is not None:
+            key = self._get_cache_key(cache, dofollow, add_header_anchors, compact)
+            result = cache.get(key)
+            if result is not None or cached_only:
+                return result
+
+        with ERenderStageTimer(EMarkdownWorker, 'render', len(self.pre_markdown_text)) as timer:
+            soup = get_sanitizer_class()(
+                text=self.markdown_text, dofollow=dofollow, add_header_anchors=add_header_anchors, compact=compact
             )
+            result = {'html': soup.clean(), 'links': soup.get_links(), 'toc': soup.get_toc()}
+            timer.output_size = len(result['html'])
+        if key is not None:
+            cache.set(key, result)
+        return result
+
+    def get_cached(self, dofollow=False, add_header_anchors=False, compact=False):
+        """
+        Get render result from markdown_render_cache without rendering
+
+        :return: dict like render returns or None, if markdown was not rendered yet
+        """
+        return self._render(markdown_render_cache, dofollow, add_header_anchors, compact, cached_only=True)
+
+    def set_cached(self, result, dofollow=False, add_header_anchors=False, compact=False):
+        """
+        Put render result, which was rendered without cache, for example in other process, to markdown_render_cache
+
+        :param result: dict like render returns
+        """
+        if self.pre_markdown_text:
+            markdown_render_cache.set(
+                self._get_cache_key(markdown_render_cache, dofollow, add_header_anchors, compact), result
+            )
+
+    def render(self, dofollow=False, add_header_anchors=False, compact=False, use_cache=True):
+        """
+        Render markdown to html with clean up
+
+        :param use_cache: use markdown_render_cache, set it to False for bulk rendering of unique texts
+        :return: dict with 'html' text, 'links' list of (kind, url) tuples and 'toc' list from ESoup.get_toc,
+                 it must not be modified
+        """
+        return self._render(markdown_render_cache if use_cache else None, dofollow, add_header_anchors, compact)
+
+    def render_blocks(self, dofollow=False, add_header_anchors=False, compact=False, skip=(), cached_only=False):
+        """
+        Render markdown by top level blocks from split_markdown_blocks.
+        Every block is cached in markdown_block_cache by its hash, so only changed blocks are rendered,
+        size of its in-process tier is set by MARKDOWN_BLOCK_CACHE_SIZE setting, 4096 by default,
+        and html of the whole text is concatenation of html of blocks.
+        Ids of header anchors are unique only inside of a block, so it is intended for preview.
+
+        :param skip: hashes of blocks, which html is not needed, for example it is known by the editor already
+        :param cached_only: do not render blocks, which are not found in the cache
+        :return: list of (hash, html) tuples, html is None for skipped blocks and not cached blocks in cached_only mode
+        """
+        blocks = []
+        for block in split_markdown_blocks(self.pre_markdown_text or ''):
+            block_hash = get_markdown_block_hash(block)
+            result = None
+            if block_hash not in skip:
+                result = EMarkdownWorker(block)._render(
+                    markdown_block_cache, dofollow, add_header_anchors, compact, cached_only=cached_only
+                )
+            blocks.append((block_hash, result['html'] if result is not None else None))
+        return blocks
 
-    def get_text(self, dofollow=False, add_header_anchors=False):
-        return ESoup.clean_text(text=self.markdown_text, dofollow=dofollow, add_header_anchors=add_header_anchors)
+    def get_text(self, dofollow=False, add_header_anchors=False, compact=False):
+        return self.render(dofollow, add_header_anchors, compact)['html']
 
 
 def get_next_url(request):
@@ -1,31 +1,129 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from urllib.parse import urlsplit, urlunsplit
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import QuerySet
-from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
+from django.db.models import DateTimeField, OuterRef, QuerySet, Subquery
+from django.http import (
+    HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, JsonResponse
+)
 from django.shortcuts import render, get_object_or_404
 from django.template.loader import render_to_string
 from django.utils.http import is_safe_url
-from django.utils.translation import LANGUAGE_SESSION_KEY, check_for_language
+from django.utils.translation import LANGUAGE_SESSION_KEY, check_for_language, ugettext_lazy as _
 from django.views import View
 from django.views.generic import DetailView
 from django.views.generic.base import ContextMixin
 
 from .mixins import EAjaxableMixin, EPaginateMixin
+from .managers import apply_list_projection
+from .models import EActivityCounter
 from .utils import EMarkdownWorker, get_next_url
 
 
+markdown_preview_slots = threading.BoundedSemaphore(getattr(settings, 'MARKDOWN_PREVIEW_CONCURRENCY', 4))
+markdown_preview_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'MARKDOWN_PREVIEW_CONCURRENCY', 4), thread_name_prefix='markdown_preview'
+)
+
+
+def _check_markdown_preview(content):
+    max_length = getattr(settings, 'MARKDOWN_PREVIEW_MAX_LENGTH', 100000)
+    if max_length is not None and len(content) > max_length:
+        return JsonResponse({'error': _('Text is too long for preview')}, status=413)
+    return None
+
+
+def _busy_markdown_preview():
+    response = JsonResponse({'error': _('Preview is busy, please try again later')}, status=429)
+    response['Retry-After'] = getattr(settings, 'MARKDOWN_PREVIEW_RETRY_AFTER', 1)
+    return response
+
+
+def _get_markdown_preview(request, worker, cached_only):
+    """
+    Get preview data of markdown.
+
+    In incremental mode, when POST has 'incremental' parameter, markdown is rendered by blocks,
+    and the editor sends hashes of blocks, which it has already, in 'known' parameters.
+    The response contains all blocks in order, html of known blocks is null.
+
+    :param cached_only: return None instead of rendering, if markdown is not in the cache
+    :return: dict for JsonResponse or None
+    """
+    if request.POST.get('incremental'):
+        known = set(request.POST.getlist('known'))
+        blocks = worker.render_blocks(skip=known, cached_only=cached_only)
+        if cached_only and any(html is None and block_hash not in known for block_hash, html in blocks):
+            return None
+        return {'blocks': blocks}
+
+    result = worker.get_cached() if cached_only else worker.render()
+    return {'preview': result['html']} if result is not None else None
+
+
 class EMarkdownView(View):
     """
-    Markdown view for preview html content
+    Markdown view for preview html content.
+
+    Preview is served from the render cache when the same text was already rendered.
+    Otherwise it is rendered, when one of MARKDOWN_PREVIEW_CONCURRENCY slots is free during MARKDOWN_PREVIEW_WAIT
+    seconds, or 429 response is returned, so the editor keeps previous preview.
+    Text longer than MARKDOWN_PREVIEW_MAX_LENGTH is rejected with 413 response.
+    In incremental mode only changed blocks of markdown are rendered and sent to the editor.
     """
     def post(self, request):
-        return JsonResponse({'preview': EMarkdownWorker(request.POST.get('content')).get_text()})
+        content = request.POST.get('content') or ''
+        response = _check_markdown_preview(content)
+        if response:
+            return response
+
+        worker = EMarkdownWorker(content)
+        data = _get_markdown_preview(request, worker, cached_only=True)
+        if data is None:
+            if not markdown_preview_slots.acquire(timeout=getattr(settings, 'MARKDOWN_PREVIEW_WAIT', 0)):
+                return _busy_markdown_preview()
+            try:
+                data = _get_markdown_preview(request, worker, cached_only=False)
+            finally:
+                markdown_preview_slots.release()
+        return JsonResponse(data)
+
+
+async def markdown_preview_async(request):
+    """
+    Asynchronous variant of EMarkdownView for ASGI servers, Django 3.1 or newer is required.
+    Rendering is offloaded to the thread pool with MARKDOWN_PREVIEW_CONCURRENCY workers,
+    lookup in the render cache is offloaded to the default executor, because cache backends may block.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    content = request.POST.get('content') or ''
+    response = _check_markdown_preview(content)
+    if response:
+        return response
+
+    worker = EMarkdownWorker(content)
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, partial(_get_markdown_preview, request, worker, True))
+    if data is None:
+        if not markdown_preview_slots.acquire(blocking=False):
+            return _busy_markdown_preview()
+        try:
+            data = await loop.run_in_executor(
+                markdown_preview_executor, partial(_get_markdown_preview, request, worker, False)
+            )
+        finally:
+            markdown_preview_slots.release()
+    return JsonResponse(data)
 
 
 class EAjaxableView(EAjaxableMixin, View):
@@ -85,6 +183,8 @@ class EPaginatedView(ContextMixin, EPaginateMixin, EAjaxableView):
     paginated_by = 10
     by_user = False
     columns_view = False
+    list_select_related = None
+    list_defer = None
 
     def get_user(self, **kwargs):
         username = kwargs.get('user', None)
@@ -109,24 +209,32 @@ class EPaginatedView(ContextMixin, EPaginateMixin, EAjaxableView):
 
         if self.by_user:
             qs = qs.filter(user=self.get_user(**kwargs))
+        if isinstance(qs, QuerySet):
+            qs = apply_list_projection(qs, self.list_select_related, self.list_defer)
         return qs
 
     def get(self, request, *args, **kwargs):
         return render(request=request, template_name=self.template_name, context=self.get_context_data(**kwargs))
 
     def get_ajax(self, request, *args, **kwargs):
-        return JsonResponse({
+        context = self.get_context_data(**kwargs)
+        response = {
             'object_list': render_to_string(
                 request=request,
                 template_name=self.template_column_partials_name if self.columns_view else self.template_partials_name,
-                context=self.get_context_data(**kwargs)
+                context=context
             ),
-        })
+        }
+        page = context.get('object_list')
+        if getattr(page, 'is_cursor_page', False):
+            # Infinite scroll requests the next page by cursor, because cursor pages have no numbers
+            response['next_url'] = page.next_url
+        return JsonResponse(response)
 
     def _get_context_data(self, **kwargs):
         qs = self.get_queryset(**kwargs)
         return {
-            'object_list': self.get_paginated_page(qs, self.paginated_by) if qs else None,
+            'object_list': self.get_paginated_page(qs, self.paginated_by) if qs is not None else None,
             'last_question': self.get_pagination_url(),
             'columns_view': self.columns_view
         }
@@ -168,32 +276,61 @@ class EFilterDetailView(EFilterView, DetailView):
 
     def get_queryset(self, **kwargs):
         qs = super().get_queryset(**kwargs)
-        return qs.filter(**{self.object_pk_field_name: self.object.pk}) if qs else qs
+        return qs.filter(**{self.object_pk_field_name: self.object.pk}) if qs is not None else qs
 
 
 class EActivityView(View):
     activity_model = None
 
     def post(self, request):
-        pk = request.POST.get('obj')
-        ct = ContentType.objects.get(pk=request.POST.get('content_type'))
+        try:
+            pk = int(request.POST['obj'])
+            ct = ContentType.objects.get_for_id(int(request.POST['content_type']))
+            if pk < 0:
+                raise ValueError(pk)
+        except (KeyError, ValueError, ContentType.DoesNotExist):
+            return HttpResponseBadRequest()
         obj, created = self.activity_model.objects.get_or_create(content_type=ct, object_id=pk, user=request.user)
         if not created:
             obj.delete()
 
         return JsonResponse({
             "result": created,
-            "count": self.activity_model.objects.filter(content_type=ct, object_id=pk).count()
+            "count": EActivityCounter.objects.get_counts_by_ids(self.activity_model, ct.pk, [pk])[pk]
         })
 
 
 class EFilterByActivityView(EFilterView):
+    """
+    View of objects of model, which have activities of user, like bookmarks or likes of user.
+    Objects are selected by subquery of activities, annotated with activity_order from activity_date_field
+    and ordered by it, newest activities first, so the view supports cursor pagination.
+    Ordering of queryset, model or get_queryset of subclass is replaced with this ordering,
+    override get_queryset and call order_by after super() for another ordering.
+
+    :param activity_model: model of activity
+    :param activity_date_field: field of creation time of activity, DateTimeField with auto_now_add by default,
+                                pk is used, if activity model has no such field
+    """
     activity_model = None
+    activity_date_field = None
+
+    def get_activity_date_field(self):
+        if self.activity_date_field is not None:
+            return self.activity_date_field
+        for field in self.activity_model._meta.concrete_fields:
+            if isinstance(field, DateTimeField) and field.auto_now_add:
+                return field.name
+        return 'pk'
 
     def get_queryset(self, **kwargs):
-        model_name = self.model.__name__.lower()
-        activity_set = getattr(self.get_user(**kwargs), '{}s'.format(self.activity_model.__name__.lower())).filter(
-            content_type__model=model_name
-        ).only('object_id', 'user_id')
-        object_ids = [q.object_id for q in activity_set]
-        return super().get_queryset(**kwargs).filter(**{'id__in': object_ids})
+        activities = self.activity_model.objects.filter(
+            user=self.get_user(**kwargs), content_type=ContentType.objects.get_for_model(self.model)
+        )
+        return super().get_queryset(**kwargs).filter(
+            pk__in=activities.values('object_id')
+        ).annotate(
+            activity_order=Subquery(
+                activities.filter(object_id=OuterRef('pk')).order_by('-pk').values(self.get_activity_date_field())[:1]
+            )
+        ).order_by('-activity_order', '-pk')
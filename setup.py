@@ -26,6 +26,7 @@ setup(
         'django-bootstrap4',
         'Markdown',
         'beautifulsoup4',
+        'lxml',
         'djangocodemirror',
         'requests',
         'redis',